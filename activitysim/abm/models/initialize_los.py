@@ -1,11 +1,13 @@
 # ActivitySim
 # See full license in LICENSE.txt.
 import logging
+import math
 import os
 import time
 import multiprocessing
 import numba
 
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from contextlib import contextmanager
 
 import pandas as pd
@@ -19,11 +21,16 @@ from activitysim.core import tracing
 from activitysim.core import chunk
 from activitysim.core import inject
 from activitysim.core import los
+from activitysim.core import util
 
 from activitysim.core import pathbuilder
 
 logger = logging.getLogger(__name__)
 
+# network_los, data buffer and chunk_size for initialize_tvpb worker processes
+# (set before worker processes are forked, so they inherit them rather than having them pickled)
+_WORKER_STATE = {}
+
 
 @contextmanager
 def lock_data(lock):
@@ -68,6 +75,13 @@ def num_uninitialized(data, lock=None):
     return result
 
 
+def sum_progress(progress, lock=None):
+
+    with lock_data(lock):
+        result = progress.sum()
+    return result
+
+
 @inject.step()
 def initialize_los(network_los):
     """
@@ -98,24 +112,31 @@ def initialize_los(network_los):
 
         # if multiprocessing make sure shared cache is filled with np.nan
         # so that initialize_tvpb subprocesses can detect when cache is fully populated
-        if network_los.multiprocess():
+        # (DYNAMIC cache is populated on demand, so there is no shared buffer to initialize)
+        if network_los.multiprocess() and not tap_cache.is_dynamic:
             data, lock = tap_cache.get_data_and_lock_from_buffers()  # don't need lock here since single process
+            progress, progress_lock = tap_cache.get_progress_and_lock_from_buffers()
 
             if os.path.isfile(tap_cache.cache_path):
                 # fully populated cache should have been loaded from saved cache
                 assert not network_los.rebuild_tvpb_cache
                 assert not any_uninitialized(data, lock=None)
             else:
-                # shared cache should be filled with np.nan so that initialize_tvpb
+                # shared cache should be filled with np.nan (so unpopulated utilities are never mistaken for
+                # computed ones) and the per-offset progress counters zeroed so that initialize_tvpb
                 # subprocesses can detect when cache is fully populated
                 with lock_data(lock):
                     np.copyto(data, np.nan)
+                with lock_data(progress_lock):
+                    progress[:] = 0
 
 
-def compute_utilities_for_attribute_tuple(network_los, scalar_attributes, data, chunk_size, trace_label):
+def compute_utilities_for_attribute_tuple(network_los, scalar_attributes, data, chunk_size, trace_label,
+                                          od_slice=None):
 
     # scalar_attributes is a dict of attribute name/value pairs for this combination
     # (e.g. {'demographic_segment': 0, 'tod': 'AM', 'access_mode': 'walk'})
+    # od_slice is an optional slice of the od rows of this combination's 'skim' (all od rows if None)
 
     logger.info(f"{trace_label} scalar_attributes: {scalar_attributes}")
 
@@ -133,6 +154,8 @@ def compute_utilities_for_attribute_tuple(network_los, scalar_attributes, data,
 
     # get od skim_offset dataframe with uid index corresponding to scalar_attributes
     choosers_df = uid_calculator.get_od_dataframe(scalar_attributes)
+    if od_slice is not None:
+        choosers_df = choosers_df.iloc[od_slice]
 
     # choosers_df is pretty big and was custom made for compute_utilities but we don't need to chunk_log it
     # since it is created outside of adaptive_chunked_choosers and so will show up in baseline
@@ -174,10 +197,70 @@ def compute_utilities_for_attribute_tuple(network_los, scalar_attributes, data,
     logger.debug(f"{trace_label} updated utilities")
 
 
+def _compute_utilities_worker(scalar_attributes, od_slice, trace_label):
+    """
+    compute utilities for od_slice of a single attribute tuple in a forked initialize_tvpb worker process,
+    writing them into the shared data buffer inherited from the parent
+
+    Returns
+    -------
+    number of od rows computed and elapsed seconds
+    """
+    t0 = time.time()
+    compute_utilities_for_attribute_tuple(_WORKER_STATE['network_los'], scalar_attributes, _WORKER_STATE['data'],
+                                          _WORKER_STATE['chunk_size'], trace_label, od_slice=od_slice)
+    return od_slice.stop - od_slice.start, time.time() - t0
+
+
+def od_slices(num_od_rows, num_pieces):
+    """
+    split range(num_od_rows) into num_pieces (roughly equal) contiguous slices
+    """
+    bounds = np.linspace(0, num_od_rows, num_pieces + 1).astype(int)
+    return [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+
+def compute_utilities_concurrently(network_los, work_items, data, chunk_size, num_processes, on_completion):
+    """
+    compute utilities for work_items with a pool of num_processes forked worker processes
+
+    Parameters
+    ----------
+    work_items: list of (offset, scalar_attributes, od_slice, trace_label) tuples
+    data: numpy array wrapping shared memory buffer (so worker processes write utilities directly to it)
+    on_completion: callable(offset, num_od_rows, elapsed) called (in this process) as each work item completes
+    """
+
+    _WORKER_STATE.update(network_los=network_los, data=data, chunk_size=chunk_size)
+
+    pending_items = list(reversed(work_items))
+
+    try:
+        with ProcessPoolExecutor(max_workers=num_processes,
+                                 mp_context=multiprocessing.get_context('fork')) as executor:
+
+            in_flight = {}
+            while pending_items or in_flight:
+
+                while pending_items and len(in_flight) < 2 * num_processes:
+                    offset, scalar_attributes, od_slice, trace_label = pending_items.pop()
+                    future = executor.submit(_compute_utilities_worker, scalar_attributes, od_slice, trace_label)
+                    in_flight[future] = offset
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    offset = in_flight.pop(future)
+                    num_od_rows, elapsed = future.result()
+                    on_completion(offset, num_od_rows, elapsed)
+    finally:
+        _WORKER_STATE.clear()
+
+
 @inject.step()
 def initialize_tvpb(network_los, attribute_combinations, chunk_size):
     """
     Initialize STATIC tap_tap_utility cache and write mmap to disk.
+    (NOP if tvpb_cache_type is DYNAMIC, as DYNAMIC cache is populated on demand)
 
     uses pipeline attribute_combinations table created in initialize_los to determine which attribute tuples
     to compute utilities for.
@@ -185,8 +268,13 @@ def initialize_tvpb(network_los, attribute_combinations, chunk_size):
     if we are single-processing, this will be the entire set of attribute tuples required to fully populate cache
 
     if we are multiprocessing, then the attribute_combinations will have been sliced and we compute only a subset
-    of the tuples (and the other processes will compute the rest). All process wait until the cache is fully
-    populated before returning, and the locutor process writes the results.
+    of the tuples (and the other processes will compute the rest). All process wait (at the sub_process_barrier)
+    until the cache is fully populated before returning, and the locutor process writes the results.
+
+    if the initialize_tvpb_processes network_los setting is greater than 1, attribute tuples (split into od row
+    slices if there are too few tuples to keep them busy) are computed by a pool of that many forked worker
+    processes, which write utilities directly into a shared data buffer. Completion is tracked with a count of
+    computed od rows per attribute tuple (skim offset).
 
 
     FIXME - if we did not close this, we could avoid having to reload it from mmap when single-process?
@@ -205,6 +293,10 @@ def initialize_tvpb(network_los, attribute_combinations, chunk_size):
     tap_cache = network_los.tvpb.tap_cache
     assert not tap_cache.is_open
 
+    if tap_cache.is_dynamic:
+        logger.info(f"{trace_label} - skipping step because DYNAMIC tap_cache is populated on demand")
+        return
+
     # if cache already exists,
     if os.path.isfile(tap_cache.cache_path):
         # otherwise should have been deleted by TVPBCache.cleanup in initialize_los step
@@ -213,44 +305,93 @@ def initialize_tvpb(network_los, attribute_combinations, chunk_size):
                     f" and cache already exists: {tap_cache.cache_path}")
         return
 
+    # number of worker processes to fan attribute tuples (and od row slices) out to
+    num_processes = network_los.setting('initialize_tvpb_processes', 1)
+    if num_processes > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+        logger.warning(f"{trace_label} computing utilities serially since initialize_tvpb_processes "
+                       f"requires 'fork' multiprocessing start method")
+        num_processes = 1
+
+    num_offsets, num_od_rows, _ = uid_calculator.skim_shape
+
     if multiprocess:
         # we will compute 'skim' chunks at offsets specified by our slice of attribute_combinations_df
         data, lock = tap_cache.get_data_and_lock_from_buffers()
+        progress, progress_lock = tap_cache.get_progress_and_lock_from_buffers()
     else:
-        data = tap_cache.allocate_data_buffer(shared=False)
-        lock = None
+        if num_processes > 1:
+            # worker processes write to shared buffer
+            data, lock = tap_cache.wrap_data_buffer(tap_cache.allocate_data_buffer(shared=True))
+            with lock_data(lock):
+                np.copyto(data, np.nan)
+        else:
+            data = tap_cache.allocate_data_buffer(shared=False)
+            lock = None
+        progress = np.zeros(num_offsets, dtype=np.int64)
+        progress_lock = None
 
     logger.debug(f"{trace_label} processing {len(attribute_combinations_df)} attribute_combinations")
     logger.debug(f"{trace_label} compute utilities for attribute_combinations_df\n{attribute_combinations_df}")
 
-    for offset, scalar_attributes in attribute_combinations_df.to_dict('index').items():
+    # - list of (offset, scalar_attributes, od_slice, trace_label) work items
+    offsets = []
+    work_items = []
+    # split each offset's od rows so there are enough work items to keep all worker processes busy
+    num_pieces = math.ceil(2 * num_processes / len(attribute_combinations_df)) if num_processes > 1 else 1
+    for scalar_attributes in attribute_combinations_df.to_dict('index').values():
         # compute utilities for this 'skim' with a single full set of scalar attributes
-
-        offset = network_los.tvpb.uid_calculator.get_skim_offset(scalar_attributes)
+        offset = uid_calculator.get_skim_offset(scalar_attributes)
         tuple_trace_label = tracing.extend_trace_label(trace_label, f'offset{offset}')
+        offsets.append(offset)
+        for od_slice in od_slices(num_od_rows, num_pieces):
+            work_items.append((offset, scalar_attributes, od_slice, tuple_trace_label))
+
+    def on_completion(offset, num_rows, elapsed):
+        # count completed od rows at offset, so other processes can tell when cache is fully populated
+        with lock_data(progress_lock):
+            progress[offset] += num_rows
+        logger.debug(f"{trace_label} offset {offset} computed {util.INT(num_rows)} od pairs "
+                     f"in {elapsed:.3f} seconds")
+
+    t0 = time.time()
+    if num_processes > 1:
+        logger.info(f"{trace_label} computing utilities for {len(work_items)} work items "
+                    f"with {num_processes} worker processes")
+        compute_utilities_concurrently(network_los, work_items, data, chunk_size, num_processes, on_completion)
+    else:
+        for offset, scalar_attributes, od_slice, tuple_trace_label in work_items:
+            t1 = time.time()
+            compute_utilities_for_attribute_tuple(network_los, scalar_attributes, data, chunk_size,
+                                                  tuple_trace_label, od_slice=od_slice)
+            on_completion(offset, od_slice.stop - od_slice.start, time.time() - t1)
+
+    elapsed = time.time() - t0
+    num_od_pairs = len(offsets) * num_od_rows
+    logger.info(f"{trace_label} computed utilities for {util.INT(num_od_pairs)} od pairs in {elapsed:.3f} seconds "
+                f"({util.INT(num_od_pairs / max(elapsed, 1e-6))} od pairs per second)")
+
+    # make sure we populated the entire offset
+    for offset in offsets:
+        assert progress[offset] == num_od_rows, \
+            f"{trace_label} offset {offset} computed {progress[offset]} of {num_od_rows} od rows"
 
-        compute_utilities_for_attribute_tuple(network_los, scalar_attributes, data, chunk_size, tuple_trace_label)
-
-        # make sure we populated the entire offset
-        assert not any_uninitialized(data.reshape(uid_calculator.skim_shape)[offset], lock)
-
-    if multiprocess and not inject.get_injectable('locutor', False):
-        return
-
-    write_results = not multiprocess or inject.get_injectable('locutor', False)
-    if write_results:
-
-        if multiprocess:
-            # if multiprocessing, wait for all processes to fully populate share data before writing results
-            # (the other processes don't have to wait, since we were sliced by attribute combination
-            # and they must wait to coalesce at the end of the multiprocessing_step)
-            # FIXME testing entire array is costly in terms of RAM)
-
-            while any_uninitialized(data, lock):
-                logger.debug(f"{trace_label}.{multiprocessing.current_process().name} waiting for other processes"
-                             f" to populate {num_uninitialized(data, lock)} uninitialized data values")
-                time.sleep(5)
-
-        logger.info(f"{trace_label} writing static cache.")
-        with lock_data(lock):
-            tap_cache.write_static_cache(data)
+    if multiprocess:
+        # if multiprocessing, all processes wait for one another to fully populate shared data, so the locutor
+        # can write results as soon as the last of them is done (or fail, rather than hang, if one of them fails)
+        # (sub_process_barrier is injected by mp_tasks if there is more than one sub process)
+        barrier = inject.get_injectable('sub_process_barrier', None)
+        if barrier is not None:
+            logger.debug(f"{trace_label}.{multiprocessing.current_process().name} waiting for other processes")
+            barrier.wait()
+
+        if not inject.get_injectable('locutor', False):
+            return
+
+        # (checking the per-offset progress counters is much cheaper than scanning the entire array for nans)
+        num_computed = sum_progress(progress, progress_lock)
+        assert num_computed == num_offsets * num_od_rows, \
+            f"{trace_label} computed {num_computed} of {num_offsets * num_od_rows} od rows"
+
+    logger.info(f"{trace_label} writing static cache.")
+    with lock_data(lock):
+        tap_cache.write_static_cache(data)
@@ -2,6 +2,7 @@
 # See full license in LICENSE.txt.
 import logging
 import itertools
+import hashlib
 import os
 
 import numpy as np
@@ -255,16 +256,6 @@ def get_cached_spec(hhsize):
         logger.debug("build_cdap_spec returning cached injectable spec %s", spec_name)
         return spec
 
-    # this is problematic for multiprocessing and since we delete csv files in output_dir
-    # at the start of every run, doesn't provide any benefit in single-processing as the
-    # cached spec will be available as an injectable to subsequent chunks
-
-    # # try data dir
-    # if os.path.exists(config.output_file_path(spec_name)):
-    #     spec_path = config.output_file_path(spec_name)
-    #     logger.info("build_cdap_spec reading cached spec %s from %s", spec_name, spec_path)
-    #     return pd.read_csv(spec_path, index_col='Expression')
-
     return None
 
 
@@ -274,6 +265,44 @@ def cache_spec(hhsize, spec):
     inject.add_injectable(spec_name, spec)
 
 
+def spec_cache_file_path(interaction_coefficients, hhsize):
+    """
+    Return path of the file in the cache dir for the spec built from interaction_coefficients for hhsize
+
+    The file name includes a hash of the preprocessed interaction_coefficients (whose coefficient values
+    have already been looked up in the cdap coefficients file) so a changed coefficient is never
+    served a stale spec file from a prior run. (The cached_spec_name injectable is keyed by hhsize
+    alone, as coefficients don't change within a run.)
+    """
+    coefficients_hash = pd.util.hash_pandas_object(interaction_coefficients, index=True).values
+    digest = hashlib.md5(coefficients_hash.tobytes()).hexdigest()
+    return os.path.join(config.get_cache_dir(), f"{cached_spec_name(hhsize)}_{digest}.parquet")
+
+
+def read_spec_cache(interaction_coefficients, hhsize):
+    """
+    Read spec written by write_spec_cache (memory mapped), or return None if not in cache dir
+
+    This spares each process (and, when multiprocessing, each sub-process) from rebuilding the spec.
+    """
+    file_path = spec_cache_file_path(interaction_coefficients, hhsize)
+    if not os.path.isfile(file_path):
+        return None
+
+    logger.debug("build_cdap_spec reading cached spec from %s", file_path)
+    return pd.read_parquet(file_path, memory_map=True)
+
+
+def write_spec_cache(interaction_coefficients, hhsize, spec):
+
+    file_path = spec_cache_file_path(interaction_coefficients, hhsize)
+
+    # write to temp file and rename, as sub-processes may be writing (and reading) the same spec
+    temp_path = f"{file_path}.{os.getpid()}.tmp"
+    spec.to_parquet(temp_path)
+    os.replace(temp_path, file_path)
+
+
 def build_cdap_spec(interaction_coefficients, hhsize,
                     trace_spec=False, trace_label=None, cache=True):
     """
@@ -312,6 +341,9 @@ def build_cdap_spec(interaction_coefficients, hhsize,
         Rules and coefficients for generating interaction specs for different household sizes
     hhsize : int
         household size for which the spec should be built.
+    cache : bool
+        return cached spec if available, and cache spec once built, both as an injectable and
+        in the cache dir (keyed by a hash of interaction_coefficients) for use by other processes
 
     Returns
     -------
@@ -335,6 +367,11 @@ def build_cdap_spec(interaction_coefficients, hhsize,
         if spec is not None:
             return spec
 
+        spec = read_spec_cache(interaction_coefficients, hhsize)
+        if spec is not None:
+            cache_spec(hhsize, spec)
+            return spec
+
     expression_name = "Expression"
 
     # generate a list of activity pattern alternatives for this hhsize
@@ -448,6 +485,7 @@ def build_cdap_spec(interaction_coefficients, hhsize,
 
     if cache:
         cache_spec(hhsize, spec)
+        write_spec_cache(interaction_coefficients, hhsize, spec)
 
     t0 = tracing.print_elapsed_time("build_cdap_spec hh_size %s" % hhsize, t0)
 
@@ -488,27 +526,68 @@ def add_interaction_column(choosers, p_tup):
 
     # Since ptypes are always between 1 and 8, we represent the interaction as an integer (24)
     # rather than as a string ('24')
-    # FIXME - check that coding interactions as integers is in fact faster then coding as strings
 
     if p_tup != tuple(sorted(p_tup)):
         raise RuntimeError("add_interaction_column tuple not sorted" % p_tup)
 
-    # FIXME - this could be made more elegant and efficient
-    # I couldn't figure out a good way to do this in pandas, but we want to do something like:
-    # choosers['p1_p3'] = choosers['ptype_p1'].astype(str) + choosers['ptype_p3'].astype(str)
-
     dest_col = '_'.join(['p%s' % pnum for pnum in p_tup])
 
-    # build a string concatenating the ptypes of the persons in the order they appear in p_tup
-    choosers[dest_col] = choosers[add_pn('ptype', p_tup[0])].astype(str)
-    for pnum in p_tup[1:]:
-        choosers[dest_col] = choosers[dest_col] + choosers[add_pn('ptype', pnum)].astype(str)
+    # sort the ptypes of each household's interacting persons into increasing ptype order
+    ptypes = np.sort(choosers[[add_pn(_ptype_, pnum) for pnum in p_tup]].to_numpy(dtype=np.int64), axis=1)
+
+    if not ((ptypes >= 0) & (ptypes <= 9)).all():
+        raise RuntimeError("add_interaction_column ptypes must be single digit")
+
+    # and read them as the decimal digits of the interaction code (e.g. [2, 8] -> 28)
+    choosers[dest_col] = ptypes.dot(10 ** np.arange(len(p_tup) - 1, -1, -1))
+
 
-    # sort the list of ptypes so it is in increasing ptype order, then convert to int
-    choosers[dest_col] = choosers[dest_col].apply(lambda x: ''.join(sorted(x))).astype(int)
+def household_arrays(indiv_utils):
+    """
+    Pivot the ptypes and M, N, H utilities of (non-extra) household members into arrays with one
+    row per household and one column per cdap_rank, so hh_choosers for every hhsize can be sliced
+    from them, rather than assembled with a merge per cdap_rank.
+
+    Households appear in the order of their cdap_rank 1 member in indiv_utils.
+
+    Parameters
+    ----------
+    indiv_utils : pandas.DataFrame
+        CDAP utilities for each individual (as returned by individual_utilities) with
+        columns 'M', 'N', 'H' and [_hh_id_, _ptype_, 'cdap_rank', _hh_size_]
+
+    Returns
+    -------
+    dict of numpy.ndarray
+        _hh_id_ : household ids
+        _hh_size_ : household size (capped at MAX_HHSIZE)
+        _ptype_ : (households x MAX_HHSIZE) ptypes, 0 where household has no person with that cdap_rank
+        'utils' : (households x MAX_HHSIZE x 3) M, N, and H utilities
+    """
+
+    rank1 = (indiv_utils['cdap_rank'] == 1).values
+    hh_ids = indiv_utils[_hh_id_].values[rank1]
+
+    rows = pd.Index(hh_ids).get_indexer(indiv_utils[_hh_id_].values)
+    cols = indiv_utils['cdap_rank'].values - 1
+    in_hh = (rows >= 0) & (cols < MAX_HHSIZE)
+    rows, cols = rows[in_hh], cols[in_hh]
 
+    ptypes = np.zeros((len(hh_ids), MAX_HHSIZE), dtype=indiv_utils[_ptype_].dtype)
+    ptypes[rows, cols] = indiv_utils[_ptype_].values[in_hh]
 
-def hh_choosers(indiv_utils, hhsize):
+    utils = np.zeros((len(hh_ids), MAX_HHSIZE, 3), dtype=np.float64)
+    utils[rows, cols] = indiv_utils[['M', 'N', 'H']].values[in_hh]
+
+    return {
+        _hh_id_: hh_ids,
+        _hh_size_: np.minimum(indiv_utils[_hh_size_].values[rank1], MAX_HHSIZE),
+        _ptype_: ptypes,
+        'utils': utils,
+    }
+
+
+def hh_choosers(indiv_utils, hhsize, hh_arrays=None):
     """
     Build a chooser table for calculating house utilities for all households of specified hhsize
 
@@ -536,6 +615,9 @@ def hh_choosers(indiv_utils, hhsize):
         MAX_HHSIZE members will be included with MAX_HHSIZE choosers since the are handled the
         same, and the activities of the extra members are assigned afterwards
 
+    hh_arrays : dict or None
+        household_arrays(indiv_utils), if already computed (e.g. to build choosers for all hhsizes)
+
     Returns
     -------
     choosers : pandas.DataFrame
@@ -543,41 +625,29 @@ def hh_choosers(indiv_utils, hhsize):
         for all (non-extra) household members
     """
 
-    # we want to merge the ptype and M, N, and H utilities for each individual in the household
-    merge_cols = [_hh_id_, _ptype_, 'M', 'N', 'H']
-
     if hhsize > MAX_HHSIZE:
         raise RuntimeError("hh_choosers hhsize > MAX_HHSIZE")
 
-    if hhsize < MAX_HHSIZE:
-        include_households = (indiv_utils[_hh_size_] == hhsize)
-    else:
-        # we want to include larger households along with MAX_HHSIZE households
-        include_households = (indiv_utils[_hh_size_] >= MAX_HHSIZE)
-
-    # start with all the individuals with cdap_rank of 1 (thus there will be one row per household)
-    choosers = indiv_utils.loc[include_households & (indiv_utils['cdap_rank'] == 1), merge_cols]
-    # rename columns, adding pn suffix (e.g. ptype_p1, M_p1) to all columns except hh_id
-    choosers.columns = add_pn(merge_cols, 1)
-
-    # for each of the higher cdap_ranks
-    for pnum in range(2, hhsize+1):
-
-        # df with merge columns for indiv with cdap_rank of pnum
-        rhs = indiv_utils.loc[include_households & (indiv_utils['cdap_rank'] == pnum), merge_cols]
-        # rename columns, adding pn suffix (e.g. ptype_p1, M_p1) to all columns except hh_id
-        rhs.columns = add_pn(merge_cols, pnum)
+    if hh_arrays is None:
+        hh_arrays = household_arrays(indiv_utils)
 
-        # merge this cdap_rank into choosers
-        choosers = pd.merge(left=choosers, right=rhs, on=_hh_id_)
+    # households of hhsize (or larger, if MAX_HHSIZE) with a member for every cdap_rank up to hhsize
+    ptypes = hh_arrays[_ptype_]
+    include_households = (hh_arrays[_hh_size_] == hhsize) & (ptypes[:, :hhsize] != 0).all(axis=1)
 
-    # we set index to _hh_id_ choosers has one row per household
-    set_hh_index(choosers)
+    ptypes = ptypes[include_households]
+    utils = hh_arrays['utils'][include_households]
 
-    # coerce utilities to float (merge apparently makes column type objects)
+    # ptype and M, N, and H utilities for each individual in the household (e.g. ptype_p1, M_p1,...)
+    columns = {}
     for pnum in range(1, hhsize+1):
-        pn_cols = add_pn(['M', 'N', 'H'], pnum)
-        choosers[pn_cols] = choosers[pn_cols].astype(float)
+        columns[add_pn(_ptype_, pnum)] = ptypes[:, pnum - 1]
+        for i, activity in enumerate(['M', 'N', 'H']):
+            columns[add_pn(activity, pnum)] = utils[:, pnum - 1, i]
+
+    # choosers has one row per household
+    index = pd.Index(hh_arrays[_hh_id_][include_households], name=_hh_index_)
+    choosers = pd.DataFrame(columns, index=index)
 
     # add interaction columns for all 2 and 3 person interactions
     for i in range(2, min(hhsize, MAX_INTERACTION_CARDINALITY)+1):
@@ -588,7 +658,7 @@ def hh_choosers(indiv_utils, hhsize):
 
 
 def household_activity_choices(indiv_utils, interaction_coefficients, hhsize,
-                               trace_hh_id=None, trace_label=None):
+                               trace_hh_id=None, trace_label=None, hh_arrays=None):
     """
     Calculate household utilities for each activity pattern alternative for households of hhsize
     The resulting activity pattern for each household will be coded as a string of activity codes.
@@ -607,6 +677,9 @@ def household_activity_choices(indiv_utils, interaction_coefficients, hhsize,
     hhsize : int
         the size of household for which activity perttern should be calculated (1..MAX_HHSIZE)
 
+    hh_arrays : dict or None
+        household_arrays(indiv_utils), if already computed
+
     Returns
     -------
     choices : pandas.Series
@@ -625,7 +698,7 @@ def household_activity_choices(indiv_utils, interaction_coefficients, hhsize,
         set_hh_index(utils)
     else:
 
-        choosers = hh_choosers(indiv_utils, hhsize=hhsize)
+        choosers = hh_choosers(indiv_utils, hhsize=hhsize, hh_arrays=hh_arrays)
 
         spec = build_cdap_spec(interaction_coefficients, hhsize,
                                trace_spec=(trace_hh_id in choosers.index),
@@ -823,6 +896,10 @@ def _run_cdap(
                                        trace_hh_id, trace_label)
     chunk.log_df(trace_label, 'indiv_utils', indiv_utils)
 
+    # pivot individual ptypes and utilities into household arrays once for all hhsizes
+    hh_arrays = household_arrays(indiv_utils)
+    chunk.log_df(trace_label, 'hh_arrays', hh_arrays)
+
     # compute interaction utilities, probabilities, and hh activity pattern choices
     # for each size household separately in turn up to MAX_HHSIZE
     hh_choices_list = []
@@ -830,12 +907,14 @@ def _run_cdap(
 
         choices = household_activity_choices(
             indiv_utils, interaction_coefficients, hhsize=hhsize,
-            trace_hh_id=trace_hh_id, trace_label=trace_label)
+            trace_hh_id=trace_hh_id, trace_label=trace_label, hh_arrays=hh_arrays)
 
         hh_choices_list.append(choices)
 
     del indiv_utils
     chunk.log_df(trace_label, 'indiv_utils', None)
+    del hh_arrays
+    chunk.log_df(trace_label, 'hh_arrays', None)
 
     # concat all the household choices into a single series indexed on _hh_index_
     hh_activity_choices = pd.concat(hh_choices_list)
@@ -156,3 +156,67 @@ def test_build_cdap_spec_hhsize2(people, model_settings):
         columns=['HH', 'HM', 'HN', 'MH', 'MM', 'MN', 'NH', 'NM', 'NN']).astype('float')
 
     pdt.assert_frame_equal(utils, expected, check_names=False)
+
+
+def test_hh_choosers(people, model_settings):
+
+    cdap_indiv_and_hhsize1 = simulate.read_model_spec(file_name='cdap_indiv_and_hhsize1.csv')
+
+    person_type_map = model_settings.get('PERSON_TYPE_MAP', {})
+
+    with chunk.chunk_log('test_hh_choosers', base=True):
+        cdap.assign_cdap_rank(people, person_type_map)
+        indiv_utils = cdap.individual_utilities(people, cdap_indiv_and_hhsize1, locals_d=None)
+
+        hh_arrays = cdap.household_arrays(indiv_utils)
+
+        for hhsize in range(2, cdap.MAX_HHSIZE + 1):
+
+            choosers = cdap.hh_choosers(indiv_utils, hhsize=hhsize, hh_arrays=hh_arrays)
+            pdt.assert_frame_equal(choosers, cdap.hh_choosers(indiv_utils, hhsize=hhsize))
+
+            # one row per household of hhsize (households with more than MAX_HHSIZE persons included in MAX_HHSIZE)
+            hh_sizes = people.groupby('household_id').size().clip(upper=cdap.MAX_HHSIZE)
+            assert sorted(choosers.index) == sorted(hh_sizes[hh_sizes == hhsize].index)
+
+            for pnum in range(1, hhsize + 1):
+                person = indiv_utils[indiv_utils.cdap_rank == pnum].set_index('household_id').loc[choosers.index]
+                assert (choosers[f'ptype_p{pnum}'] == person.ptype).all()
+                assert (choosers[f'M_p{pnum}'] == person.M).all()
+
+            # interaction codes are the ptypes of the interacting persons in increasing ptype order
+            expected = (choosers.ptype_p1.astype(str) + choosers.ptype_p2.astype(str)).map(sorted).str.join('')
+            assert (choosers.p1_p2 == expected.astype(int)).all()
+
+
+def test_build_cdap_spec_cache():
+
+    interaction_coefficients = pd.read_csv(config.config_file_path('cdap_interaction_coefficients.csv'), comment='#')
+    interaction_coefficients = cdap.preprocess_interaction_coefficients(interaction_coefficients)
+
+    hhsize = 3
+    spec = cdap.build_cdap_spec(interaction_coefficients, hhsize=hhsize, cache=False)
+
+    # in case a spec for other coefficients was cached as injectable by an earlier test
+    inject.remove_injectable(cdap.cached_spec_name(hhsize))
+
+    cache_path = cdap.spec_cache_file_path(interaction_coefficients, hhsize)
+    if os.path.exists(cache_path):
+        os.unlink(cache_path)
+
+    # built spec is written to cache dir
+    pdt.assert_frame_equal(cdap.build_cdap_spec(interaction_coefficients, hhsize=hhsize), spec)
+    assert os.path.isfile(cache_path)
+
+    # and is read from cache dir by processes without the cached injectable
+    inject.remove_injectable(cdap.cached_spec_name(hhsize))
+    pdt.assert_frame_equal(cdap.read_spec_cache(interaction_coefficients, hhsize), spec)
+    pdt.assert_frame_equal(cdap.build_cdap_spec(interaction_coefficients, hhsize=hhsize), spec)
+
+    # changed coefficients key a different spec
+    interaction_coefficients.loc[0, 'coefficient'] += 1
+    assert cdap.spec_cache_file_path(interaction_coefficients, hhsize) != cache_path
+    assert cdap.read_spec_cache(interaction_coefficients, hhsize) is None
+
+    inject.remove_injectable(cdap.cached_spec_name(hhsize))
+    os.unlink(cache_path)
@@ -1,7 +1,6 @@
 # ActivitySim
 # See full license in LICENSE.txt.
 import logging
-import time
 import multiprocessing
 import ctypes
 
@@ -46,20 +45,6 @@ size_table: pandas.DataFrame
 """
 
 
-"""
-Artisanal reverse semaphores to synchronize concurrent access to shared data buffer
-
-we use the first two rows of the final column in numpy-wrapped shared data as 'reverse semaphores'
-(they synchronize concurrent access to shared data resource rather than throttling access)
-
-ShadowPriceCalculator.synchronize_choices coordinates access to the global aggregate zone counts
-(local_modeled_size summed across all sub-processes) using these two semaphores
-(which are really only tuples of indexes of locations in the shared data array.
-"""
-TALLY_CHECKIN = (0, -1)
-TALLY_CHECKOUT = (1, -1)
-
-
 def size_table_name(model_selector):
     """
     Returns canonical name of injected destination desired_size table
@@ -78,13 +63,15 @@ def size_table_name(model_selector):
 
 class ShadowPriceCalculator(object):
 
-    def __init__(self, model_settings, num_processes, shared_data=None, shared_data_lock=None):
+    def __init__(self, model_settings, num_processes, shared_data=None, shared_data_lock=None,
+                 shared_data_barrier=None):
         """
 
         Presence of shared_data is used as a flag for multiprocessing
         If we are multiprocessing, shared_data should be a multiprocessing.RawArray buffer
-        to aggregate modeled_size across all sub-processes, and shared_data_lock should be
-        a multiprocessing.Lock object to coordinate access to that buffer.
+        to aggregate modeled_size across all sub-processes, shared_data_lock should be
+        a multiprocessing.Lock object to coordinate access to that buffer, and shared_data_barrier
+        should be a multiprocessing.Barrier shared by all sub-processes to synchronize them.
 
         Optionally load saved shadow_prices from data_dir if config setting use_shadow_pricing
         and shadow_setting LOAD_SAVED_SHADOW_PRICES are both True
@@ -94,6 +81,7 @@ class ShadowPriceCalculator(object):
         model_settings : dict
         shared_data : multiprocessing.Array or None (if single process)
         shared_data_lock : numpy array wrapping multiprocessing.RawArray or None (if single process)
+        shared_data_barrier : multiprocessing.Barrier or None (if single process)
         """
 
         self.num_processes = num_processes
@@ -132,10 +120,12 @@ class ShadowPriceCalculator(object):
         # - shared_data
         if shared_data is not None:
             assert shared_data.shape[0] == self.desired_size.shape[0]
-            assert shared_data.shape[1] == self.desired_size.shape[1] + 1  # tally column
+            assert shared_data.shape[1] == self.desired_size.shape[1]
             assert shared_data_lock is not None
+            assert shared_data_barrier is not None or self.num_processes == 1
         self.shared_data = shared_data
         self.shared_data_lock = shared_data_lock
+        self.shared_data_barrier = shared_data_barrier
 
         # - load saved shadow_prices (if available) and set max_iterations accordingly
         if self.use_shadow_pricing:
@@ -207,19 +197,19 @@ class ShadowPriceCalculator(object):
         Note that all access to self.shared_data has to be protected by acquiring shared_data_lock
 
         ShadowPriceCalculator.synchronize_choices coordinates access to the global aggregate
-        zone counts (local_modeled_size summed across all sub-processes).
+        zone counts (local_modeled_size summed across all sub-processes) using shared_data_barrier,
+        so processes block (rather than poll) until the others reach the same phase.
 
-        * All processes wait (in case we are iterating) until any stragglers from the previous
-          iteration have exited the building. (TALLY_CHECKOUT goes to zero)
+        * Processes add their local counts into the shared_data
 
-        * Processes then add their local counts into the shared_data and increment TALLY_CHECKIN
+        * All processes wait at the barrier until everybody has added their counts
 
-        * All processes wait until everybody has checked in (TALLY_CHECKIN == num_processes)
+        * Processes make local copy of shared_data
 
-        * Processes make local copy of shared_data and check out (increment TALLY_CHECKOUT)
+        * All processes wait at the barrier until everybody has made their copy, then the one
+          process the barrier selects zeros shared_data
 
-        * first_in process waits until all processes have checked out, then zeros shared_data
-          and clears semaphores
+        * All processes wait at the barrier until shared_data is zeroed (in case we are iterating)
 
         Parameters
         ----------
@@ -237,43 +227,24 @@ class ShadowPriceCalculator(object):
         assert self.shared_data is not None
         assert self.num_processes > 1
 
-        def get_tally(t):
-            with self.shared_data_lock:
-                return self.shared_data[t]
+        # - add local data from df to shared data buffer
+        with self.shared_data_lock:
+            self.shared_data += local_modeled_size.values
 
-        def wait(tally, target):
-            while get_tally(tally) != target:
-                time.sleep(1)
+        # - wait until everybody else has added their data
+        self.shared_data_barrier.wait()
 
-        # - nobody checks in until checkout clears
-        wait(TALLY_CHECKOUT, 0)
+        # - numpy array with sum of local_modeled_size.values from all processes
+        logger.info("copy shared_data")
+        global_modeled_size_array = self.shared_data.copy()
 
-        # - add local_modeled_size data, increment TALLY_CHECKIN
-        with self.shared_data_lock:
-            first_in = self.shared_data[TALLY_CHECKIN] == 0
-            # add local data from df to shared data buffer
-            # final column is used for tallys, hence the negative index
-            # Ellipsis expands : to fill available dims so [..., 0:-1] is the whole array except for the tallys
-            self.shared_data[..., 0:-1] += local_modeled_size.values
-            self.shared_data[TALLY_CHECKIN] += 1
+        # - wait until everybody else has made their copy, then barrier picks one process to clean tub
+        if self.shared_data_barrier.wait() == 0:
+            self.shared_data[:] = 0
+            logger.info("clearing shared_data")
 
-        # - wait until everybody else has checked in
-        wait(TALLY_CHECKIN, self.num_processes)
-
-        # - copy shared data, increment TALLY_CHECKIN
-        with self.shared_data_lock:
-            logger.info("copy shared_data")
-            # numpy array with sum of local_modeled_size.values from all processes
-            global_modeled_size_array = self.shared_data[..., 0:-1].copy()
-            self.shared_data[TALLY_CHECKOUT] += 1
-
-        # - first in waits until all other processes have checked out, and cleans tub
-        if first_in:
-            wait(TALLY_CHECKOUT, self.num_processes)
-            with self.shared_data_lock:
-                # zero shared_data, clear TALLY_CHECKIN, and TALLY_CHECKOUT semaphores
-                self.shared_data[:] = 0
-            logger.info("first_in clearing shared_data")
+        # - nobody adds data for next iteration until tub is clean
+        self.shared_data_barrier.wait()
 
         # convert summed numpy array data to conform to original dataframe
         global_modeled_size_df = \
@@ -632,14 +603,13 @@ def shadow_price_data_from_buffers(data_buffers, shadow_pricing_info, model_sele
     data_buffers : dict of {<model_selector> : <multiprocessing.Array>}
         multiprocessing.Array is simply a convenient way to bundle Array and Lock
         we extract the lock and wrap the RawArray in a numpy array for convenience in indexing
-        The shared data buffer has shape (<num_zones, <num_segments> + 1)
-        extra column is for reverse semaphores with TALLY_CHECKIN and TALLY_CHECKOUT
+        The shared data buffer has shape (<num_zones, <num_segments>)
     shadow_pricing_info : dict
         dict of useful info
            dtype: sp_dtype,
            block_shapes : OrderedDict({<model_selector>: <shape tuple>})
-           dict mapping model_selector to block shape (including extra column for semaphores)
-           e.g. {'school': (num_zones, num_segments + 1)
+           dict mapping model_selector to block shape
+           e.g. {'school': (num_zones, num_segments)
     model_selector : str
         location type model_selector (e.g. school or workplace)
 
@@ -671,8 +641,8 @@ def load_shadow_price_calculator(model_settings):
     """
     Initialize ShadowPriceCalculator for model_selector (e.g. school or workplace)
 
-    If multiprocessing, get the shared_data buffer to coordinate global_desired_size
-    calculation across sub-processes
+    If multiprocessing, get the shared_data buffer and sub_process_barrier to coordinate
+    global_desired_size calculation across sub-processes
 
     Parameters
     ----------
@@ -699,15 +669,19 @@ def load_shadow_price_calculator(model_settings):
         # - extract data buffer and reshape as numpy array
         data, lock = \
             shadow_price_data_from_buffers(data_buffers, shadow_pricing_info, model_selector)
+
+        # - barrier shared by sub-processes (injected by mp_tasks.mp_run_simulation)
+        barrier = inject.get_injectable('sub_process_barrier', None)
     else:
         assert num_processes == 1
         data = None  # ShadowPriceCalculator will allocate its own data
         lock = None
+        barrier = None
 
     # - ShadowPriceCalculator
     spc = ShadowPriceCalculator(
         model_settings,
-        num_processes, data, lock)
+        num_processes, data, lock, barrier)
 
     return spc
 
@@ -813,7 +787,7 @@ def get_shadow_pricing_info():
     """
     return dict with info about dtype and shapes of desired and modeled size tables
 
-    block shape is (num_zones, num_segments + 1)
+    block shape is (num_zones, num_segments)
 
 
     Returns
@@ -837,8 +811,7 @@ def get_shadow_pricing_info():
         sp_rows = len(land_use)
         sp_cols = len(size_terms[size_terms.model_selector == model_selector])
 
-        # extra tally column for TALLY_CHECKIN and TALLY_CHECKOUT semaphores
-        blocks[block_name(model_selector)] = (sp_rows, sp_cols + 1)
+        blocks[block_name(model_selector)] = (sp_rows, sp_cols)
 
     sp_dtype = np.int64
 
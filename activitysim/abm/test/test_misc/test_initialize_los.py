@@ -0,0 +1,87 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+import os
+import logging
+import pkg_resources
+
+import numpy as np
+import numpy.testing as npt
+
+from activitysim.core import inject
+from activitysim.core import los
+from activitysim.core import pathbuilder_cache
+
+from activitysim.abm.models import initialize_los
+
+
+def example_path(dirname):
+    resource = os.path.join('examples', dirname)
+    return pkg_resources.resource_filename('activitysim', resource)
+
+
+def setup_function():
+
+    configs_dir = [example_path('example_multiple_zone/configs_3_zone'), example_path('example_mtc/configs')]
+    inject.add_injectable('configs_dir', configs_dir)
+
+    data_dir = example_path('example_multiple_zone/data_3')
+    inject.add_injectable('data_dir', data_dir)
+
+    output_dir = os.path.join(os.path.dirname(__file__), 'output')
+    inject.add_injectable('output_dir', output_dir)
+
+
+def teardown_function(func):
+    inject.clear_cache()
+    inject.reinject_decorated_tables()
+
+
+def test_od_slices():
+
+    # contiguous slices covering all rows, with sizes differing by at most one
+    for num_od_rows, num_pieces in [(10, 1), (10, 3), (10, 4), (7, 7)]:
+        slices = initialize_los.od_slices(num_od_rows, num_pieces)
+        assert len(slices) == num_pieces
+        assert slices[0].start == 0 and slices[-1].stop == num_od_rows
+        assert all(s1.stop == s2.start for s1, s2 in zip(slices[:-1], slices[1:]))
+        sizes = [s.stop - s.start for s in slices]
+        assert max(sizes) - min(sizes) <= 1
+
+    # no empty slices if there are more pieces than rows
+    assert initialize_los.od_slices(3, 5) == [slice(0, 1), slice(1, 2), slice(2, 3)]
+
+
+def test_initialize_tvpb_processes(caplog):
+
+    def static_cache(num_processes):
+
+        inject.clear_cache()
+
+        network_los = los.Network_LOS()
+        network_los.los_settings['initialize_tvpb_processes'] = num_processes
+        network_los.los_settings['read_skim_cache'] = False
+        network_los.los_settings['write_skim_cache'] = False
+        network_los.load_data()
+
+        tap_cache = network_los.tvpb.tap_cache
+        tap_cache.cleanup()
+
+        # as initialize_los step would
+        attribute_combinations = network_los.tvpb.uid_calculator.scalar_attribute_combinations()
+        inject.add_table('attribute_combinations', attribute_combinations, replace=True)
+
+        initialize_los.initialize_tvpb(network_los, inject.get_table('attribute_combinations'), chunk_size=0)
+
+        data = np.fromfile(tap_cache.cache_path, dtype=pathbuilder_cache.DTYPE_NAME)
+        tap_cache.cleanup()
+
+        return data
+
+    serial_data = static_cache(num_processes=1)
+    assert not np.isnan(serial_data).any()
+
+    with caplog.at_level(logging.INFO):
+        concurrent_data = static_cache(num_processes=2)
+    assert "with 2 worker processes" in caplog.text
+
+    npt.assert_array_equal(concurrent_data, serial_data)
@@ -0,0 +1,109 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+import multiprocessing
+import threading
+
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+
+from activitysim.abm.tables import shadow_pricing
+
+NUM_PROCESSES = 2
+NUM_ITERATIONS = 3
+
+SHADOW_PRICING_INFO = {
+    'dtype': np.int64,
+    'block_shapes': {'school': (4, 2)},
+}
+
+
+def local_modeled_size(process_num, iteration):
+    data = np.arange(8).reshape(4, 2) * (process_num + 1) + iteration
+    return pd.DataFrame(data, index=[10, 11, 12, 13], columns=['university', 'highschool'])
+
+
+def shadow_price_calculator(data_buffers, barrier):
+    # bypass __init__, which needs size tables and settings, since we only synchronize_choices
+    spc = shadow_pricing.ShadowPriceCalculator.__new__(shadow_pricing.ShadowPriceCalculator)
+    spc.num_processes = NUM_PROCESSES
+    spc.shared_data, spc.shared_data_lock = \
+        shadow_pricing.shadow_price_data_from_buffers(data_buffers, SHADOW_PRICING_INFO, 'school')
+    spc.shared_data_barrier = barrier
+    return spc
+
+
+def synchronize_choices_worker(process_num, data_buffers, barrier, conn, fail=False):
+
+    if fail:
+        raise RuntimeError(f"process {process_num} failed")
+
+    spc = shadow_price_calculator(data_buffers, barrier)
+    try:
+        for iteration in range(NUM_ITERATIONS):
+            conn.send(spc.synchronize_choices(local_modeled_size(process_num, iteration)))
+    except threading.BrokenBarrierError as e:
+        conn.send(type(e).__name__)
+
+
+def run_workers(fail_process_num=None):
+
+    data_buffers = shadow_pricing.buffers_for_shadow_pricing(SHADOW_PRICING_INFO)
+    barrier = multiprocessing.Barrier(NUM_PROCESSES)
+
+    readers = []
+    procs = []
+    for process_num in range(NUM_PROCESSES):
+        reader, conn = multiprocessing.Pipe(duplex=False)
+        p = multiprocessing.Process(target=synchronize_choices_worker,
+                                    args=(process_num, data_buffers, barrier, conn,
+                                          process_num == fail_process_num))
+        p.start()
+        conn.close()
+        readers.append(reader)
+        procs.append(p)
+
+    if fail_process_num is not None:
+        # as mp_tasks.run_sub_simulations does when a sub process fails
+        procs[fail_process_num].join(timeout=60)
+        assert procs[fail_process_num].exitcode != 0
+        barrier.abort()
+
+    results = []
+    for reader in readers:
+        messages = []
+        while True:
+            try:
+                messages.append(reader.recv())
+            except EOFError:
+                break
+        results.append(messages)
+
+    for p in procs:
+        p.join(timeout=60)
+        assert p.exitcode is not None
+
+    shared_data, _ = shadow_pricing.shadow_price_data_from_buffers(data_buffers, SHADOW_PRICING_INFO, 'school')
+
+    return results, shared_data
+
+
+def test_synchronize_choices():
+
+    results, shared_data = run_workers()
+
+    for iteration in range(NUM_ITERATIONS):
+        expected = sum(local_modeled_size(process_num, iteration) for process_num in range(NUM_PROCESSES))
+        for process_num in range(NUM_PROCESSES):
+            pdt.assert_frame_equal(results[process_num][iteration], expected)
+
+    # shared tub is cleaned after each iteration
+    assert not shared_data.any()
+
+
+def test_synchronize_choices_failed_peer():
+
+    results, _ = run_workers(fail_process_num=0)
+
+    # failed process sent nothing and its peer was not left waiting for it at the barrier
+    assert results == [[], ['BrokenBarrierError']]
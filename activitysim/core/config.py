@@ -54,7 +54,8 @@ def output_file_prefix():
 @inject.injectable(cache=True)
 def pipeline_file_name(settings):
 
-    pipeline_file_name = settings.get('pipeline_file_name', 'pipeline.h5')
+    default_file_name = 'pipeline.parquet' if settings.get('pipeline_store_format') == 'parquet' else 'pipeline.h5'
+    pipeline_file_name = settings.get('pipeline_file_name', default_file_name)
 
     return pipeline_file_name
 
@@ -131,9 +131,14 @@ def remove_injectable(name):
     orca._INJECTABLES.pop(name, None)
 
 
-def reinject_decorated_tables():
+def reinject_decorated_tables(injectables=True):
     """
     reinject the decorated tables (and columns)
+
+    Parameters
+    ----------
+    injectables : bool
+        also reinject the decorated injectables (discarding cached and overridden values)
     """
 
     logger.info("reinject_decorated_tables")
@@ -153,6 +158,9 @@ def reinject_decorated_tables():
         logger.debug("reinject decorated column %s.%s" % (table_name, column_name))
         orca.add_column(table_name, column_name, args['func'], cache=args['cache'])
 
+    if not injectables:
+        return
+
     for name, args in _DECORATED_INJECTABLES.items():
         logger.debug("reinject decorated injectable %s" % name)
         orca.add_injectable(name, args['func'], cache=args['cache'])
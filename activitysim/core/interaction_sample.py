@@ -5,6 +5,7 @@ from builtins import range
 import logging
 
 from math import ceil
+import numba
 import numpy as np
 import pandas as pd
 
@@ -22,6 +23,73 @@ logger = logging.getLogger(__name__)
 DUMP = False
 
 
+@numba.njit(nogil=True)
+def _sample_positions(probs, rands):
+    """
+    For each chooser (row) and each of that chooser's rands, find the position of the first
+    alternative whose cumulative probability is greater than the rand (the same position as
+    np.argmax(probs.cumsum(axis=1) > rand, axis=1), including 0 if there is no such alternative)
+
+    The chooser's rands are visited in sorted order so a single sweep over the row accumulates
+    the cumulative probabilities (in float64, even for float32 probs) without allocating them.
+    """
+    num_choosers, num_alts = probs.shape
+    sample_size = rands.shape[1]
+
+    positions = np.zeros((num_choosers, sample_size), dtype=np.int64)
+
+    for i in range(num_choosers):
+        j = 0
+        cum_prob = 0.0
+        if num_alts > 0:
+            cum_prob += probs[i, 0]
+        for k in np.argsort(rands[i]):
+            r = rands[i, k]
+            while j < num_alts and not cum_prob > r:
+                j += 1
+                if j < num_alts:
+                    cum_prob += probs[i, j]
+            if j < num_alts:
+                positions[i, k] = j
+
+    return positions
+
+
+def count_picks(positions):
+    """
+    Count duplicate picks in each row of positions
+
+    Parameters
+    ----------
+    positions : 2-D ndarray
+        one row per chooser and one column per sample pick
+
+    Returns
+    -------
+    pick_count : 2-D ndarray same shape as positions
+        number of times the position was picked in its row
+    first_pick : 2-D bool ndarray same shape as positions
+        True for the first (leftmost) pick of each distinct position in its row
+    """
+
+    # stable sort so first pick in sorted order is the leftmost
+    order = np.argsort(positions, axis=1, kind='stable')
+    sorted_positions = np.take_along_axis(positions, order, axis=1)
+
+    # run-length encode the sorted rows
+    run_start = np.ones(sorted_positions.shape, dtype=bool)
+    run_start[:, 1:] = sorted_positions[:, 1:] != sorted_positions[:, :-1]
+    run_id = np.cumsum(run_start.ravel()) - 1
+    run_count = np.bincount(run_id)[run_id].reshape(sorted_positions.shape)
+
+    pick_count = np.empty_like(run_count)
+    np.put_along_axis(pick_count, order, run_count, axis=1)
+    first_pick = np.empty_like(run_start)
+    np.put_along_axis(first_pick, order, run_start, axis=1)
+
+    return pick_count, first_pick
+
+
 def make_sample_choices(
         choosers, probs,
         alternatives,
@@ -45,7 +113,9 @@ def make_sample_choices(
 
     Returns
     -------
-
+    choices_df : pandas.DataFrame
+        one row per distinct (chooser, alternative) pick, in order of first pick,
+        with columns alt_col_name, 'rand', 'prob', choosers.index.name and 'pick_count'
     """
 
     assert isinstance(probs, pd.DataFrame)
@@ -57,98 +127,45 @@ def make_sample_choices(
     if allow_zero_probs:
         zero_probs = (probs.sum(axis=1) == 0)
         if zero_probs.all():
-            return pd.DataFrame(columns=[alt_col_name, 'rand', 'prob', choosers.index.name])
+            return pd.DataFrame(columns=[alt_col_name, 'rand', 'prob', choosers.index.name, 'pick_count'])
         if zero_probs.any():
             # remove from sample
             probs = probs[~zero_probs]
             choosers = choosers[~zero_probs]
 
-    cum_probs_array = probs.values.cumsum(axis=1)
-    chunk.log_df(trace_label, 'cum_probs_array', cum_probs_array)
-
-    # alt probs in convenient layout to return prob of chose alternative
-    # (same layout as cum_probs_arr)
-    alt_probs_array = probs.values.flatten()
-    chunk.log_df(trace_label, 'alt_probs_array', alt_probs_array)
-
     # get sample_size rands for each chooser
     rands = pipeline.get_rn_generator().random_for_df(probs, n=sample_size)
-
-    # transform as we iterate over alternatives
-    # reshape so rands[i] is in broadcastable (2-D) shape for cum_probs_arr
-    # i.e rands[i] is a 2-D array of one alt choice rand for each chooser
-    rands = rands.T.reshape(sample_size, -1, 1)
     chunk.log_df(trace_label, 'rands', rands)
 
-    # the alternative value chosen
-    # WHY SHOULD CHOICES COL HAVE TO BE TYPE INT???
-    # choices_array = np.empty([sample_size, len(choosers)]).astype(int)
-    choices_array = np.empty([sample_size, len(choosers)]).astype(alternatives.index.dtype)
-    # chunk log these later after we populate them...
-
-    # the probability of the chosen alternative
-    choice_probs_array = np.empty([sample_size, len(choosers)])
-    # chunk log these later after we populate them...
+    # positions of chosen alternatives (column index in probs) with one row per chooser and one col per pick
+    positions = _sample_positions(probs.values, rands)
+    chunk.log_df(trace_label, 'positions', positions)
 
-    alts = np.tile(alternatives.index.values, len(choosers))
-    chunk.log_df(trace_label, 'alts', alts)
+    pick_count, first_pick = count_picks(positions)
+    chunk.log_df(trace_label, 'pick_count', pick_count)
 
-    # FIXME - do this all at once rather than iterate?
-    for i in range(sample_size):
+    # drop the duplicate picks (flattened in chooser-major order)
+    first_pick = first_pick.ravel()
+    chooser_offsets = np.repeat(np.arange(len(choosers)), sample_size)[first_pick]
+    positions = positions.ravel()[first_pick]
 
-        # FIXME - do this in numpy, not pandas?
-
-        # rands for this alt in broadcastable shape
-        r = rands[i]
-
-        # position of first occurrence of positive value
-        positions = np.argmax(cum_probs_array > r, axis=1)
-
-        # FIXME - leave positions as numpy array, not pandas series?
-        # positions is series with the chosen alternative represented as a column index in probs
-        # which is an integer between zero and num alternatives in the alternative sample
-        positions = pd.Series(positions, index=probs.index)
-
-        # need to get from an integer offset into the alternative sample to the alternative index
-        # that is, we want the index value of the row that is offset by <position> rows into the
-        # tranche of this choosers alternatives created by cross join of alternatives and choosers
-
-        # offsets is the offset into model_design df of first row of chooser alternatives
-        offsets = np.arange(len(positions)) * alternative_count
-
-        # choices and choice_probs have one element per chooser and is in same order as choosers
-        choices_array[i] = np.take(alts, positions + offsets)
-        choice_probs_array[i] = np.take(alt_probs_array, positions + offsets)
-
-        del positions
-        del offsets
-
-    chunk.log_df(trace_label, 'choices_array', choices_array)
-    chunk.log_df(trace_label, 'choice_probs_array', choice_probs_array)
-
-    del alts
-    chunk.log_df(trace_label, 'alts', None)
-    del cum_probs_array
-    chunk.log_df(trace_label, 'cum_probs_array', None)
-    del alt_probs_array
-    chunk.log_df(trace_label, 'alt_probs_array', None)
-
-    # explode to one row per chooser.index, alt_zone_id
+    # one row per chooser.index, alt_zone_id
     choices_df = pd.DataFrame(
-        {alt_col_name: choices_array.flatten(order='F'),
-         'rand': rands.flatten(order='F'),
-         'prob': choice_probs_array.flatten(order='F'),
-         choosers.index.name: np.repeat(np.asanyarray(choosers.index), sample_size)
+        {alt_col_name: alternatives.index.values[positions],
+         'rand': rands.ravel()[first_pick],
+         'prob': probs.values[chooser_offsets, positions],
+         choosers.index.name: np.asanyarray(choosers.index)[chooser_offsets],
+         'pick_count': pick_count.ravel()[first_pick],
          })
 
     chunk.log_df(trace_label, 'choices_df', choices_df)
 
-    del choices_array
-    chunk.log_df(trace_label, 'choices_array', None)
+    del positions
+    chunk.log_df(trace_label, 'positions', None)
+    del pick_count
+    chunk.log_df(trace_label, 'pick_count', None)
     del rands
     chunk.log_df(trace_label, 'rands', None)
-    del choice_probs_array
-    chunk.log_df(trace_label, 'choice_probs_array', None)
 
     # handing this off to caller
     chunk.log_df(trace_label, 'choices_df', None)
@@ -238,69 +255,88 @@ def _interaction_sample(
         alternatives = alternatives.copy()
         alternatives[alternatives.index.name] = alternatives.index
 
-    chooser_index_id = interaction_simulate.ALT_CHOOSER_ID if log_alt_losers else None
-
-    # - cross join choosers and alternatives (cartesian product)
-    # for every chooser, there will be a row for each alternative
-    # index values (non-unique) are from alternatives df
     alternative_count = alternatives.shape[0]
-    interaction_df = \
-        logit.interaction_dataset(choosers, alternatives, sample_size=alternative_count,
-                                  chooser_index_id=chooser_index_id)
 
-    chunk.log_df(trace_label, 'interaction_df', interaction_df)
-
-    assert alternative_count == len(interaction_df.index) / len(choosers.index)
+    # tracing and log_alt_losers need the expression values of every interaction_dataset row
+    if have_trace_targets or log_alt_losers:
+        terms = None
+    else:
+        terms = interaction_simulate.interaction_terms(spec, choosers, alternatives, skims, locals_d)
 
-    if skims is not None:
-        set_skim_wrapper_targets(interaction_df, skims)
+    if terms is not None:
 
-    # evaluate expressions from the spec multiply by coefficients and sum
-    # spec is df with one row per spec expression and one col with utility coefficient
-    # column names of interaction_df match spec index values
-    # utilities has utility value for element in the cross product of choosers and alternatives
-    # interaction_utilities is a df with one utility column and one row per row in interaction_df
-    if have_trace_targets:
-        trace_rows, trace_ids \
-            = tracing.interaction_trace_rows(interaction_df, choosers, alternative_count)
+        # evaluate chooser and alternative terms on choosers and alternatives, rather than on their cross join
+        # (every chooser has every alternative, so there is no sample)
+        utilities = pd.DataFrame(
+            interaction_simulate.eval_interaction_terms(terms, choosers, alternatives, None, alternative_count,
+                                                        skims, locals_d, trace_label),
+            index=choosers.index)
+        chunk.log_df(trace_label, 'utilities', utilities)
 
-        tracing.trace_df(interaction_df[trace_rows],
-                         tracing.extend_trace_label(trace_label, 'interaction_df'),
-                         slicer='NONE', transpose=False)
     else:
-        trace_rows = trace_ids = None
 
-    # interaction_utilities is a df with one utility column and one row per interaction_df row
-    interaction_utilities, trace_eval_results \
-        = interaction_simulate.eval_interaction_utilities(spec, interaction_df, locals_d, trace_label, trace_rows,
-                                                          estimator=None,
-                                                          log_alt_losers=log_alt_losers)
-    chunk.log_df(trace_label, 'interaction_utilities', interaction_utilities)
+        chooser_index_id = interaction_simulate.ALT_CHOOSER_ID if log_alt_losers else None
 
-    # ########### HWM - high water mark (point of max observed memory usage)
+        # - cross join choosers and alternatives (cartesian product)
+        # for every chooser, there will be a row for each alternative
+        # index values (non-unique) are from alternatives df
+        interaction_df = \
+            logit.interaction_dataset(choosers, alternatives, sample_size=alternative_count,
+                                      chooser_index_id=chooser_index_id)
 
-    del interaction_df
-    chunk.log_df(trace_label, 'interaction_df', None)
+        chunk.log_df(trace_label, 'interaction_df', interaction_df)
 
-    if have_trace_targets:
-        tracing.trace_interaction_eval_results(trace_eval_results, trace_ids,
-                                               tracing.extend_trace_label(trace_label, 'eval'))
+        assert alternative_count == len(interaction_df.index) / len(choosers.index)
 
-        tracing.trace_df(interaction_utilities[trace_rows],
-                         tracing.extend_trace_label(trace_label, 'interaction_utilities'),
-                         slicer='NONE', transpose=False)
+        if skims is not None:
+            set_skim_wrapper_targets(interaction_df, skims)
+
+        # evaluate expressions from the spec multiply by coefficients and sum
+        # spec is df with one row per spec expression and one col with utility coefficient
+        # column names of interaction_df match spec index values
+        # utilities has utility value for element in the cross product of choosers and alternatives
+        # interaction_utilities is a df with one utility column and one row per row in interaction_df
+        if have_trace_targets:
+            trace_rows, trace_ids \
+                = tracing.interaction_trace_rows(interaction_df, choosers, alternative_count)
+
+            tracing.trace_df(interaction_df[trace_rows],
+                             tracing.extend_trace_label(trace_label, 'interaction_df'),
+                             slicer='NONE', transpose=False)
+        else:
+            trace_rows = trace_ids = None
+
+        # interaction_utilities is a df with one utility column and one row per interaction_df row
+        interaction_utilities, trace_eval_results \
+            = interaction_simulate.eval_interaction_utilities(spec, interaction_df, locals_d, trace_label, trace_rows,
+                                                              estimator=None,
+                                                              log_alt_losers=log_alt_losers)
+        chunk.log_df(trace_label, 'interaction_utilities', interaction_utilities)
+
+        # ########### HWM - high water mark (point of max observed memory usage)
 
-    tracing.dump_df(DUMP, interaction_utilities, trace_label, 'interaction_utilities')
+        del interaction_df
+        chunk.log_df(trace_label, 'interaction_df', None)
 
-    # reshape utilities (one utility column and one row per row in interaction_utilities)
-    # to a dataframe with one row per chooser and one column per alternative
-    utilities = pd.DataFrame(
-        interaction_utilities.values.reshape(len(choosers), alternative_count),
-        index=choosers.index)
-    chunk.log_df(trace_label, 'utilities', utilities)
+        if have_trace_targets:
+            tracing.trace_interaction_eval_results(trace_eval_results, trace_ids,
+                                                   tracing.extend_trace_label(trace_label, 'eval'))
 
-    del interaction_utilities
-    chunk.log_df(trace_label, 'interaction_utilities', None)
+            tracing.trace_df(interaction_utilities[trace_rows],
+                             tracing.extend_trace_label(trace_label, 'interaction_utilities'),
+                             slicer='NONE', transpose=False)
+
+        tracing.dump_df(DUMP, interaction_utilities, trace_label, 'interaction_utilities')
+
+        # reshape utilities (one utility column and one row per row in interaction_utilities)
+        # to a dataframe with one row per chooser and one column per alternative
+        utilities = pd.DataFrame(
+            interaction_utilities.values.reshape(len(choosers), alternative_count),
+            index=choosers.index)
+        chunk.log_df(trace_label, 'utilities', utilities)
+
+        del interaction_utilities
+        chunk.log_df(trace_label, 'interaction_utilities', None)
 
     if have_trace_targets:
         tracing.trace_df(utilities, tracing.extend_trace_label(trace_label, 'utils'),
@@ -310,12 +346,14 @@ def _interaction_sample(
 
     # convert to probabilities (utilities exponentiated and normalized to probs)
     # probs is same shape as utilities, one row per chooser and one column for alternative
+    # (computed in place in the utilities buffer to avoid a second choosers x alternatives array)
     probs = logit.utils_to_probs(utilities, allow_zero_probs=allow_zero_probs,
-                                 trace_label=trace_label, trace_choosers=choosers)
-    chunk.log_df(trace_label, 'probs', probs)
+                                 trace_label=trace_label, trace_choosers=choosers,
+                                 overwrite_utils=True)
 
     del utilities
     chunk.log_df(trace_label, 'utilities', None)
+    chunk.log_df(trace_label, 'probs', probs)
 
     if have_trace_targets:
         tracing.trace_df(probs, tracing.extend_trace_label(trace_label, 'probs'),
@@ -349,24 +387,7 @@ def _interaction_sample(
     del probs
     chunk.log_df(trace_label, 'probs', None)
 
-    # pick_count and pick_dup
-    # pick_count is number of duplicate picks
-    # pick_dup flag is True for all but first of duplicates
-    pick_group = choices_df.groupby([choosers.index.name, alt_col_name])
-
-    # number each item in each group from 0 to the length of that group - 1.
-    choices_df['pick_count'] = pick_group.cumcount(ascending=True)
-    # flag duplicate rows after first
-    choices_df['pick_dup'] = choices_df['pick_count'] > 0
-    # add reverse cumcount to get total pick_count (conveniently faster than groupby.count + merge)
-    choices_df['pick_count'] += pick_group.cumcount(ascending=False) + 1
-
-    # drop the duplicates
-    choices_df = choices_df[~choices_df['pick_dup']]
-    del choices_df['pick_dup']
-    chunk.log_df(trace_label, 'choices_df', choices_df)
-
-    # set index after groupby so we can trace on it
+    # set index so we can trace on it
     choices_df.set_index(choosers.index.name, inplace=True)
 
     tracing.dump_df(DUMP, choices_df, trace_label, 'choices_df')
@@ -2,6 +2,7 @@
 # See full license in LICENSE.txt.
 from builtins import zip
 
+import ast
 import logging
 
 import numpy as np
@@ -95,7 +96,8 @@ def eval_interaction_utilities(spec, df, locals_d, trace_label, trace_rows, esti
         # need to be able to identify which variables causes an error, which keeps
         # this from being expressed more parsimoniously
 
-        utilities = pd.DataFrame({'utility': 0.0}, index=df.index)
+        # accumulate partial utilities in an ndarray (chooser-major, so it can be reshaped to choosers x alts)
+        utilities = np.zeros(len(df.index))
 
         chunk.log_df(trace_label, 'eval.utilities', utilities)
 
@@ -134,8 +136,8 @@ def eval_interaction_utilities(spec, df, locals_d, trace_label, trace_rows, esti
                 if expr.startswith('_'):
 
                     target = expr[:expr.index('@')]
-                    rhs = expr[expr.index('@') + 1:]
-                    v = to_series(eval(rhs, globals(), locals_d))
+                    rhs = expr[expr.index('@'):]
+                    v = to_series(simulate.eval_expression(rhs, df, globals(), locals_d))
 
                     # update locals to allows us to ref previously assigned targets
                     locals_d[target] = v
@@ -148,10 +150,7 @@ def eval_interaction_utilities(spec, df, locals_d, trace_label, trace_rows, esti
                     # they have a non-zero dummy coefficient to avoid being removed from spec as NOPs
                     continue
 
-                if expr.startswith('@'):
-                    v = to_series(eval(expr[1:], globals(), locals_d))
-                else:
-                    v = df.eval(expr)
+                v = to_series(simulate.eval_expression(expr, df, globals(), locals_d))
 
                 if check_for_variability and v.std() == 0:
                     logger.info("%s: no variability (%s) in: %s" % (trace_label, v.iloc[0], expr))
@@ -187,7 +186,7 @@ def eval_interaction_utilities(spec, df, locals_d, trace_label, trace_rows, esti
 
                     del max_utils_by_chooser
 
-                utilities.utility += utility
+                utilities += utility.values
 
                 if trace_eval_results is not None:
 
@@ -212,6 +211,9 @@ def eval_interaction_utilities(spec, df, locals_d, trace_label, trace_rows, esti
             estimator.write_interaction_expression_values(expression_values_df)
             del expression_values_df
 
+        utilities = pd.DataFrame({'utility': utilities}, index=df.index)
+        chunk.log_df(trace_label, 'eval.utilities', utilities)
+
         if no_variability > 0:
             logger.warning("%s: %s columns have no variability" % (trace_label, no_variability))
 
@@ -235,6 +237,334 @@ def eval_interaction_utilities(spec, df, locals_d, trace_label, trace_rows, esti
     return utilities, trace_eval_results
 
 
+# attributes naming the df columns that skim wrappers (and other set_df targets) look up
+SKIM_KEY_ATTRIBUTES = ['orig_key', 'dest_key', 'dim3_key', 'tod_key', 'segment_key']
+
+_EXPRESSION_COLUMNS = {}
+
+
+def expression_columns(expr):
+    """
+    Names of the interaction dataset columns referenced by a spec expression (or None if not known)
+
+    Simple expressions reference columns by name. '@' expressions must only access df columns
+    with df.<column> or df['<column>'] - any other use of df (e.g. df.eval, df.size or passing df
+    to a function) might depend on any (or every) column.
+
+    Parameters
+    ----------
+    expr : str
+        spec expression (or the rhs of a temp expression)
+
+    Returns
+    -------
+    referenced : tuple or None
+        (columns, names) or None if the referenced df columns can't be determined
+        columns: tuple of names of the referenced df columns
+        names: tuple of other names referenced by '@' expressions (locals, temps, functions, modules)
+    """
+
+    referenced = _EXPRESSION_COLUMNS.get(expr, False)
+
+    if referenced is False:
+
+        referenced = None
+
+        if not expr.startswith('@'):
+            _, _, names = simulate.compile_expression(expr)
+            if names:
+                referenced = (names, ())
+        else:
+            try:
+                tree = ast.parse(expr[1:].strip(), mode='eval')
+            except SyntaxError:
+                tree = None
+
+            if tree is not None:
+                nodes = list(ast.walk(tree))
+                columns = set()
+                column_df_nodes = set()
+                for node in nodes:
+                    value = getattr(node, 'value', None)
+                    if not (isinstance(value, ast.Name) and value.id == 'df'):
+                        continue
+                    if isinstance(node, ast.Attribute) and not hasattr(pd.DataFrame, node.attr):
+                        # (df.size is the DataFrame attribute, not the size column)
+                        columns.add(node.attr)
+                        column_df_nodes.add(id(value))
+                    elif isinstance(node, ast.Subscript):
+                        # python < 3.9 wraps subscripts in ast.Index
+                        key = node.slice.value if isinstance(node.slice, getattr(ast, 'Index', ())) else node.slice
+                        if isinstance(key, ast.Constant) and isinstance(key.value, str):
+                            columns.add(key.value)
+                            column_df_nodes.add(id(value))
+
+                names = {node.id for node in nodes if isinstance(node, ast.Name)}
+
+                if not any(isinstance(node, ast.Name) and node.id == 'df' and id(node) not in column_df_nodes
+                           for node in nodes):
+                    referenced = (tuple(sorted(columns)), tuple(sorted(names - {'df'})))
+
+        _EXPRESSION_COLUMNS[expr] = referenced
+
+    return referenced
+
+
+def interaction_columns(choosers, alternatives):
+    """
+    The columns logit.interaction_dataset(choosers, alternatives) would have and where they come from
+
+    Returns
+    -------
+    columns : dict
+        {<interaction dataset column name>: ('choosers' or 'alternatives', <column name in source table>)}
+    """
+
+    columns = {c: ('alternatives', c) for c in alternatives.columns}
+
+    # interaction_dataset renames chooser columns that it already has
+    for c in choosers.columns:
+        c_chooser = (c + '_chooser') if c in columns else c
+        columns[c_chooser] = ('choosers', c)
+
+    return columns
+
+
+def interaction_terms(spec, choosers, alternatives, skims=None, locals_d=None):
+    """
+    Determine whether each spec expression can be evaluated on choosers, on alternatives, or must be
+    evaluated on the (chooser, alternative) interaction of the two.
+
+    Expressions that only reference chooser columns (or only alternative columns) are 'choosers'
+    (or 'alternatives') terms. Expressions that reference columns from both, temps, or skims are
+    'interaction' terms. (Spec expressions are assumed to be row-wise, as the choice models require.)
+
+    Parameters
+    ----------
+    spec : pandas.DataFrame
+        one row per spec expression and one col with utility coefficient
+    choosers : pandas.DataFrame
+    alternatives : pandas.DataFrame
+    skims : SkimWrapper, or a list or dict of skims (optional)
+    locals_d : dict (optional)
+
+    Returns
+    -------
+    terms : list of tuples or None
+        (expr, coefficient, source, columns) for each spec expression in order,
+        or None if the interaction dataset column references of any expression can't be determined
+    """
+
+    columns = interaction_columns(choosers, alternatives)
+
+    skims = [] if skims is None \
+        else skims if isinstance(skims, list) \
+        else list(skims.values()) if isinstance(skims, dict) \
+        else [skims]
+    skim_ids = {id(skim) for skim in skims}
+
+    def is_skim(obj):
+        if isinstance(obj, dict):
+            return any(is_skim(o) for o in obj.values())
+        return id(obj) in skim_ids or hasattr(obj, 'set_df')
+
+    interaction_names = {name for name, obj in (locals_d or {}).items() if is_skim(obj)}
+
+    if isinstance(spec.index, pd.MultiIndex):
+        exprs = spec.index.get_level_values(simulate.SPEC_EXPRESSION_NAME)
+    else:
+        exprs = spec.index
+
+    terms = []
+    for expr, coefficient in zip(exprs, spec.iloc[:, 0]):
+
+        if expr.startswith('_'):
+            # temps of form _od_DIST@od_skim['DIST'] are evaluated on the interaction dataset
+            target = expr[:expr.index('@')]
+            referenced = expression_columns(expr[expr.index('@'):])
+            interaction_names.add(target)
+        else:
+            referenced = expression_columns(expr)
+
+        if referenced is None or any(c not in columns for c in referenced[0]):
+            return None
+
+        expr_columns, names = referenced
+        sources = {columns[c][0] for c in expr_columns}
+
+        if expr.startswith('_') or interaction_names.intersection(names) or len(sources) > 1:
+            source = 'interaction'
+        else:
+            source = sources.pop() if sources else 'choosers'
+
+        terms.append((expr, coefficient, source, expr_columns))
+
+    return terms
+
+
+def eval_interaction_terms(terms, choosers, alternatives, sample, sample_size,
+                           skims, locals_d, trace_label):
+    """
+    Compute the utilities of the (chooser, alternative) pairs of logit.interaction_dataset
+    without building it.
+
+    'choosers' terms are evaluated once per chooser and 'alternatives' terms once per alternative,
+    and their partial utilities are broadcast straight into the (choosers, alternatives) utilities.
+    Only interaction terms are evaluated on the (chooser, alternative) pairs, in a dataframe with just
+    the columns they (and the skims) reference.
+
+    Parameters
+    ----------
+    terms : list of tuples
+        from interaction_terms
+    choosers : pandas.DataFrame
+    alternatives : pandas.DataFrame
+    sample : 1-D ndarray of int or None
+        positions in alternatives of each chooser's alternatives from logit.interaction_dataset_sample
+        (or None if every chooser has every alternative, in order)
+    sample_size : int
+        number of alternatives per chooser
+    skims : SkimWrapper, or a list or dict of skims (optional)
+    locals_d : dict (optional)
+    trace_label : str
+
+    Returns
+    -------
+    utilities : 2-D ndarray
+        one row per chooser and one column per sampled alternative
+    """
+
+    trace_label = tracing.extend_trace_label(trace_label, "eval_interaction_terms")
+
+    num_choosers = len(choosers)
+    logger.info("Running eval_interaction_terms on %s choosers and %s alternatives"
+                % (num_choosers, sample_size))
+
+    with chunk.chunk_log(trace_label):
+
+        # avoid altering caller's passed-in locals_d parameter (they may be looping)
+        locals_d = locals_d.copy() if locals_d is not None else {}
+
+        columns = interaction_columns(choosers, alternatives)
+
+        def source_columns(source):
+            return sorted({c for _, _, s, expr_columns in terms if s == source for c in expr_columns})
+
+        frames = {
+            'choosers':
+                pd.DataFrame({c: choosers[columns[c][1]] for c in source_columns('choosers')},
+                             index=choosers.index),
+            'alternatives':
+                pd.DataFrame({c: alternatives[columns[c][1]] for c in source_columns('alternatives')},
+                             index=alternatives.index),
+        }
+
+        if any(source == 'interaction' for _, _, source, _ in terms):
+
+            # narrow interaction dataset with only the columns that interaction terms (and skims) need
+            interaction_columns_needed = set(source_columns('interaction'))
+            for skim in (skims.values() if isinstance(skims, dict) else skims if isinstance(skims, list)
+                         else [skims] if skims is not None else []):
+                for key_attribute in SKIM_KEY_ATTRIBUTES:
+                    key = getattr(skim, key_attribute, None)
+                    if isinstance(key, str) and key in columns:
+                        interaction_columns_needed.add(key)
+
+            if sample is None:
+                sample = np.tile(np.arange(len(alternatives)), num_choosers)
+
+            interaction_df = pd.DataFrame(index=alternatives.index.take(sample))
+            for c in sorted(interaction_columns_needed):
+                source, column = columns[c]
+                if source == 'alternatives':
+                    interaction_df[c] = alternatives[column].values.take(sample)
+                else:
+                    interaction_df[c] = np.repeat(choosers[column].values, sample_size)
+            chunk.log_df(trace_label, 'interaction_df', interaction_df)
+
+            if skims is not None:
+                simulate.set_skim_wrapper_targets(interaction_df, skims)
+
+            frames['interaction'] = interaction_df
+
+        # alternatives are not sampled if every chooser has all of them, in order
+        sampled = sample_size < len(alternatives)
+        assert sampled or sample_size == len(alternatives)
+
+        check_for_variability = config.setting('check_for_variability')
+
+        utilities = np.zeros((num_choosers, sample_size))
+        chunk.log_df(trace_label, 'eval.utilities', utilities)
+
+        no_variability = has_missing_vals = 0
+
+        for expr, coefficient, source, _ in terms:
+            try:
+                df = frames[source]
+
+                # add df for startswith('@') eval expressions
+                locals_d['df'] = df
+
+                def to_series(x):
+                    if np.isscalar(x):
+                        return pd.Series([x] * len(df), index=df.index)
+                    if isinstance(x, np.ndarray):
+                        return pd.Series(x, index=df.index)
+                    return x
+
+                if expr.startswith('_'):
+
+                    target = expr[:expr.index('@')]
+                    rhs = expr[expr.index('@'):]
+                    v = to_series(simulate.eval_expression(rhs, df, globals(), locals_d))
+
+                    # update locals to allows us to ref previously assigned targets
+                    locals_d[target] = v
+                    chunk.log_df(trace_label, target, v)  # track temps stored in locals
+
+                    # don't add temps to utility sums
+                    continue
+
+                v = to_series(simulate.eval_expression(expr, df, globals(), locals_d))
+
+                if check_for_variability and v.std() == 0:
+                    logger.info("%s: no variability (%s) in: %s" % (trace_label, v.iloc[0], expr))
+                    no_variability += 1
+
+                if check_for_variability and np.count_nonzero(v.isnull().values) > 0:
+                    logger.info("%s: missing values in: %s" % (trace_label, expr))
+                    has_missing_vals += 1
+
+                utility = (v * coefficient).astype('float').values
+
+                if source == 'choosers':
+                    utilities += utility.reshape(-1, 1)
+                elif source == 'alternatives' and sampled:
+                    utilities += utility.take(sample).reshape(num_choosers, sample_size)
+                elif source == 'alternatives':
+                    utilities += utility
+                else:
+                    utilities += utility.reshape(num_choosers, sample_size)
+
+                del v
+                del utility
+
+            except Exception as err:
+                logger.exception(f"{trace_label} - {type(err).__name__} ({str(err)}) evaluating: {str(expr)}")
+                raise err
+
+        if no_variability > 0:
+            logger.warning("%s: %s columns have no variability" % (trace_label, no_variability))
+
+        if has_missing_vals > 0:
+            logger.warning("%s: %s columns have missing values" % (trace_label, has_missing_vals))
+
+        chunk.log_df(trace_label, 'interaction_df', None)
+        chunk.log_df(trace_label, 'eval.utilities', None)  # out of out hands...
+
+    return utilities
+
+
 def _interaction_simulate(
         choosers, alternatives, spec,
         skims=None, locals_d=None, sample_size=None,
@@ -313,60 +643,89 @@ def _interaction_simulate(
         alternatives = alternatives.copy()
         alternatives[alternatives.index.name] = alternatives.index
 
-    # cross join choosers and alternatives (cartesian product)
-    # for every chooser, there will be a row for each alternative
-    # index values (non-unique) are from alternatives df
-    alt_index_id = estimator.get_alt_id() if estimator else None
-    chooser_index_id = ALT_CHOOSER_ID if log_alt_losers else None
+    # tracing, estimation, and log_alt_losers need the expression values of every interaction_dataset row
+    if have_trace_targets or estimator or log_alt_losers:
+        terms = None
+    else:
+        terms = interaction_terms(spec, choosers, alternatives, skims, locals_d)
 
-    interaction_df = logit.interaction_dataset(choosers, alternatives, sample_size,
-                                               alt_index_id=alt_index_id, chooser_index_id=chooser_index_id)
-    chunk.log_df(trace_label, 'interaction_df', interaction_df)
+    if terms is not None:
 
-    if skims is not None:
-        simulate.set_skim_wrapper_targets(interaction_df, skims)
+        # evaluate chooser and alternative terms on choosers and alternatives, rather than on their cross join
+        sample = logit.interaction_dataset_sample(choosers, alternatives, sample_size)
 
-    # evaluate expressions from the spec multiply by coefficients and sum
-    # spec is df with one row per spec expression and one col with utility coefficient
-    # column names of model_design match spec index values
-    # utilities has utility value for element in the cross product of choosers and alternatives
-    # interaction_utilities is a df with one utility column and one row per row in model_design
-    if have_trace_targets:
-        trace_rows, trace_ids \
-            = tracing.interaction_trace_rows(interaction_df, choosers, sample_size)
+        utilities = pd.DataFrame(
+            eval_interaction_terms(terms, choosers, alternatives, sample, sample_size,
+                                   skims, locals_d, trace_label),
+            index=choosers.index)
+        chunk.log_df(trace_label, 'utilities', utilities)
+
+        # index values (non-unique) of each chooser's alternatives, as for interaction_dataset
+        alternatives_index = alternatives.index.take(sample)
+
+        del sample
 
-        tracing.trace_df(interaction_df[trace_rows],
-                         tracing.extend_trace_label(trace_label, 'interaction_df'),
-                         slicer='NONE', transpose=False)
     else:
-        trace_rows = trace_ids = None
 
-    interaction_utilities, trace_eval_results \
-        = eval_interaction_utilities(spec, interaction_df, locals_d, trace_label, trace_rows,
-                                     estimator=estimator,
-                                     log_alt_losers=log_alt_losers)
-    chunk.log_df(trace_label, 'interaction_utilities', interaction_utilities)
+        # cross join choosers and alternatives (cartesian product)
+        # for every chooser, there will be a row for each alternative
+        # index values (non-unique) are from alternatives df
+        alt_index_id = estimator.get_alt_id() if estimator else None
+        chooser_index_id = ALT_CHOOSER_ID if log_alt_losers else None
+
+        interaction_df = logit.interaction_dataset(choosers, alternatives, sample_size,
+                                                   alt_index_id=alt_index_id, chooser_index_id=chooser_index_id)
+        chunk.log_df(trace_label, 'interaction_df', interaction_df)
+
+        if skims is not None:
+            simulate.set_skim_wrapper_targets(interaction_df, skims)
+
+        # evaluate expressions from the spec multiply by coefficients and sum
+        # spec is df with one row per spec expression and one col with utility coefficient
+        # column names of model_design match spec index values
+        # utilities has utility value for element in the cross product of choosers and alternatives
+        # interaction_utilities is a df with one utility column and one row per row in model_design
+        if have_trace_targets:
+            trace_rows, trace_ids \
+                = tracing.interaction_trace_rows(interaction_df, choosers, sample_size)
+
+            tracing.trace_df(interaction_df[trace_rows],
+                             tracing.extend_trace_label(trace_label, 'interaction_df'),
+                             slicer='NONE', transpose=False)
+        else:
+            trace_rows = trace_ids = None
 
-    # print(f"interaction_df {interaction_df.shape}")
-    # print(f"interaction_utilities {interaction_utilities.shape}")
+        interaction_utilities, trace_eval_results \
+            = eval_interaction_utilities(spec, interaction_df, locals_d, trace_label, trace_rows,
+                                         estimator=estimator,
+                                         log_alt_losers=log_alt_losers)
+        chunk.log_df(trace_label, 'interaction_utilities', interaction_utilities)
 
-    del interaction_df
-    chunk.log_df(trace_label, 'interaction_df', None)
+        # print(f"interaction_df {interaction_df.shape}")
+        # print(f"interaction_utilities {interaction_utilities.shape}")
 
-    if have_trace_targets:
-        tracing.trace_interaction_eval_results(trace_eval_results, trace_ids,
-                                               tracing.extend_trace_label(trace_label, 'eval'))
+        del interaction_df
+        chunk.log_df(trace_label, 'interaction_df', None)
 
-        tracing.trace_df(interaction_utilities[trace_rows],
-                         tracing.extend_trace_label(trace_label, 'interaction_utils'),
-                         slicer='NONE', transpose=False)
+        if have_trace_targets:
+            tracing.trace_interaction_eval_results(trace_eval_results, trace_ids,
+                                                   tracing.extend_trace_label(trace_label, 'eval'))
+
+            tracing.trace_df(interaction_utilities[trace_rows],
+                             tracing.extend_trace_label(trace_label, 'interaction_utils'),
+                             slicer='NONE', transpose=False)
+
+        # reshape utilities (one utility column and one row per row in model_design)
+        # to a dataframe with one row per chooser and one column per alternative
+        utilities = pd.DataFrame(
+            interaction_utilities.values.reshape(len(choosers), sample_size),
+            index=choosers.index)
+        chunk.log_df(trace_label, 'utilities', utilities)
+
+        alternatives_index = interaction_utilities.index
 
-    # reshape utilities (one utility column and one row per row in model_design)
-    # to a dataframe with one row per chooser and one column per alternative
-    utilities = pd.DataFrame(
-        interaction_utilities.values.reshape(len(choosers), sample_size),
-        index=choosers.index)
-    chunk.log_df(trace_label, 'utilities', utilities)
+        del interaction_utilities
+        chunk.log_df(trace_label, 'interaction_utilities', None)
 
     if have_trace_targets:
         tracing.trace_df(utilities, tracing.extend_trace_label(trace_label, 'utils'),
@@ -400,7 +759,7 @@ def _interaction_simulate(
     # offsets is the offset into model_design df of first row of chooser alternatives
     offsets = np.arange(len(positions)) * sample_size
     # resulting Int64Index has one element per chooser row and is in same order as choosers
-    choices = interaction_utilities.index.take(positions + offsets)
+    choices = alternatives_index.take(positions + offsets)
 
     # create a series with index from choosers and the index of the chosen alternative
     choices = pd.Series(choices, index=choosers.index)
@@ -4,6 +4,7 @@ from builtins import object
 
 import logging
 
+import numba
 import numpy as np
 import pandas as pd
 
@@ -20,6 +21,42 @@ PROB_MIN = 0.0
 PROB_MAX = 1.0
 
 
+@numba.njit(nogil=True)
+def _zero_tiny_exp_utils(exp_utils):
+    """
+    set exponentiated utilities at or below EXP_UTIL_MIN to zero in place (with no temporary arrays)
+    which is equivalent to clipping to [EXP_UTIL_MIN, EXP_UTIL_MAX] and then zeroing EXP_UTIL_MIN
+    """
+    num_rows, num_cols = exp_utils.shape
+    for i in range(num_rows):
+        for j in range(num_cols):
+            if exp_utils[i, j] <= EXP_UTIL_MIN:
+                exp_utils[i, j] = 0.0
+
+
+@numba.njit(nogil=True)
+def _choice_positions(probs, rands, positions, totals):
+    """
+    For each chooser (row) find the position of the first alternative whose cumulative probability
+    is greater than the chooser's rand (the same position as np.argmax(probs.cumsum(axis=1) - rands > 0, axis=1),
+    including 0 if there is no such alternative) without allocating the cumulative probabilities.
+
+    Cumulative probabilities are accumulated in float64 (even for float32 probs) and the row totals
+    are returned in totals so caller can cheaply check that probabilities sum to one.
+    """
+    num_rows, num_cols = probs.shape
+    for i in range(num_rows):
+        r = rands[i]
+        cum_prob = 0.0
+        position = -1
+        for j in range(num_cols):
+            cum_prob += probs[i, j]
+            if position < 0 and cum_prob > r:
+                position = j
+        positions[i] = max(position, 0)
+        totals[i] = cum_prob
+
+
 def report_bad_choices(bad_row_map, df, trace_label, msg, trace_choosers=None, raise_error=True):
     """
 
@@ -108,7 +145,7 @@ def utils_to_logsums(utils, exponentiated=False, allow_zero_probs=False):
 
 
 def utils_to_probs(utils, trace_label=None, exponentiated=False, allow_zero_probs=False,
-                   trace_choosers=None):
+                   trace_choosers=None, overwrite_utils=False):
     """
     Convert a table of utilities to probabilities.
 
@@ -133,6 +170,12 @@ def utils_to_probs(utils, trace_label=None, exponentiated=False, allow_zero_prob
         by report_bad_choices because it can't deduce hh_id from the interaction_dataset
         which is indexed on index values from alternatives df
 
+    overwrite_utils : bool
+        if True, probabilities are computed in place in the utils buffer (which should not be
+        used by the caller afterwards) rather than in a newly allocated array of the same size.
+        (bad rows are then reported with exponentiated rather than raw utilities)
+        Float32 utils are computed (and probs returned) in float32.
+
     Returns
     -------
     probs : pandas.DataFrame
@@ -141,16 +184,14 @@ def utils_to_probs(utils, trace_label=None, exponentiated=False, allow_zero_prob
     """
     trace_label = tracing.extend_trace_label(trace_label, 'utils_to_probs')
 
-    # fixme - conversion to float not needed in either case?
-    # utils_arr = utils.values.astype('float')
     utils_arr = utils.values
+    overwrite_utils = overwrite_utils and utils_arr.dtype.kind == 'f'
     if not exponentiated:
-        utils_arr = np.exp(utils_arr)
+        utils_arr = np.exp(utils_arr, out=utils_arr if overwrite_utils else None)
+    elif not overwrite_utils:
+        utils_arr = utils_arr.astype(np.result_type(utils_arr.dtype, np.float32))
 
-    np.clip(utils_arr, EXP_UTIL_MIN, EXP_UTIL_MAX, out=utils_arr)
-
-    # FIXME
-    utils_arr = np.where(utils_arr == EXP_UTIL_MIN, 0.0, utils_arr)
+    _zero_tiny_exp_utils(utils_arr)
 
     arr_sum = utils_arr.sum(axis=1)
 
@@ -175,7 +216,12 @@ def utils_to_probs(utils, trace_label=None, exponentiated=False, allow_zero_prob
         np.divide(utils_arr, arr_sum.reshape(len(utils_arr), 1), out=utils_arr)
 
     # if allow_zero_probs, this will cause EXP_UTIL_MIN util rows to have all zero probabilities
-    utils_arr[np.isnan(utils_arr)] = PROB_MIN
+    # (nan probabilities can only be in rows with zero or nan sums, so only check those)
+    nan_rows = ~(arr_sum > 0.0)
+    if nan_rows.any():
+        nan_probs = utils_arr[nan_rows]
+        nan_probs[np.isnan(nan_probs)] = PROB_MIN
+        utils_arr[nan_rows] = nan_probs
 
     np.clip(utils_arr, PROB_MIN, PROB_MAX, out=utils_arr)
 
@@ -212,41 +258,34 @@ def make_choices(probs, trace_label=None, trace_choosers=None, allow_bad_probs=F
     """
     trace_label = tracing.extend_trace_label(trace_label, 'make_choices')
 
-    # probs should sum to 1 across each row
+    rands = pipeline.get_rn_generator().random_for_df(probs)
+    rands = np.asanyarray(rands).reshape(len(probs.index))
+
+    choices = np.empty(len(probs.index), dtype=np.int64)
+    totals = np.empty(len(probs.index), dtype=np.float64)
+    _choice_positions(probs.values, rands, choices, totals)
 
+    # probs should sum to 1 across each row (nan totals are bad too)
     BAD_PROB_THRESHOLD = 0.001
-    bad_probs = \
-        probs.sum(axis=1).sub(np.ones(len(probs.index))).abs() \
-        > BAD_PROB_THRESHOLD * np.ones(len(probs.index))
+    bad_probs = ~(np.abs(totals - 1.0) <= BAD_PROB_THRESHOLD)
 
     if bad_probs.any() and not allow_bad_probs:
 
-        report_bad_choices(bad_probs, probs,
+        report_bad_choices(pd.Series(bad_probs, index=probs.index), probs,
                            trace_label=tracing.extend_trace_label(trace_label, 'bad_probs'),
                            msg="probabilities do not add up to 1",
                            trace_choosers=trace_choosers)
 
-    rands = pipeline.get_rn_generator().random_for_df(probs)
-
-    probs_arr = probs.values.cumsum(axis=1) - rands
-
-    # rows, cols = np.where(probs_arr > 0)
-    # choices = [s.iat[0] for _, s in pd.Series(cols).groupby(rows)]
-    choices = np.argmax(probs_arr > 0.0, axis=1)
-
     choices = pd.Series(choices, index=probs.index)
 
-    rands = pd.Series(np.asanyarray(rands).flatten(), index=probs.index)
+    rands = pd.Series(rands, index=probs.index)
 
     return choices, rands
 
 
-def interaction_dataset(choosers, alternatives, sample_size=None, alt_index_id=None, chooser_index_id=None):
+def interaction_dataset_sample(choosers, alternatives, sample_size=None):
     """
-    Combine choosers and alternatives into one table for the purposes
-    of creating interaction variables and/or sampling alternatives.
-
-    Any duplicate column names in choosers table will be renamed with an '_chooser' suffix.
+    Positions (in alternatives) of the alternatives interaction_dataset pairs with each chooser
 
     Parameters
     ----------
@@ -258,10 +297,8 @@ def interaction_dataset(choosers, alternatives, sample_size=None, alt_index_id=N
 
     Returns
     -------
-    alts_sample : pandas.DataFrame
-        Merged choosers and alternatives with data repeated either
-        len(alternatives) or `sample_size` times.
-
+    sample : 1-D ndarray of int
+        len(choosers) * sample_size positions in chooser-major order
     """
     if not choosers.index.is_unique:
         raise RuntimeError(
@@ -285,6 +322,34 @@ def interaction_dataset(choosers, alternatives, sample_size=None, alt_index_id=N
     else:
         sample = np.tile(alts_idx, numchoosers)
 
+    return sample
+
+
+def interaction_dataset(choosers, alternatives, sample_size=None, alt_index_id=None, chooser_index_id=None):
+    """
+    Combine choosers and alternatives into one table for the purposes
+    of creating interaction variables and/or sampling alternatives.
+
+    Any duplicate column names in choosers table will be renamed with an '_chooser' suffix.
+
+    Parameters
+    ----------
+    choosers : pandas.DataFrame
+    alternatives : pandas.DataFrame
+    sample_size : int, optional
+        If sampling from alternatives for each chooser, this is
+        how many to sample.
+
+    Returns
+    -------
+    alts_sample : pandas.DataFrame
+        Merged choosers and alternatives with data repeated either
+        len(alternatives) or `sample_size` times.
+
+    """
+    sample_size = sample_size or len(alternatives)
+    sample = interaction_dataset_sample(choosers, alternatives, sample_size)
+
     alts_sample = alternatives.take(sample).copy()
 
     if alt_index_id:
@@ -470,3 +535,204 @@ def count_nests(nest_spec):
             return 1
 
     return count_each_nest(nest_spec, 0) if nest_spec is not None else 0
+
+
+class NestArrays(object):
+    """
+    Nest spec compiled into index arrays for array-native nested logit computations
+
+    Nests and leaves (nodes) are numbered in each_nest post_order, so the alternatives of a nest precede
+    it and the root is the last node. Exponentiated utilities and nested probabilities of all nodes are
+    stored in a single 2D float array with a row per node and a column per chooser, so each step is a few
+    vectorized passes over contiguous node rows rather than a DataFrame column assignment per node.
+
+    ::
+
+      names: list of str              # node names in post_order
+      parent: int ndarray             # node index of parent nest (-1 for root)
+      coefficient: float ndarray      # nest coefficient (0 for leaves)
+      product_of_coefficients: float ndarray
+      nest_ixs: int ndarray           # node indexes of nests (post_order)
+      leaf_ixs: int ndarray           # node indexes of leaves (post_order)
+      alternatives: dict              # int ndarray node indexes of alternatives keyed by nest node index
+      ancestors: 2D int ndarray       # (num_leaves, depth) node indexes of leaf ancestors below root,
+                                      # padded with root (whose nested probability is 1)
+      probability_ixs: int ndarray    # node indexes of nested probability columns (in legacy column order)
+    """
+
+    def __init__(self, nest_spec):
+
+        nests = list(each_nest(nest_spec, post_order=True))
+
+        self.names = [nest.name for nest in nests]
+        node_ix = {name: i for i, name in enumerate(self.names)}
+        assert len(node_ix) == len(nests), "duplicate nest key in nest spec"
+
+        self.root = len(nests) - 1
+        self.parent = np.full(len(nests), -1, dtype=np.int64)
+        self.coefficient = np.array([nest.coefficient for nest in nests], dtype=np.float64)
+        self.product_of_coefficients = np.array([nest.product_of_coefficients for nest in nests], dtype=np.float64)
+
+        self.alternatives = {}
+        for i, nest in enumerate(nests):
+            if not nest.is_leaf:
+                self.alternatives[i] = np.array([node_ix[a] for a in nest.alternatives], dtype=np.int64)
+                self.parent[self.alternatives[i]] = i
+
+        self.nest_ixs = np.array([i for i, nest in enumerate(nests) if not nest.is_leaf], dtype=np.int64)
+        self.leaf_ixs = np.array([i for i, nest in enumerate(nests) if nest.is_leaf], dtype=np.int64)
+        self.leaf_names = [self.names[i] for i in self.leaf_ixs]
+
+        depth = max(len(nest.ancestors) for nest in nests) - 1
+        self.ancestors = np.full((len(self.leaf_ixs), depth), self.root, dtype=np.int64)
+        for i, leaf_ix in enumerate(self.leaf_ixs):
+            # skip root: it has a prob of 1 but there is no nested probability for it
+            ancestors = [node_ix[a] for a in nests[leaf_ix].ancestors[1:]]
+            self.ancestors[i, :len(ancestors)] = ancestors
+
+        # nested probabilities are traced with alternatives of each nest in pre_order of nests
+        self.probability_ixs = np.concatenate(
+            [self.alternatives[node_ix[nest.name]] for nest in each_nest(nest_spec, type='node', post_order=False)])
+
+    @property
+    def num_nodes(self):
+        return len(self.names)
+
+    def leaf_column_ixs(self, columns):
+        """
+        positions in columns (e.g. spec alternatives) of leaves in leaf_ixs order
+        """
+        columns = pd.Index(columns)
+        assert set(columns) == set(self.leaf_names), \
+            f"nest spec leaves {self.leaf_names} do not match alternatives {list(columns)}"
+        return columns.get_indexer(self.leaf_names)
+
+    def exp_utilities(self, raw_utilities, columns):
+        """
+        compute exponentiated nest utilities based on nesting coefficients
+
+        leaf <- exp( raw_utility / product_of_coefficients )
+        nest <- exp( ln(sum of exponentiated utilities of alternatives) * nest_coefficient )
+
+        Parameters
+        ----------
+        raw_utilities : 2D numpy.ndarray
+            raw leaf utilities with a row per chooser and a column per alternative
+        columns : list-like
+            alternative (leaf) names of raw_utilities columns
+
+        Returns
+        -------
+        exp_utilities : 2D numpy.ndarray of float
+            shape (num_nodes, num_choosers)
+        """
+
+        exp_utilities = np.empty((self.num_nodes, raw_utilities.shape[0]), dtype=np.float64)
+
+        leaf_utilities = raw_utilities.T[self.leaf_column_ixs(columns)].astype(np.float64, copy=False)
+        leaf_utilities /= self.product_of_coefficients[self.leaf_ixs, np.newaxis]
+        exp_utilities[self.leaf_ixs] = np.exp(leaf_utilities)
+
+        # alternatives of a nest will already have been computed due to post_order
+        for i in self.nest_ixs:
+            # log(0) is -inf if all nest alternative utilities are zero, which will become 0 when exponentiated
+            with np.errstate(divide='ignore'):
+                exp_utilities[i] = np.exp(self.coefficient[i] * np.log(exp_utilities[self.alternatives[i]].sum(axis=0)))
+
+        return exp_utilities
+
+    def logsums(self, exp_utilities):
+        """
+        logsum of root nest from exp_utilities array
+        """
+        return np.log(exp_utilities[self.root])
+
+    def nested_probabilities(self, exp_utilities, trace_label=None, index=None):
+        """
+        compute probabilities of nodes relative to siblings sharing the same nest
+
+        Semantics match utils_to_probs(exponentiated=True, allow_zero_probs=True) applied to the
+        alternatives of each nest, so a nest whose alternatives are all unavailable has all zero probabilities.
+
+        Parameters
+        ----------
+        exp_utilities : 2D numpy.ndarray
+            array returned by exp_utilities
+        trace_label : str
+            label for reporting infinite exponentiated utilities
+        index : pandas.Index
+            chooser index for reporting infinite exponentiated utilities
+
+        Returns
+        -------
+        nested_probabilities : 2D numpy.ndarray of float
+            shape (num_nodes, num_choosers), root probability is 1
+        """
+
+        probs = np.clip(exp_utilities, EXP_UTIL_MIN, EXP_UTIL_MAX)
+        probs[probs == EXP_UTIL_MIN] = 0.0
+
+        nest_sums = np.empty_like(probs)
+        for i in self.nest_ixs:
+            nest_sums[i] = probs[self.alternatives[i]].sum(axis=0)
+
+            inf_utils = np.isinf(nest_sums[i])
+            if inf_utils.any():
+                utils = pd.DataFrame(exp_utilities[self.alternatives[i]].T, index=index,
+                                     columns=[self.names[a] for a in self.alternatives[i]])
+                trace_label = tracing.extend_trace_label(trace_label, 'utils_to_probs')
+                report_bad_choices(inf_utils, utils,
+                                   trace_label=tracing.extend_trace_label(trace_label, 'inf_exp_utils'),
+                                   msg="infinite exponentiated utilities")
+
+        # nests with all zero exp utilities will have nan (all zero) probabilities
+        with np.errstate(invalid='ignore', divide='ignore'):
+            np.divide(probs[:self.root], nest_sums[self.parent[:self.root]], out=probs[:self.root])
+        probs[self.root] = 1.0
+
+        probs[np.isnan(probs)] = PROB_MIN
+        np.clip(probs, PROB_MIN, PROB_MAX, out=probs)
+
+        return probs
+
+    def base_probabilities(self, nested_probabilities, columns):
+        """
+        compute base probabilities of leaves as the product of the nested probabilities of their ancestors
+
+        Parameters
+        ----------
+        nested_probabilities : 2D numpy.ndarray
+            array returned by nested_probabilities
+        columns : list-like
+            alternative (leaf) names in desired column order (e.g. spec.columns)
+
+        Returns
+        -------
+        base_probabilities : 2D numpy.ndarray of float
+            shape (num_choosers, len(columns))
+        """
+
+        # leaf (in leaf_ixs order) of each column
+        column_leaves = np.empty(len(self.leaf_ixs), dtype=np.int64)
+        column_leaves[self.leaf_column_ixs(columns)] = np.arange(len(self.leaf_ixs))
+        ancestors = self.ancestors[column_leaves]
+
+        base_probabilities = nested_probabilities[ancestors[:, 0]].T.copy()
+        for level in range(1, ancestors.shape[1]):
+            base_probabilities *= nested_probabilities[ancestors[:, level]].T
+
+        return base_probabilities
+
+
+_NEST_ARRAYS = {}
+
+
+def nest_arrays(nest_spec):
+    """
+    NestArrays for nest_spec, compiled once per distinct nest spec (including coefficient values)
+    """
+
+    key = repr(nest_spec)
+    if key not in _NEST_ARRAYS:
+        _NEST_ARRAYS[key] = NestArrays(nest_spec)
+    return _NEST_ARRAYS[key]
@@ -1,6 +1,8 @@
 # ActivitySim
 # See full license in LICENSE.txt.
 
+import hashlib
+import json
 import os
 import logging
 import warnings
@@ -15,14 +17,17 @@ from activitysim.core import config
 from activitysim.core import pathbuilder
 from activitysim.core import mem
 from activitysim.core import tracing
+from activitysim.core import maz_pairs
 
 from activitysim.core.skim_dictionary import NOT_IN_SKIM_ZONE_ID
 from activitysim.core.skim_dict_factory import NumpyArraySkimFactory
 from activitysim.core.skim_dict_factory import MemMapSkimFactory
+from activitysim.core.skim_dict_factory import SharedMemorySkimFactory
 
 skim_factories = {
     'NumpyArraySkimFactory': NumpyArraySkimFactory,
     'MemMapSkimFactory': MemMapSkimFactory,
+    'SharedMemorySkimFactory': SharedMemorySkimFactory,
 }
 
 logger = logging.getLogger(__name__)
@@ -41,6 +46,9 @@ DEFAULT_SETTINGS = {
 
 TRACE_TRIMMED_MAZ_TO_TAP_TABLES = True
 
+# prefix of shared data_buffers keys of maz_to_maz MazPairs arrays
+MAZ_PAIRS_BUFFER_TAG = 'maz_to_maz'
+
 
 class Network_LOS(object):
     """
@@ -61,9 +69,10 @@ class Network_LOS(object):
 
       # TWO_ZONE and THREE_ZONE
       maz_taz_df: pandas.DataFrame        # DataFrame with two columns, MAZ and TAZ, mapping MAZ to containing TAZ
-      maz_to_maz_df: pandas.DataFrame     # maz_to_maz attributes for MazSkimDict sparse skims
-                                          # indexed by synthetic omaz/dmaz index for faster get_mazpairs lookup)
-      maz_ceiling: int                    # max maz_id + 1 (to compute synthetic omaz/dmaz index by get_mazpairs)
+      maz_pairs: MazPairs                 # maz_to_maz attributes for MazSkimDict sparse skims
+                                          # in compressed sparse row layout for fast get_mazpairs lookup
+      maz_pairs_in_shared_buffers: bool   # if multiprocessing, maz_pairs already copied to shared buffers
+      maz_ceiling: int                    # max maz_id + 1
       max_blend_distance: dict            # dict of int maz_to_maz max_blend_distance values keyed by skim_tag
 
       # THREE_ZONE only
@@ -88,7 +97,8 @@ class Network_LOS(object):
 
         # TWO_ZONE and THREE_ZONE
         self.maz_taz_df = None
-        self.maz_to_maz_df = None
+        self.maz_pairs = None
+        self.maz_pairs_in_shared_buffers = False  # copied by allocate_shared_skim_buffers
         self.maz_ceiling = None
         self.max_blend_distance = {}
 
@@ -222,34 +232,25 @@ class Network_LOS(object):
         if self.zone_system in [TWO_ZONE, THREE_ZONE]:
 
             # maz
-            file_name = self.setting('maz')
-            self.maz_taz_df = pd.read_csv(config.data_file_path(file_name, mandatory=True))
-            self.maz_taz_df = self.maz_taz_df[['MAZ', 'TAZ']].sort_values(by='MAZ')  # only fields we need
-
-            self.maz_ceiling = self.maz_taz_df.MAZ.max() + 1
-
-            # maz_to_maz_df
-            maz_to_maz_tables = self.setting('maz_to_maz.tables')
-            maz_to_maz_tables = [maz_to_maz_tables] if isinstance(maz_to_maz_tables, str) else maz_to_maz_tables
-            for file_name in maz_to_maz_tables:
+            file_path = config.data_file_path(self.setting('maz'), mandatory=True)
 
-                df = pd.read_csv(config.data_file_path(file_name, mandatory=True))
+            def read_maz_taz_df():
+                df = pd.read_csv(file_path)
+                return df[['MAZ', 'TAZ']].sort_values(by='MAZ')  # only fields we need
 
-                df['i'] = df.OMAZ * self.maz_ceiling + df.DMAZ
-                df.set_index('i', drop=True, inplace=True, verify_integrity=True)
-                logger.debug(f"loading maz_to_maz table {file_name} with {len(df)} rows")
+            self.maz_taz_df = self.cached_los_table('maz', [file_path], read_maz_taz_df)
 
-                # FIXME - don't really need these columns, but if we do want them,
-                #  we would need to merge them in since files may have different numbers of rows
-                df.drop(columns=['OMAZ', 'DMAZ'], inplace=True)
-
-                # besides, we only want data columns so we can coerce to same type as skims
-                df = df.astype(np.dtype(self.skim_dtype_name))
+            self.maz_ceiling = self.maz_taz_df.MAZ.max() + 1
 
-                if self.maz_to_maz_df is None:
-                    self.maz_to_maz_df = df
-                else:
-                    self.maz_to_maz_df = pd.concat([self.maz_to_maz_df, df], axis=1)
+            # maz_to_maz pairs
+            data_buffers = inject.get_injectable('data_buffers', None) if self.multiprocess() else None
+            if maz_pairs.MazPairs.has_buffers(data_buffers, MAZ_PAIRS_BUFFER_TAG):
+                # preloaded into shared buffers by load_shared_data
+                columns = maz_pairs.read_csv_columns(self.maz_to_maz_file_paths())
+                self.maz_pairs = maz_pairs.MazPairs.from_buffers(data_buffers, MAZ_PAIRS_BUFFER_TAG, columns)
+                logger.info(f"load_data using existing shared buffers for maz_to_maz pairs")
+            else:
+                self.maz_pairs = self.load_maz_pairs()
 
         # load tap tables
         if self.zone_system == THREE_ZONE:
@@ -265,63 +266,14 @@ class Network_LOS(object):
                 assert 'table' in maz_to_tap_settings, \
                     f"Expected setting maz_to_tap.{mode}.table not found in in {LOS_SETTINGS_FILE_NAME}"
 
-                file_name = maz_to_tap_settings['table']
-                df = pd.read_csv(config.data_file_path(file_name, mandatory=True))
-
-                # trim tap set
-                # if provided, use tap_line_distance_col together with tap_lines table to trim the near tap set
-                # to only include the nearest tap to origin when more than one tap serves the same line
-                distance_col = maz_to_tap_settings.get('tap_line_distance_col')
-                if distance_col:
-
-                    if self.tap_lines_df is None:
-                        # load tap_lines on demand (required if they specify tap_line_distance_col)
-                        tap_lines_file_name = self.setting('tap_lines', )
-                        self.tap_lines_df = pd.read_csv(config.data_file_path(tap_lines_file_name, mandatory=True))
-
-                        # csv file has one row per TAP with space-delimited list of lines served by that TAP
-                        #  TAP                                      LINES
-                        # 6020  GG_024b_SB GG_068_RT GG_228_WB GG_023X_RT
-                        # stack to create dataframe with one column 'line' indexed by TAP with one row per line served
-                        #  TAP        line
-                        # 6020  GG_024b_SB
-                        # 6020   GG_068_RT
-                        # 6020   GG_228_WB
-                        self.tap_lines_df = \
-                            self.tap_lines_df.set_index('TAP').LINES.str.split(expand=True)\
-                                .stack().droplevel(1).to_frame('line')
-
-                    old_len = len(df)
-
-                    # NOTE - merge will remove unused taps (not appearing in tap_lines)
-                    df = pd.merge(df, self.tap_lines_df, left_on='TAP', right_index=True)
-
-                    # find nearest TAP to MAz that serves line
-                    df = df.sort_values(by=distance_col).drop_duplicates(subset=['MAZ', 'line'])
-
-                    # we don't need to remember which lines are served by which TAPs
-                    df = df.drop(columns='line').drop_duplicates(subset=['MAZ', 'TAP']).sort_values(['MAZ', 'TAP'])
+                file_paths = [config.data_file_path(maz_to_tap_settings['table'], mandatory=True)]
+                if maz_to_tap_settings.get('tap_line_distance_col'):
+                    file_paths.append(config.data_file_path(self.setting('tap_lines'), mandatory=True))
 
-                    logger.debug(f"trimmed maz_to_tap table {file_name} from {old_len} to {len(df)} rows "
-                                 f"based on tap_lines")
-                    logger.debug(f"maz_to_tap table {file_name} max {distance_col} {df[distance_col].max()}")
-
-                    max_dist = maz_to_tap_settings.get('max_dist', None)
-                    if max_dist:
-                        old_len = len(df)
-                        df = df[df[distance_col] <= max_dist]
-                        logger.debug(f"trimmed maz_to_tap table {file_name} from {old_len} to {len(df)} rows "
-                                     f"based on max_dist {max_dist}")
-
-                    if TRACE_TRIMMED_MAZ_TO_TAP_TABLES:
-                        tracing.write_csv(df, file_name=f"trimmed_{maz_to_tap_settings['table']}", transpose=False)
-
-                else:
-                    logger.warning(f"tap_line_distance_col not provided in {LOS_SETTINGS_FILE_NAME} so maz_to_tap "
-                                   f"pairs will not be trimmed which may result in high memory use and long runtimes")
-
-                df.set_index(['MAZ', 'TAP'], drop=True, inplace=True, verify_integrity=True)
-                logger.debug(f"loaded maz_to_tap table {file_name} with {len(df)} rows")
+                df = self.cached_los_table(f"maz_to_tap_{mode}", file_paths,
+                                           lambda: self.read_maz_to_tap_df(maz_to_tap_settings),
+                                           settings=maz_to_tap_settings)
+                logger.debug(f"loaded maz_to_tap table {maz_to_tap_settings['table']} with {len(df)} rows")
 
                 assert mode not in self.maz_to_tap_dfs
                 self.maz_to_tap_dfs[mode] = df
@@ -336,7 +288,7 @@ class Network_LOS(object):
         # create MazSkimDict facade
         if self.zone_system in [TWO_ZONE, THREE_ZONE]:
             # create MazSkimDict facade skim_dict
-            # (must have already loaded dependencies: taz skim_dict, maz_to_maz_df, and maz_taz_df)
+            # (must have already loaded dependencies: taz skim_dict, maz_pairs, and maz_taz_df)
             assert 'maz' not in self.skim_dicts
             maz_skim_dict = self.create_skim_dict('maz')
             self.skim_dicts['maz'] = maz_skim_dict
@@ -352,6 +304,212 @@ class Network_LOS(object):
             # make sure skim has all tap_ids
             assert not (tap_skim_dict.offset_mapper.map(self.tap_df['TAP'].values) == NOT_IN_SKIM_ZONE_ID).any()
 
+    def read_tap_lines_df(self):
+        """
+        Read tap_lines table (lines served by each TAP), caching it in the los cache if write_los_cache
+
+        Returns
+        -------
+        pandas.DataFrame with one column 'line' indexed by TAP, with one row per line served
+        """
+
+        file_path = config.data_file_path(self.setting('tap_lines'), mandatory=True)
+
+        def read_tap_lines_df():
+            df = pd.read_csv(file_path)
+
+            # csv file has one row per TAP with space-delimited list of lines served by that TAP
+            #  TAP                                      LINES
+            # 6020  GG_024b_SB GG_068_RT GG_228_WB GG_023X_RT
+            # stack to create dataframe with one column 'line' indexed by TAP with one row per line served
+            #  TAP        line
+            # 6020  GG_024b_SB
+            # 6020   GG_068_RT
+            # 6020   GG_228_WB
+            return df.set_index('TAP').LINES.str.split(expand=True).stack().droplevel(1).to_frame('line')
+
+        return self.cached_los_table('tap_lines', [file_path], read_tap_lines_df)
+
+    def read_maz_to_tap_df(self, maz_to_tap_settings):
+        """
+        Read maz_to_tap table and, if tap_line_distance_col is specified, trim it to only include the
+        nearest tap to each maz when more than one tap serves the same line
+
+        Parameters
+        ----------
+        maz_to_tap_settings: dict
+            maz_to_tap settings for access mode (e.g. maz_to_tap.walk)
+
+        Returns
+        -------
+        pandas.DataFrame indexed by MAZ and TAP
+        """
+
+        file_name = maz_to_tap_settings['table']
+        df = pd.read_csv(config.data_file_path(file_name, mandatory=True))
+
+        # trim tap set
+        # if provided, use tap_line_distance_col together with tap_lines table to trim the near tap set
+        # to only include the nearest tap to origin when more than one tap serves the same line
+        distance_col = maz_to_tap_settings.get('tap_line_distance_col')
+        if distance_col:
+
+            if self.tap_lines_df is None:
+                # load tap_lines on demand (required if they specify tap_line_distance_col)
+                self.tap_lines_df = self.read_tap_lines_df()
+
+            old_len = len(df)
+
+            # NOTE - merge will remove unused taps (not appearing in tap_lines)
+            df = pd.merge(df, self.tap_lines_df, left_on='TAP', right_index=True)
+
+            # find nearest TAP to MAz that serves line
+            df = df.sort_values(by=distance_col).drop_duplicates(subset=['MAZ', 'line'])
+
+            # we don't need to remember which lines are served by which TAPs
+            df = df.drop(columns='line').drop_duplicates(subset=['MAZ', 'TAP']).sort_values(['MAZ', 'TAP'])
+
+            logger.debug(f"trimmed maz_to_tap table {file_name} from {old_len} to {len(df)} rows "
+                         f"based on tap_lines")
+            logger.debug(f"maz_to_tap table {file_name} max {distance_col} {df[distance_col].max()}")
+
+            max_dist = maz_to_tap_settings.get('max_dist', None)
+            if max_dist:
+                old_len = len(df)
+                df = df[df[distance_col] <= max_dist]
+                logger.debug(f"trimmed maz_to_tap table {file_name} from {old_len} to {len(df)} rows "
+                             f"based on max_dist {max_dist}")
+
+            if TRACE_TRIMMED_MAZ_TO_TAP_TABLES:
+                tracing.write_csv(df, file_name=f"trimmed_{maz_to_tap_settings['table']}", transpose=False)
+
+        else:
+            logger.warning(f"tap_line_distance_col not provided in {LOS_SETTINGS_FILE_NAME} so maz_to_tap "
+                           f"pairs will not be trimmed which may result in high memory use and long runtimes")
+
+        df.set_index(['MAZ', 'TAP'], drop=True, inplace=True, verify_integrity=True)
+
+        return df
+
+    def los_cache_path(self, table_name, file_paths, settings=None):
+        """
+        Return path (without suffix) of los cache file for table_name
+
+        The file name includes a digest of the contents of the files the table is built from and of any
+        network_los settings that affect how it is processed, so a cache built from different (or changed)
+        inputs is never read.
+
+        Parameters
+        ----------
+        table_name: str
+        file_paths: list of str
+            paths of data files the table is built from
+        settings: dict or None
+            settings used to process the table (must be json serializable)
+
+        Returns
+        -------
+        str
+        """
+        md5 = hashlib.md5()
+        for file_path in file_paths:
+            md5.update(util.file_digest(file_path).encode())
+        if settings is not None:
+            md5.update(json.dumps(settings, sort_keys=True, default=str).encode())
+        return os.path.join(config.get_cache_dir(), f"los_{table_name}_{md5.hexdigest()}")
+
+    def cached_los_table(self, table_name, file_paths, read_table, settings=None):
+        """
+        Return table built by read_table, or, if read_los_cache setting, memory mapped from the parquet
+        los cache file written by a prior run with write_los_cache setting from the same files and settings
+
+        Parameters
+        ----------
+        table_name: str
+        file_paths: list of str
+            paths of data files the table is built from
+        read_table: callable
+            function that reads and processes the files and returns a pandas.DataFrame
+        settings: dict or None
+            settings used by read_table to process the table
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+
+        read_cache = self.setting('read_los_cache', False)
+        write_cache = self.setting('write_los_cache', False)
+
+        if not (read_cache or write_cache):
+            return read_table()
+
+        cache_path = f"{self.los_cache_path(table_name, file_paths, settings)}.parquet"
+
+        if read_cache:
+            if os.path.isfile(cache_path):
+                logger.info(f"reading los cache {table_name} from {cache_path}")
+                return pd.read_parquet(cache_path, memory_map=True)
+            logger.warning(f"read_los_cache {table_name} cache not found: {cache_path}")
+
+        df = read_table()
+
+        if write_cache:
+            # write to temp file and rename so concurrent readers never see a partially written table
+            temp_path = f"{cache_path}.{os.getpid()}.tmp"
+            df.to_parquet(temp_path)
+            os.replace(temp_path, cache_path)
+            logger.info(f"wrote los cache {table_name} to {cache_path}")
+
+        return df
+
+    def maz_to_maz_file_paths(self):
+        """
+        Return list of paths of maz_to_maz table files from maz_to_maz.tables setting
+        """
+        file_names = self.setting('maz_to_maz.tables')
+        file_names = [file_names] if isinstance(file_names, str) else file_names
+        return [config.data_file_path(file_name, mandatory=True) for file_name in file_names]
+
+    def load_maz_pairs(self):
+        """
+        Load maz_to_maz tables into MazPairs
+
+        If read_los_cache setting, memory map MazPairs from cache dir if it was cached (by a run with
+        write_los_cache setting) from the same maz_to_maz tables, rather than reading and parsing csv files.
+
+        Returns
+        -------
+        MazPairs
+        """
+
+        file_paths = self.maz_to_maz_file_paths()
+
+        read_cache = self.setting('read_los_cache', False)
+        write_cache = self.setting('write_los_cache', False)
+
+        cache_path = self.los_cache_path('maz_to_maz', file_paths, {'dtype': self.skim_dtype_name}) \
+            if (read_cache or write_cache) else None
+
+        if read_cache:
+            pairs = maz_pairs.MazPairs.read(cache_path)
+            if pairs is not None:
+                return pairs
+            logger.warning(f"read_los_cache maz_to_maz cache not found: {cache_path}")
+
+        tables = {}
+        for file_path in file_paths:
+            tables[file_path] = pd.read_csv(file_path)
+            logger.debug(f"loading maz_to_maz table {file_path} with {len(tables[file_path])} rows")
+
+        pairs = maz_pairs.MazPairs.from_tables(tables, self.skim_dtype_name)
+        logger.info(f"loaded {pairs.num_pairs} maz_to_maz pairs ({util.GB(pairs.nbytes)})")
+
+        if write_cache:
+            pairs.write(cache_path)
+
+        return pairs
+
     def create_skim_dict(self, skim_tag):
         """
         Create a new SkimDict of type specified by skim_tag (e.g. 'taz', 'maz' or 'tap')
@@ -368,7 +526,7 @@ class Network_LOS(object):
 
         if skim_tag == 'maz':
             # MazSkimDict gets a reference to self here, because it has dependencies on self.load_data
-            # (e.g. maz_to_maz_df, maz_taz_df...) We pass in taz_skim_dict as a parameter
+            # (e.g. maz_pairs, maz_taz_df...) We pass in taz_skim_dict as a parameter
             # to hilight the fact that we do not want two copies of its (very large) data array in memory
             assert 'taz' in self.skim_dicts, \
                 f"create_skim_dict 'maz': backing taz skim_dict not in skim_dicts"
@@ -428,6 +586,10 @@ class Network_LOS(object):
                 assert skim_tag in shared_data_buffers, f"load_shared_data expected allocated shared_data_buffers"
                 self.skim_dict_factory.load_skims_to_buffer(self.skims_info[skim_tag], shared_data_buffers[skim_tag])
 
+        if self.zone_system in [TWO_ZONE, THREE_ZONE] and not self.maz_pairs_in_shared_buffers:
+            # allocate_shared_skim_buffers already copied them, unless it ran in another (non-forked) process
+            self.load_maz_pairs().copy_to_buffers(shared_data_buffers, MAZ_PAIRS_BUFFER_TAG)
+
         if self.zone_system == THREE_ZONE:
             assert self.tvpb is not None
 
@@ -436,7 +598,11 @@ class Network_LOS(object):
                 # when singleprocess, this call is made (later in program flow) in the initialize_los step
                 self.tvpb.tap_cache.cleanup()
 
-            self.tvpb.tap_cache.load_data_to_buffer(shared_data_buffers[self.tvpb.tap_cache.cache_tag])
+            if self.tvpb.tap_cache.is_dynamic:
+                # create dynamic cache files before subprocesses race to open them
+                self.tvpb.tap_cache.create_dynamic_cache()
+            else:
+                self.tvpb.tap_cache.load_data_to_buffer(shared_data_buffers[self.tvpb.tap_cache.cache_tag])
 
     def allocate_shared_skim_buffers(self):
         """
@@ -447,6 +613,7 @@ class Network_LOS(object):
         to be shared with subprocesses.
 
         Note: we are only allocating storage, but not loading any skim data into it
+        (except for the maz_to_maz pairs, which have to be loaded anyway to size their buffers)
 
         Returns
         -------
@@ -463,13 +630,42 @@ class Network_LOS(object):
                 skim_buffers[skim_tag] = \
                     self.skim_dict_factory.allocate_skim_buffer(self.skims_info[skim_tag], shared=True)
 
+        if self.zone_system in [TWO_ZONE, THREE_ZONE]:
+            # buffers are sized to fit maz_to_maz pairs, so we have to load them here, and we copy them
+            # into the buffers while we have them, rather than loading them again in load_shared_data
+            pairs = self.load_maz_pairs()
+            maz_pairs_buffers = pairs.allocate_shared_buffers(MAZ_PAIRS_BUFFER_TAG)
+            pairs.copy_to_buffers(maz_pairs_buffers, MAZ_PAIRS_BUFFER_TAG)
+            del pairs
+            skim_buffers.update(maz_pairs_buffers)
+            self.maz_pairs_in_shared_buffers = True
+
         if self.zone_system == THREE_ZONE:
             assert self.tvpb is not None
-            skim_buffers[self.tvpb.tap_cache.cache_tag] = \
-                self.tvpb.tap_cache.allocate_data_buffer(shared=True)
+            # dynamic tap_cache processes share memmapped cache files rather than a shared buffer
+            if not self.tvpb.tap_cache.is_dynamic:
+                skim_buffers[self.tvpb.tap_cache.cache_tag] = \
+                    self.tvpb.tap_cache.allocate_data_buffer(shared=True)
+                skim_buffers[self.tvpb.tap_cache.progress_tag] = \
+                    self.tvpb.tap_cache.allocate_progress_buffer()
 
         return skim_buffers
 
+    def release_shared_skim_buffers(self, skim_buffers):
+        """
+        Free shared skim buffers allocated by allocate_shared_skim_buffers, if skim_dict_factory requires it
+        (e.g. SharedMemorySkimFactory shared memory segments must be explicitly unlinked by the owning process)
+
+        Parameters
+        ----------
+        skim_buffers: dict of shared data buffers keyed by skim_tag
+        """
+
+        if self.skim_dict_factory.supports_shared_data_for_multiprocessing:
+            for skim_tag in self.skims_info.keys():
+                if skim_tag in skim_buffers:
+                    self.skim_dict_factory.release_skim_buffer(skim_buffers[skim_tag])
+
     def get_skim_dict(self, skim_tag):
         """
         Get SkimDict for the specified skim_tag (e.g. 'taz', 'maz', or 'tap')
@@ -498,30 +694,20 @@ class Network_LOS(object):
 
     def get_mazpairs(self, omaz, dmaz, attribute):
         """
-        look up attribute values of maz od pairs in sparse maz_to_maz df
+        look up attribute values of maz od pairs in sparse maz_to_maz pairs
 
         Parameters
         ----------
         omaz: array-like list of omaz zone_ids
         dmaz: array-like list of omaz zone_ids
-        attribute: str name of attribute column in maz_to_maz_df
+        attribute: str name of attribute column in maz_to_maz tables
 
         Returns
         -------
         Numpy.ndarray: list of attribute values for od pairs
         """
 
-        # # this is slower
-        # s = pd.merge(pd.DataFrame({'OMAZ': omaz, 'DMAZ': dmaz}),
-        #              self.maz_to_maz_df,
-        #              how="left")[attribute]
-
-        # synthetic index method i : omaz_dmaz
-        i = np.asanyarray(omaz) * self.maz_ceiling + np.asanyarray(dmaz)
-        s = util.quick_loc_df(i, self.maz_to_maz_df, attribute)
-
-        # FIXME - no point in returning series?
-        return np.asanyarray(s)
+        return self.maz_pairs.lookup(omaz, dmaz, attribute)
 
     def get_tappairs3d(self, otap, dtap, dim3, key):
         """
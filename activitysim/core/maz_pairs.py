@@ -0,0 +1,299 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+import logging
+import multiprocessing
+import os
+
+import numba
+import numpy as np
+import pandas as pd
+
+from activitysim.core import util
+
+logger = logging.getLogger(__name__)
+
+ROW_PTR_DTYPE_NAME = 'int64'
+DMAZ_DTYPE_NAME = 'int32'
+
+# RawArray typecodes for shared buffers
+TYPECODES = {
+    'int64': 'q',
+    'int32': 'i',
+    'float32': 'f',
+    'float64': 'd',
+}
+
+BUFFER_TAGS = ['row_ptr', 'dmaz', 'data']
+
+
+@numba.njit(nogil=True)
+def _lookup_csr(row_ptr, dmaz, values, omaz_ids, dmaz_ids, result):
+    """
+    binary search for each omaz_ids, dmaz_ids pair in the (sorted) dmaz slice of its omaz row,
+    setting result to the corresponding value if found (result should be prefilled with nan)
+    """
+    num_rows = row_ptr.shape[0] - 1
+    for i in range(omaz_ids.shape[0]):
+        o = omaz_ids[i]
+        if o < 0 or o >= num_rows:
+            continue
+        d = dmaz_ids[i]
+        lo = row_ptr[o]
+        end = row_ptr[o + 1]
+        hi = end
+        while lo < hi:
+            mid = (lo + hi) >> 1
+            if dmaz[mid] < d:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < end and dmaz[lo] == d:
+            result[i] = values[lo]
+
+
+class MazPairs(object):
+    """
+    Sparse maz_to_maz od pair attributes (for MazSkimDict sparse skims) in compressed sparse row (CSR) layout
+
+    ::
+
+      row_ptr: int64 ndarray      # length max OMAZ zone_id + 2, pairs with origin o are at [row_ptr[o]:row_ptr[o+1]]
+      dmaz: int32 ndarray         # DMAZ zone_id of each pair, sorted within each OMAZ row
+      data: float ndarray         # attribute values, shape (num_attributes, num_pairs), nan if pair not in table
+      columns: list of str        # attribute names, in data row order
+
+    Compared to a DataFrame indexed by a synthetic OMAZ * maz_ceiling + DMAZ int64 index, this uses
+    4 bytes (rather than 8) of index per pair plus 8 bytes per OMAZ, lookups are a binary search within
+    the (short) destination list of the origin rather than a hash table probe, and the arrays can be
+    wrapped around shared memory buffers or memory mapped from the los cache without copying.
+    """
+
+    def __init__(self, row_ptr, dmaz, data, columns):
+
+        assert row_ptr.ndim == 1 and dmaz.ndim == 1
+        assert data.shape == (len(columns), len(dmaz)), \
+            f"MazPairs data shape {data.shape} expected {(len(columns), len(dmaz))}"
+        assert row_ptr[-1] == len(dmaz)
+
+        self.row_ptr = row_ptr
+        self.dmaz = dmaz
+        self.data = data
+        self.columns = list(columns)
+        self._column_index = {c: i for i, c in enumerate(self.columns)}
+
+    @property
+    def num_pairs(self):
+        return len(self.dmaz)
+
+    @property
+    def nbytes(self):
+        return self.row_ptr.nbytes + self.dmaz.nbytes + self.data.nbytes
+
+    @classmethod
+    def from_tables(cls, tables, dtype_name):
+        """
+        Build MazPairs from one or more maz_to_maz DataFrames
+
+        Tables may have different (sets of) od pairs, attributes of pairs missing from a table are nan.
+
+        Parameters
+        ----------
+        tables: dict of DataFrame keyed by table name, each with OMAZ, DMAZ and attribute columns
+        dtype_name: str
+            dtype to coerce attribute values to (e.g. skim_dtype_name 'float32')
+
+        Returns
+        -------
+        MazPairs
+        """
+
+        columns = []
+        for table_name, df in tables.items():
+            assert 'OMAZ' in df and 'DMAZ' in df, f"maz_to_maz table {table_name} missing OMAZ or DMAZ column"
+            for c in df.columns:
+                if c in ['OMAZ', 'DMAZ']:
+                    continue
+                if c in columns:
+                    raise RuntimeError(f"maz_to_maz attribute '{c}' in {table_name} already in another table")
+                columns.append(c)
+
+        maz_ceiling = max(max(df.OMAZ.max(), df.DMAZ.max()) for df in tables.values()) + 1
+
+        # synthetic keys sort by OMAZ and then DMAZ
+        table_keys = {}
+        for table_name, df in tables.items():
+            keys = df.OMAZ.values.astype(np.int64) * maz_ceiling + df.DMAZ.values
+            if len(np.unique(keys)) != len(keys):
+                raise RuntimeError(f"maz_to_maz table {table_name} has duplicate OMAZ, DMAZ pairs")
+            table_keys[table_name] = keys
+
+        pair_keys = np.unique(np.concatenate(list(table_keys.values())))
+        omaz = pair_keys // maz_ceiling
+        dmaz = (pair_keys % maz_ceiling).astype(DMAZ_DTYPE_NAME)
+
+        row_ptr = np.zeros(omaz[-1] + 2 if len(omaz) else 1, dtype=ROW_PTR_DTYPE_NAME)
+        np.cumsum(np.bincount(omaz, minlength=len(row_ptr) - 1), out=row_ptr[1:])
+
+        data = np.full((len(columns), len(pair_keys)), np.nan, dtype=np.dtype(dtype_name))
+        for table_name, df in tables.items():
+            positions = np.searchsorted(pair_keys, table_keys[table_name])
+            for c in df.columns:
+                if c not in ['OMAZ', 'DMAZ']:
+                    data[columns.index(c), positions] = df[c].values
+
+        return cls(row_ptr, dmaz, data, columns)
+
+    def lookup(self, omaz, dmaz, attribute):
+        """
+        look up attribute values of od pairs
+
+        Parameters
+        ----------
+        omaz: array-like list of omaz zone_ids
+        dmaz: array-like list of dmaz zone_ids
+        attribute: str name of attribute column
+
+        Returns
+        -------
+        numpy.ndarray of attribute values for od pairs (nan for pairs not in maz_to_maz tables)
+        """
+
+        if attribute not in self._column_index:
+            raise KeyError(f"'{attribute}' not in maz_to_maz attributes {self.columns}")
+
+        omaz = np.asanyarray(omaz).astype(np.int64, copy=False)
+        dmaz = np.asanyarray(dmaz).astype(np.int64, copy=False)
+        assert omaz.shape == dmaz.shape
+
+        values = self.data[self._column_index[attribute]]
+        result = np.full(len(omaz), np.nan, dtype=values.dtype)
+        _lookup_csr(self.row_ptr, self.dmaz, values, omaz, dmaz, result)
+
+        return result
+
+    def to_frame(self):
+        """
+        Return pairs as DataFrame with OMAZ, DMAZ and attribute columns (e.g. for tracing)
+        """
+        omaz = np.repeat(np.arange(len(self.row_ptr) - 1), np.diff(self.row_ptr))
+        df = pd.DataFrame(self.data.T, columns=self.columns)
+        df.insert(0, 'DMAZ', self.dmaz)
+        df.insert(0, 'OMAZ', omaz)
+        return df
+
+    def arrays(self):
+        return dict(zip(BUFFER_TAGS, [self.row_ptr, self.dmaz, self.data]))
+
+    def allocate_shared_buffers(self, buffer_tag_prefix):
+        """
+        Allocate multiprocessing.RawArray buffers sized to hold row_ptr, dmaz and data arrays
+
+        Returns
+        -------
+        dict of multiprocessing.RawArray keyed by f"{buffer_tag_prefix}_{array_tag}"
+        """
+        buffers = {}
+        for tag, a in self.arrays().items():
+            typecode = TYPECODES.get(a.dtype.name)
+            if typecode is None:
+                raise RuntimeError(f"MazPairs.allocate_shared_buffers unsupported dtype {a.dtype.name}")
+            # multiprocessing.RawArray argument size_or_initializer must be int, not np.int64
+            buffers[f"{buffer_tag_prefix}_{tag}"] = multiprocessing.RawArray(typecode, int(a.size))
+
+        logger.info(f"MazPairs.allocate_shared_buffers allocated {util.GB(self.nbytes)} "
+                    f"for {util.INT(self.num_pairs)} maz_to_maz pairs")
+
+        return buffers
+
+    def copy_to_buffers(self, buffers, buffer_tag_prefix):
+        """
+        Copy arrays into buffers allocated by allocate_shared_buffers
+        """
+        for tag, a in self.arrays().items():
+            buffer_data = np.ctypeslib.as_array(buffers[f"{buffer_tag_prefix}_{tag}"])
+            assert buffer_data.size == a.size and buffer_data.dtype == a.dtype, \
+                f"MazPairs.copy_to_buffers {tag} buffer ({buffer_data.dtype} {buffer_data.size}) " \
+                f"does not match array ({a.dtype} {a.size})"
+            np.copyto(buffer_data, a.reshape(-1))
+
+    @classmethod
+    def from_buffers(cls, buffers, buffer_tag_prefix, columns):
+        """
+        Wrap (without copying) shared buffers loaded by copy_to_buffers
+
+        Parameters
+        ----------
+        buffers: dict of multiprocessing.RawArray (e.g. data_buffers injectable)
+        buffer_tag_prefix: str
+        columns: list of str attribute names, in same order as in MazPairs that was copied to buffers
+
+        Returns
+        -------
+        MazPairs
+        """
+        row_ptr, dmaz, data = [np.ctypeslib.as_array(buffers[f"{buffer_tag_prefix}_{tag}"]) for tag in BUFFER_TAGS]
+        data = data.reshape(len(columns), -1)
+        return cls(row_ptr, dmaz, data, columns)
+
+    @staticmethod
+    def has_buffers(buffers, buffer_tag_prefix):
+        return buffers is not None and all(f"{buffer_tag_prefix}_{tag}" in buffers for tag in BUFFER_TAGS)
+
+    def write(self, cache_path):
+        """
+        write arrays to .npy files (and attribute names to columns.txt) in cache_path directory
+
+        Files are written to a temp directory that is then renamed, so concurrent readers never see
+        a partially written cache.
+        """
+
+        temp_path = f"{cache_path}.{os.getpid()}.tmp"
+        os.makedirs(temp_path, exist_ok=True)
+        for tag, a in self.arrays().items():
+            np.save(os.path.join(temp_path, f"{tag}.npy"), a)
+        with open(os.path.join(temp_path, 'columns.txt'), 'w') as f:
+            f.write('\n'.join(self.columns))
+
+        try:
+            os.replace(temp_path, cache_path)
+        except OSError:
+            # another process got there first (rename does not replace non-empty directories)
+            for file_name in os.listdir(temp_path):
+                os.unlink(os.path.join(temp_path, file_name))
+            os.rmdir(temp_path)
+
+        logger.info(f"MazPairs wrote {util.INT(self.num_pairs)} maz_to_maz pairs to {cache_path}")
+
+    @classmethod
+    def read(cls, cache_path):
+        """
+        memory map MazPairs arrays from cache_path directory written by write
+
+        Returns
+        -------
+        MazPairs or None if cache not found
+        """
+
+        if not os.path.isdir(cache_path):
+            return None
+
+        with open(os.path.join(cache_path, 'columns.txt')) as f:
+            columns = f.read().split('\n')
+
+        row_ptr, dmaz, data = [np.load(os.path.join(cache_path, f"{tag}.npy"), mmap_mode='r') for tag in BUFFER_TAGS]
+
+        logger.info(f"MazPairs read {util.INT(len(dmaz))} maz_to_maz pairs from {cache_path}")
+
+        return cls(row_ptr, dmaz, data, columns)
+
+
+def read_csv_columns(file_paths):
+    """
+    Return list of attribute names (in MazPairs.from_tables order) from maz_to_maz table csv headers
+    """
+    columns = []
+    for file_path in file_paths:
+        header = pd.read_csv(file_path, nrows=0).columns
+        columns.extend([c for c in header if c not in ['OMAZ', 'DMAZ']])
+    return columns
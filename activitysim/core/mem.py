@@ -13,6 +13,7 @@ import platform
 import psutil
 import threading
 import time
+from multiprocessing import shared_memory
 
 import numpy as np
 import pandas as pd
@@ -254,6 +255,9 @@ def shared_memory_size(data_buffers=None):
         data_buffers = inject.get_injectable('data_buffers', {})
 
     for k, data_buffer in data_buffers.items():
+        if isinstance(data_buffer, shared_memory.SharedMemory):
+            shared_size += data_buffer.size
+            continue
         try:
             obj = data_buffer.get_obj()
         except Exception:
@@ -3,8 +3,10 @@
 import sys
 import os
 import time
+import datetime as dt
 import logging
 import multiprocessing
+import multiprocessing.connection
 import traceback
 
 from collections import OrderedDict
@@ -17,6 +19,7 @@ from activitysim.core import config
 from activitysim.core import inject
 from activitysim.core import mem
 from activitysim.core import pipeline
+from activitysim.core import pipeline_store
 from activitysim.core import tracing
 from activitysim.core import util
 
@@ -137,7 +140,9 @@ either of their indexes, should also be considered a dependent table.
 The num_processes setting of 2 indicates that the pipeline should be split in two, and half of the
 households should be apportioned into each subprocess pipeline, and all dependent tables should
 likewise be apportioned accordingly. All other tables (e.g. land_use) that do share an index (name)
-or have a ref_col should be considered mirrored and be included in their entirety.
+or have a ref_col should be considered mirrored and be included in their entirety. (Rather than being
+copied to every subprocess pipeline, mirrored tables are read by the subprocesses from the parent
+pipeline, which is not written to until the subprocess pipelines are coalesced.)
 
 The primary table is sliced by num_processes-sized strides. (e.g. for num_processes == 2, the
 sub-processes get every second record starting at offsets 0 and 1 respectively. All other dependent
@@ -154,6 +159,29 @@ previously primary tables or are mirrored. Thus we can coalesce the sub-process
 concatenating the primary and dependent tables and simply retaining any copy of the mirrored tables
 (since they should all be identical.)
 
+Statically apportioned sub-processes can finish at quite different times (e.g. because of skewed
+household sizes or zone-dependent model costs) leaving their cores idle until the slowest one is done.
+A step with an optional num_work_units setting (greater than num_processes) is instead scheduled
+dynamically: the primary table is sliced into num_work_units strides (work units) each with its own
+apportioned pipeline, the names of the work units are put in a shared queue, and each of the
+num_processes sub-processes runs the step models on work units pulled from the queue until it is empty.
+The work unit pipelines are then coalesced just like sub-process pipelines. Results are the same as
+with static apportionment because random number streams are specific to the rows of the channel tables
+(households, persons, tours, etc.) rather than to the sub-process that happens to run them. Since work
+units are run one after another, steps with models that synchronize across sub-processes (i.e. shadow
+priced location choice models) can not be scheduled dynamically.
+
+::
+
+      - name: mp_households
+        begin: cdap_simulate
+        num_processes: 4
+        num_work_units: 40
+        slice:
+          tables:
+            - households
+            - persons
+
 The third multiprocess_step (mp_summarize) then is handled in single-process mode and runs the
 write_tables model, writing the results, but also leaving the tables in the pipeline, with
 essentially the same tables and results as if the whole simulation had been run as a single process.
@@ -263,7 +291,7 @@ def pipeline_table_keys(pipeline_store):
     return dict of current (as of last checkpoint) pipeline tables
     and their checkpoint-specific hdf5_keys
 
-    This facilitates reading pipeline tables directly from a 'raw' open pandas.HDFStore without
+    This facilitates reading pipeline tables directly from a 'raw' open pipeline store without
     opening it as a pipeline (e.g. when apportioning and coalescing pipelines)
 
     We currently only ever need to do this from the last checkpoint, so the ability to specify
@@ -271,7 +299,7 @@ def pipeline_table_keys(pipeline_store):
 
     Parameters
     ----------
-    pipeline_store : open hdf5 pipeline_store
+    pipeline_store : open pipeline_store (pandas.HDFStore or pipeline_store.ParquetPipelineStore)
 
     Returns
     -------
@@ -307,6 +335,90 @@ def pipeline_table_keys(pipeline_store):
     return checkpoint_name, checkpoint_tables
 
 
+def slice_table_order(slice_info, table_names):
+    """
+    Return list of table_names in the order they should be sliced (or coalesced)
+
+    tables listed in slice_info must come first (in slice_info order) since the slice rules of
+    the other tables cascade from theirs.
+    """
+
+    slicer_table_names = slice_info['tables']
+    primary_slicer = slicer_table_names[0]
+
+    ordered_table_names = list(slicer_table_names) + [t for t in table_names if t not in slicer_table_names]
+
+    if primary_slicer not in table_names:
+        raise RuntimeError("primary slice table '%s' not in pipeline" % primary_slicer)
+
+    return ordered_table_names
+
+
+def slice_table_exceptions(slice_info, table_names):
+    """
+    Return list of names of tables that should not be sliced, expanding slice_info 'except' wildcards
+    """
+
+    slicer_table_names = slice_info['tables']
+    slicer_table_exceptions = slice_info.get('except', [])
+
+    # allow wildcard 'True' to avoid slicing (or coalescing) any tables no explicitly listed in slice_info.tables
+    # populationsim uses slice.except wildcards to avoid listing control tables (etc) that should not be sliced,
+    # followed by a slice.coalesce directive to explicitly list the omnibus tables created by the subprocesses.
+    # So don't change this behavior withoyt testing populationsim multiprocess!
+    if slicer_table_exceptions is True:
+        debug(f"slice.except wildcard (True): excluding all tables not explicitly listed in slice.tables")
+        slicer_table_exceptions = [t for t in table_names if t not in slicer_table_names]
+
+    if slicer_table_exceptions == '*':
+        slicer_table_exceptions = [t for t in table_names if t not in slicer_table_names]
+
+    return slicer_table_exceptions
+
+
+def table_slice_rule(slice_info, table_name, df, slicer_table_exceptions, slicer_ref_cols):
+    """
+    Return slice rule for a single table (see build_slice_rules)
+
+    slice rules cascade, so tables must be passed in slice_table_order, with the same slicer_ref_cols
+    OrderedDict (mapping sliced table names to their index names) which is updated if table is sliced.
+
+    Only the index name and columns of df are used, so it needn't have any rows.
+    """
+
+    primary_slicer = slice_info['tables'][0]
+
+    rule = {}
+    if table_name == primary_slicer:
+        # slice primary apportion table
+        rule = {'slice_by': 'primary'}
+    elif table_name in slicer_table_exceptions:
+        rule['slice_by'] = None
+    else:
+        for slicer_table_name in slicer_ref_cols:
+            if df.index.name is not None and (df.index.name == slicer_ref_cols[slicer_table_name]):
+                # slice df with same index name as a known slicer
+                rule = {'slice_by': 'index', 'source': slicer_table_name}
+            else:
+                # if df has a column with same name as the ref_col (index) of a slicer?
+                try:
+                    source, ref_col = next((t, c)
+                                           for t, c in slicer_ref_cols.items()
+                                           if c in df.columns)
+                    # then we can use that table to slice this df
+                    rule = {'slice_by': 'column',
+                            'column': ref_col,
+                            'source': source}
+                except StopIteration:
+                    rule['slice_by'] = None
+
+    if rule['slice_by']:
+        # cascade sliceability
+        slicer_ref_cols[table_name] = df.index.name
+
+    return rule
+
+
 def build_slice_rules(slice_info, pipeline_tables):
     """
     based on slice_info for current step from run_list, generate a recipe for slicing
@@ -386,67 +498,21 @@ def build_slice_rules(slice_info, pipeline_tables):
     slice_rules : dict
     """
 
-    slicer_table_names = slice_info['tables']
-    slicer_table_exceptions = slice_info.get('except', [])
-    primary_slicer = slicer_table_names[0]
-
     # - ensure that tables listed in slice_info appear in correct order and before any others
-    tables = OrderedDict([(table_name, None) for table_name in slicer_table_names])
-
-    for table_name in pipeline_tables.keys():
-        tables[table_name] = pipeline_tables[table_name]
-
-    if primary_slicer not in tables:
-        raise RuntimeError("primary slice table '%s' not in pipeline" % primary_slicer)
+    tables = OrderedDict([(table_name, pipeline_tables.get(table_name))
+                          for table_name in slice_table_order(slice_info, pipeline_tables.keys())])
 
-    # allow wildcard 'True' to avoid slicing (or coalescing) any tables no explicitly listed in slice_info.tables
-    # populationsim uses slice.except wildcards to avoid listing control tables (etc) that should not be sliced,
-    # followed by a slice.coalesce directive to explicitly list the omnibus tables created by the subprocesses.
-    # So don't change this behavior withoyt testing populationsim multiprocess!
-    if slicer_table_exceptions is True:
-        debug(f"slice.except wildcard (True): excluding all tables not explicitly listed in slice.tables")
-        slicer_table_exceptions = [t for t in tables if t not in slicer_table_names]
+    slicer_table_exceptions = slice_table_exceptions(slice_info, tables.keys())
 
     # dict mapping slicer table_name to index name
     # (also presumed to be name of ref col name in referencing table)
     slicer_ref_cols = OrderedDict()
 
-    if slicer_table_exceptions == '*':
-        slicer_table_exceptions = [t for t in tables if t not in slicer_table_names]
-
     # build slice rules for loaded tables
     slice_rules = OrderedDict()
     for table_name, df in tables.items():
-
-        rule = {}
-        if table_name == primary_slicer:
-            # slice primary apportion table
-            rule = {'slice_by': 'primary'}
-        elif table_name in slicer_table_exceptions:
-            rule['slice_by'] = None
-        else:
-            for slicer_table_name in slicer_ref_cols:
-                if df.index.name is not None and (df.index.name == tables[slicer_table_name].index.name):
-                    # slice df with same index name as a known slicer
-                    rule = {'slice_by': 'index', 'source': slicer_table_name}
-                else:
-                    # if df has a column with same name as the ref_col (index) of a slicer?
-                    try:
-                        source, ref_col = next((t, c)
-                                               for t, c in slicer_ref_cols.items()
-                                               if c in df.columns)
-                        # then we can use that table to slice this df
-                        rule = {'slice_by': 'column',
-                                'column': ref_col,
-                                'source': source}
-                    except StopIteration:
-                        rule['slice_by'] = None
-
-        if rule['slice_by']:
-            # cascade sliceability
-            slicer_ref_cols[table_name] = df.index.name
-
-        slice_rules[table_name] = rule
+        slice_rules[table_name] = \
+            table_slice_rule(slice_info, table_name, df, slicer_table_exceptions, slicer_ref_cols)
 
     for table_name, rule in slice_rules.items():
         if rule['slice_by'] is not None:
@@ -456,6 +522,35 @@ def build_slice_rules(slice_info, pipeline_tables):
     return slice_rules
 
 
+def truncate_checkpoints(store, checkpoint_name):
+    """
+    Drop any checkpoints after checkpoint_name from the checkpoints table of a 'raw' open pipeline store
+    (as pipeline.load_checkpoint does when a pipeline is opened to resume after checkpoint_name)
+
+    Parameters
+    ----------
+    store : open pipeline_store (pandas.HDFStore or pipeline_store.ParquetPipelineStore)
+    checkpoint_name : str
+
+    Returns
+    -------
+    checkpoints : pandas.DataFrame
+        truncated checkpoints table
+    """
+
+    checkpoints = store[pipeline.CHECKPOINT_TABLE_NAME]
+
+    i = checkpoints.index[checkpoints[pipeline.CHECKPOINT_NAME] == checkpoint_name]
+    if len(i) == 0:
+        raise RuntimeError(f"Couldn't find checkpoint '{checkpoint_name}' in checkpoints")
+
+    if i[0] != checkpoints.index[-1]:
+        checkpoints = checkpoints.loc[:i[0]]
+        store[pipeline.CHECKPOINT_TABLE_NAME] = checkpoints
+
+    return checkpoints
+
+
 def apportion_pipeline(sub_proc_names, step_info):
     """
     apportion pipeline for multiprocessing step
@@ -465,10 +560,15 @@ def apportion_pipeline(sub_proc_names, step_info):
     Called at the beginning of a multiprocess step prior to launching the sub-processes
     Pipeline files have well known names (pipeline file name prefixed by subjob name)
 
+    Tables are read (without opening the pipeline) one at a time, and their slices are written to
+    the sub_proc pipelines before the next table is read, retaining only the sliced indexes needed to
+    cascade slicing to dependent tables. Mirrored tables are not copied to the sub_proc pipelines,
+    which instead read them from the (read-only) parent pipeline (see pipeline.read_mirrored_tables)
+
     Parameters
     ----------
     sub_proc_names : list of str
-        names of the sub processes to apportion
+        names of the sub processes (or work units if step is dynamically scheduled) to apportion
     step_info : dict
         step_info from multiprocess_steps for step we are apportioning pipeline tables for
 
@@ -481,72 +581,73 @@ def apportion_pipeline(sub_proc_names, step_info):
     multiprocess_step_name = step_info.get('name', None)
 
     pipeline_file_name = inject.get_injectable('pipeline_file_name')
+    pipeline_path = config.pipeline_file_path(pipeline_file_name)
 
     # ensure that if we are resuming, we don't apportion any tables from future model steps
     last_checkpoint_in_previous_multiprocess_step = step_info.get('last_checkpoint_in_previous_multiprocess_step', None)
     assert last_checkpoint_in_previous_multiprocess_step is not None
-    pipeline.open_pipeline(resume_after=last_checkpoint_in_previous_multiprocess_step)
 
-    # ensure all tables are in the pipeline
-    checkpointed_tables = pipeline.checkpointed_tables()
-    for table_name in slice_info['tables']:
-        if table_name not in checkpointed_tables:
-            raise RuntimeError(f"slicer table {table_name} not found in pipeline")
+    # use well-known pipeline file names
+    num_sub_procs = len(sub_proc_names)
+    sub_proc_paths = [config.build_output_file_path(pipeline_file_name, use_prefix=process_name)
+                      for process_name in sub_proc_names]
 
-    checkpoints_df = pipeline.get_checkpoints()
+    # remove existing files
+    for sub_proc_path in sub_proc_paths:
+        pipeline_store.delete_store(sub_proc_path)
 
-    # for the subprocess pipelines, keep only the last row of checkpoints and patch the last checkpoint name
-    checkpoints_df = checkpoints_df.tail(1).copy()
+    with pipeline_store.open_store(pipeline_path, mode='a') as store:
 
-    # load all tables from pipeline
-    checkpoint_name = multiprocess_step_name
-    tables = {}
-    for table_name in checkpointed_tables:
-        # patch last checkpoint name for all tables
-        checkpoints_df[table_name] = checkpoint_name
-        # load the dataframe
-        tables[table_name] = pipeline.get_table(table_name)
+        checkpoints_df = truncate_checkpoints(store, last_checkpoint_in_previous_multiprocess_step)
 
-        debug(f"loaded table {table_name} {tables[table_name].shape}")
+        # hdf5_keys is a dict mapping table_name to pipeline hdf5_key
+        _, hdf5_keys = pipeline_table_keys(store)
 
-    pipeline.close_pipeline()
+        # ensure all tables are in the pipeline
+        for table_name in slice_info['tables']:
+            if table_name not in hdf5_keys:
+                raise RuntimeError(f"slicer table {table_name} not found in pipeline")
 
-    # should only be one checkpoint (named <multiprocess_step_name>)
-    assert len(checkpoints_df) == 1
+        # for the subprocess pipelines, keep only the last row of checkpoints and patch the last checkpoint name
+        checkpoint_name = multiprocess_step_name
+        checkpoints_df = checkpoints_df.tail(1).copy()
+        checkpoints_df = checkpoints_df[pipeline.NON_TABLE_COLUMNS +
+                                        [c for c in checkpoints_df.columns if c not in pipeline.NON_TABLE_COLUMNS]]
+        for table_name in hdf5_keys:
+            checkpoints_df[table_name] = checkpoint_name
 
-    # - build slice rules for loaded tables
-    slice_rules = build_slice_rules(slice_info, tables)
+        # should only be one checkpoint (named <multiprocess_step_name>)
+        assert len(checkpoints_df) == 1
 
-    # - allocate sliced tables for each sub_proc
-    num_sub_procs = len(sub_proc_names)
-    for i in range(num_sub_procs):
+        table_names = slice_table_order(slice_info, hdf5_keys.keys())
+        slicer_table_exceptions = slice_table_exceptions(slice_info, table_names)
+        slicer_ref_cols = OrderedDict()
 
-        # use well-known pipeline file name
-        process_name = sub_proc_names[i]
-        pipeline_path = config.build_output_file_path(pipeline_file_name, use_prefix=process_name)
+        # remember sliced indexes so we can cascade slicing to other tables
+        sliced_indexes = {}
 
-        # remove existing file
-        try:
-            os.unlink(pipeline_path)
-        except OSError:
-            pass
-
-        with pd.HDFStore(pipeline_path, mode='a') as pipeline_store:
+        # {<sub_proc table_key>: (<pipeline_path>, <table_key>)} of mirrored tables
+        mirrored_tables = {}
 
-            # remember sliced_tables so we can cascade slicing to other tables
-            sliced_tables = {}
+        sub_proc_stores = [pipeline_store.open_store(sub_proc_path, mode='a') for sub_proc_path in sub_proc_paths]
 
+        try:
             # - for each table in pipeline
-            for table_name, rule in slice_rules.items():
+            for table_name in table_names:
 
-                df = tables[table_name]
+                df = pipeline.read_store_table(store, hdf5_keys[table_name])
+                debug(f"loaded table {table_name} {df.shape}")
+
+                rule = table_slice_rule(slice_info, table_name, df, slicer_table_exceptions, slicer_ref_cols)
+
+                hdf5_key = pipeline.pipeline_table_key(table_name, checkpoint_name)
 
                 if rule['slice_by'] is not None and num_sub_procs > len(df):
 
                     # almost certainly a configuration error
                     raise RuntimeError(f"apportion_pipeline: multiprocess step {multiprocess_step_name} "
                                        f"slice table {table_name} has fewer rows {df.shape} "
-                                       f"than num_processes ({num_sub_procs}).")
+                                       f"than num_processes or num_work_units ({num_sub_procs}).")
 
                 if rule['slice_by'] == 'primary':
                     # slice primary apportion table by num_sub_procs strides
@@ -557,30 +658,43 @@ def apportion_pipeline(sub_proc_names, step_info):
                     # we could easily work around this, but it seems likely this was an error on the user's part
                     assert not df.index.duplicated().any()
 
-                    primary_df = df[np.asanyarray(list(range(df.shape[0]))) % num_sub_procs == i]
-                    sliced_tables[table_name] = primary_df
+                    strides = np.arange(df.shape[0]) % num_sub_procs
+                    sliced_dfs = [df[strides == i] for i in range(num_sub_procs)]
                 elif rule['slice_by'] == 'index':
                     # slice a table with same index name as a known slicer
-                    source_df = sliced_tables[rule['source']]
-                    sliced_tables[table_name] = df.loc[source_df.index]
+                    sliced_dfs = [df.loc[source_index] for source_index in sliced_indexes[rule['source']]]
                 elif rule['slice_by'] == 'column':
                     # slice a table with a recognized slicer_column
-                    source_df = sliced_tables[rule['source']]
-                    sliced_tables[table_name] = df[df[rule['column']].isin(source_df.index)]
+                    sliced_dfs = [df[df[rule['column']].isin(source_index)]
+                                  for source_index in sliced_indexes[rule['source']]]
                 elif rule['slice_by'] is None:
-                    # don't slice mirrored tables
-                    sliced_tables[table_name] = df
+                    # don't slice (or copy) mirrored tables
+                    mirrored_tables[hdf5_key] = (pipeline_path, hdf5_keys[table_name])
+                    continue
                 else:
                     raise RuntimeError("Unrecognized slice rule '%s' for table %s" %
                                        (rule['slice_by'], table_name))
 
-                # - write table to pipeline
-                hdf5_key = pipeline.pipeline_table_key(table_name, checkpoint_name)
-                pipeline_store[hdf5_key] = sliced_tables[table_name]
+                # - write table slices to sub_proc pipelines
+                for sub_proc_store, sliced_df in zip(sub_proc_stores, sliced_dfs):
+                    sub_proc_store[hdf5_key] = sliced_df
+
+                sliced_indexes[table_name] = [sliced_df.index for sliced_df in sliced_dfs]
+
+            for sub_proc_path, sub_proc_store in zip(sub_proc_paths, sub_proc_stores):
 
-            debug(f"writing checkpoints ({checkpoints_df.shape}) "
-                  f"to {pipeline.CHECKPOINT_TABLE_NAME} in {pipeline_path}")
-            pipeline_store[pipeline.CHECKPOINT_TABLE_NAME] = checkpoints_df
+                if mirrored_tables:
+                    debug(f"writing {len(mirrored_tables)} mirrored tables to "
+                          f"{pipeline.MIRRORED_TABLE_NAME} in {sub_proc_path}")
+                    pipeline.write_mirrored_tables(sub_proc_store, mirrored_tables)
+
+                debug(f"writing checkpoints ({checkpoints_df.shape}) "
+                      f"to {pipeline.CHECKPOINT_TABLE_NAME} in {sub_proc_path}")
+                sub_proc_store[pipeline.CHECKPOINT_TABLE_NAME] = checkpoints_df
+
+        finally:
+            for sub_proc_store in sub_proc_stores:
+                sub_proc_store.close()
 
 
 def coalesce_pipelines(sub_proc_names, slice_info):
@@ -592,6 +706,10 @@ def coalesce_pipelines(sub_proc_names, slice_info):
     Sliced tables are concatenated to create a single omnibus table with data from all sub_procs
     but mirrored tables are the same across all sub_procs, so we can grab a copy from any pipeline.
 
+    Tables are coalesced one at a time and written directly to the pipeline store (without opening the
+    pipeline and loading all its tables) before the next is read. Mirrored tables that the sub_procs
+    read from the parent pipeline and did not change are already there, and so are left as they are.
+
     Parameters
     ----------
     sub_proc_names : list of str
@@ -604,22 +722,22 @@ def coalesce_pipelines(sub_proc_names, slice_info):
     """
 
     pipeline_file_name = inject.get_injectable('pipeline_file_name')
+    pipeline_path = config.pipeline_file_path(pipeline_file_name)
 
     debug(f"coalesce_pipelines to: {pipeline_file_name}")
 
-    # - read all tables from first process pipeline
-    # FIXME - note: assumes any new tables will be present in ALL subprocess pipelines
-    tables = {}
-    pipeline_path = config.build_output_file_path(pipeline_file_name, use_prefix=sub_proc_names[0])
+    sub_proc_paths = [config.build_output_file_path(pipeline_file_name, use_prefix=process_name)
+                      for process_name in sub_proc_names]
 
-    with pd.HDFStore(pipeline_path, mode='r') as pipeline_store:
+    # - read table keys from first process pipeline
+    # FIXME - note: assumes any new tables will be present in ALL subprocess pipelines
+    with pipeline_store.open_store(sub_proc_paths[0], mode='r') as store:
 
         # hdf5_keys is a dict mapping table_name to pipeline hdf5_key
-        checkpoint_name, hdf5_keys = pipeline_table_keys(pipeline_store)
+        checkpoint_name, hdf5_keys = pipeline_table_keys(store)
 
-        for table_name, hdf5_key in hdf5_keys.items():
-            debug(f"loading table {table_name} {hdf5_key}")
-            tables[table_name] = pipeline_store[hdf5_key]
+        # mirrored tables read from the parent pipeline
+        mirrored_tables = pipeline.read_mirrored_tables(store)
 
     # slice.coalesce is an override  list of omnibus tables created by subprocesses that should be coalesced,
     # whether or not they satisfy the slice rules. Ordinarily all tables qualify for slicing by the slice rules
@@ -635,51 +753,99 @@ def coalesce_pipelines(sub_proc_names, slice_info):
     # report absence of any slice_info.coalesce tables not in pipeline
     # we don't require their presence in case there are tracing tables that will only be present if tracing is enabled
     for table_name in coalesce_tables:
-        if table_name not in tables:
+        if table_name not in hdf5_keys:
             logger.warning("slicer coalesce.table %s not found in pipeline" % table_name)
 
     # - use slice rules followed by apportion_pipeline to identify mirrored tables
     # (tables that are identical in every pipeline and so don't need to be concatenated)
-    slice_rules = build_slice_rules(slice_info, tables)
+    table_names = slice_table_order(slice_info, hdf5_keys.keys())
+    slicer_table_exceptions = slice_table_exceptions(slice_info, table_names)
+    slicer_ref_cols = OrderedDict()
 
-    # table is mirrored if no slice rule or explicitly listed in slice_info.coalesce setting
-    mirrored_table_names = \
-        [t for t, rule in slice_rules.items() if rule['slice_by'] is None and t not in coalesce_tables]
-    mirrored_tables = {t: tables[t] for t in mirrored_table_names}
-    omnibus_keys = {t: k for t, k in hdf5_keys.items() if t not in mirrored_table_names}
+    coalesced_table_names = []
 
-    debug(f"coalesce_pipelines to: {pipeline_file_name}")
-    debug(f"mirrored_table_names: {mirrored_table_names}")
-    debug(f"omnibus_keys: {omnibus_keys}")
-
-    # assemble lists of omnibus tables from all sub_processes
-    omnibus_tables = {table_name: [] for table_name in omnibus_keys}
-    for process_name in sub_proc_names:
-        pipeline_path = config.build_output_file_path(pipeline_file_name, use_prefix=process_name)
-        logger.info(f"coalesce pipeline {pipeline_path}")
-
-        with pd.HDFStore(pipeline_path, mode='r') as pipeline_store:
-            for table_name, hdf5_key in omnibus_keys.items():
-                omnibus_tables[table_name].append(pipeline_store[hdf5_key])
-
-    # open pipeline, preserving existing checkpoints (so resume_after will work for prior steps)
-    pipeline.open_pipeline('_')
-
-    # - add mirrored tables to pipeline
-    for table_name in mirrored_tables:
-        df = mirrored_tables[table_name]
-        info(f"adding mirrored table {table_name} {df.shape}")
-        pipeline.replace_table(table_name, df)
-
-    # - concatenate omnibus tables and add them to pipeline
-    for table_name in omnibus_tables:
-        df = pd.concat(omnibus_tables[table_name], sort=False)
-        info(f"adding omnibus table {table_name} {df.shape}")
-        pipeline.replace_table(table_name, df)
+    sub_proc_stores = [pipeline_store.open_store(sub_proc_path, mode='r') for sub_proc_path in sub_proc_paths]
 
-    pipeline.add_checkpoint(checkpoint_name)
+    try:
+        with pipeline_store.open_store(pipeline_path, mode='a') as store:
+
+            for table_name in table_names:
+
+                hdf5_key = hdf5_keys[table_name]
+
+                if hdf5_key in mirrored_tables:
+                    debug(f"mirrored table {table_name} unchanged since {mirrored_tables[hdf5_key][1]}")
+                    continue
+
+                df = pipeline.read_store_table(sub_proc_stores[0], hdf5_key)
+
+                rule = table_slice_rule(slice_info, table_name, df, slicer_table_exceptions, slicer_ref_cols)
+
+                # table is mirrored if no slice rule or explicitly listed in slice_info.coalesce setting
+                if rule['slice_by'] is None and table_name not in coalesce_tables:
+                    info(f"adding mirrored table {table_name} {df.shape}")
+                else:
+                    # - concatenate omnibus table slices from all sub_processes
+                    df = pd.concat([df] + [pipeline.read_store_table(sub_proc_store, hdf5_key)
+                                           for sub_proc_store in sub_proc_stores[1:]], sort=False)
+                    info(f"adding omnibus table {table_name} {df.shape}")
+
+                write_coalesced_table(store, df, table_name, checkpoint_name)
+                coalesced_table_names.append(table_name)
+
+            add_coalesced_checkpoint(store, checkpoint_name, coalesced_table_names)
+
+    finally:
+        for sub_proc_store in sub_proc_stores:
+            sub_proc_store.close()
+
+
+def write_coalesced_table(store, df, table_name, checkpoint_name):
+    """
+    Write table to a 'raw' open pipeline store (as pipeline.write_df would if pipeline was open)
+    """
+
+    # coerce column names to str as unicode names will cause PyTables to pickle them
+    df.columns = df.columns.astype(str)
+
+    table_key = pipeline.pipeline_table_key(table_name, checkpoint_name)
+
+    # forget any stale column map (e.g. from before we resumed) as table is written in its entirety
+    map_key = pipeline.column_map_key(table_key)
+    if map_key in store:
+        store.remove(map_key)
+
+    store[table_key] = df
 
-    pipeline.close_pipeline()
+
+def add_coalesced_checkpoint(store, checkpoint_name, table_names):
+    """
+    Append checkpoint for tables written by write_coalesced_table to checkpoints of a 'raw' open pipeline store
+    (as pipeline.add_checkpoint would if pipeline was open with those tables replaced)
+
+    Parameters
+    ----------
+    store : open pipeline_store (pandas.HDFStore or pipeline_store.ParquetPipelineStore)
+    checkpoint_name : str
+    table_names : list of str
+        names of tables written to the store at checkpoint_name
+    """
+
+    checkpoints = store[pipeline.CHECKPOINT_TABLE_NAME]
+
+    # tables not written keep their entries from the last checkpoint
+    checkpoint = checkpoints.iloc[-1].to_dict()
+    checkpoint.update({table_name: checkpoint_name for table_name in table_names})
+    checkpoint[pipeline.CHECKPOINT_NAME] = checkpoint_name
+    checkpoint[pipeline.TIMESTAMP] = dt.datetime.now()
+
+    checkpoints = pd.concat([checkpoints, pd.DataFrame([checkpoint])], ignore_index=True)
+
+    # convert empty values to str so PyTables doesn't pickle object types
+    for c in checkpoints.columns:
+        checkpoints[c] = checkpoints[c].fillna('')
+
+    store[pipeline.CHECKPOINT_TABLE_NAME] = checkpoints
 
 
 def setup_injectables_and_logging(injectables, locutor=True):
@@ -764,7 +930,7 @@ def adjust_chunk_size_for_shared_memory(chunk_size, data_buffers, num_processes)
     return adjusted_chunk_size
 
 
-def run_simulation(queue, step_info, resume_after, shared_data_buffer):
+def run_simulation(conn, step_info, resume_after, shared_data_buffer):
     """
     run step models as subtask
 
@@ -775,7 +941,8 @@ def run_simulation(queue, step_info, resume_after, shared_data_buffer):
 
     Parameters
     ----------
-    queue : multiprocessing.Queue
+    conn : multiprocessing.connection.Connection
+        send end of pipe for progress messages to parent process
     step_info : dict
         step_info for current step from multiprocess_steps
     resume_after : str or None
@@ -826,7 +993,7 @@ def run_simulation(queue, step_info, resume_after, shared_data_buffer):
             raise e
 
         tracing.log_runtime(model_name=model, start_time=t1)
-        queue.put({'model': model, 'time': time.time()-t1})
+        conn.send({'model': model, 'time': time.time()-t1})
 
     tracing.print_elapsed_time("run (%s models)" % len(models), t0)
 
@@ -837,22 +1004,69 @@ def run_simulation(queue, step_info, resume_after, shared_data_buffer):
     pipeline.close_pipeline()
 
 
+def run_work_units(conn, work_queue, step_info, resume_after, shared_data_buffer):
+    """
+    run step models on work units pulled from work_queue until it is empty
+
+    called once to run each individual sub process in a dynamically scheduled multiprocess step
+
+    Each work unit has its own apportioned pipeline (with the work unit name as pipeline file prefix)
+    so run_simulation is simply called for each work unit in turn, dropping the tables of the
+    previous work unit (but not the cached injectables such as network_los) in between.
+
+    Parameters
+    ----------
+    conn : multiprocessing.connection.Connection
+        send end of pipe for progress messages to parent process
+    work_queue : multiprocessing.Queue
+        names of work units, followed by a None sentinel for each sub process
+    step_info : dict
+        step_info for current step from multiprocess_steps
+    resume_after : str or None
+    shared_data_buffer : dict
+        dict of shared data (e.g. skims and shadow_pricing)
+    """
+
+    while True:
+
+        work_unit = work_queue.get()
+        if work_unit is None:
+            break
+
+        t0 = time.time()
+        info(f"running work unit {work_unit}")
+
+        inject.add_injectable("pipeline_file_prefix", work_unit)
+        run_simulation(conn, step_info, resume_after, shared_data_buffer)
+
+        # so next work unit only sees the tables loaded from its own pipeline
+        inject.reinject_decorated_tables(injectables=False)
+
+        conn.send({'work_unit': work_unit, 'time': time.time()-t0})
+
+
 """
 ### multiprocessing sub-process entry points
 """
 
 
-def mp_run_simulation(locutor, queue, injectables, step_info, resume_after, **kwargs):
+def mp_run_simulation(locutor, conn, injectables, step_info, resume_after, work_queue=None, barrier=None,
+                      **kwargs):
     """
-    mp entry point for run_simulation
+    mp entry point for run_simulation (or run_work_units if step is dynamically scheduled)
 
     Parameters
     ----------
     locutor
-    queue
+    conn : multiprocessing.connection.Connection
+        send end of pipe for progress messages to parent process
     injectables
     step_info
     resume_after : bool
+    work_queue : multiprocessing.Queue or None
+        queue of work unit names if step is dynamically scheduled
+    barrier : multiprocessing.Barrier or None
+        barrier shared by all sub processes in (statically apportioned) multiprocess step
     kwargs : dict
         shared_data_buffers passed as kwargs to avoid picking dict
     """
@@ -863,13 +1077,21 @@ def mp_run_simulation(locutor, queue, injectables, step_info, resume_after, **kw
 
     try:
 
-        if step_info['num_processes'] > 1:
-            pipeline_prefix = multiprocessing.current_process().name
-            logger.debug(f"injecting pipeline_file_prefix '{pipeline_prefix}'")
-            inject.add_injectable("pipeline_file_prefix", pipeline_prefix)
-
         shared_data_buffer = kwargs
-        run_simulation(queue, step_info, resume_after, shared_data_buffer)
+
+        if barrier is not None:
+            # e.g. so shadow pricing can synchronize choices across sub processes
+            inject.add_injectable('sub_process_barrier', barrier)
+
+        if work_queue is not None:
+            run_work_units(conn, work_queue, step_info, resume_after, shared_data_buffer)
+        else:
+            if step_info['num_processes'] > 1:
+                pipeline_prefix = multiprocessing.current_process().name
+                logger.debug(f"injecting pipeline_file_prefix '{pipeline_prefix}'")
+                inject.add_injectable("pipeline_file_prefix", pipeline_prefix)
+
+            run_simulation(conn, step_info, resume_after, shared_data_buffer)
 
         mem.log_global_hwm()  # subprocess
 
@@ -984,6 +1206,17 @@ def allocate_shared_skim_buffers():
     return skim_buffers
 
 
+def release_shared_skim_buffers(shared_data_buffers):
+    """
+    This is called by the main process to free any shared memory segments allocated by
+    allocate_shared_skim_buffers that are not freed by garbage collection (e.g. SharedMemory)
+    """
+
+    network_los = inject.get_injectable('network_los_preload', None)
+    if network_los is not None:
+        network_los.release_shared_skim_buffers(shared_data_buffers)
+
+
 def allocate_shared_shadow_pricing_buffers():
     """
     This is called by the main process to allocate memory buffer to share with subprocs
@@ -1010,18 +1243,25 @@ def run_sub_simulations(
         injectables,
         shared_data_buffers,
         step_info, process_names,
-        resume_after, previously_completed, fail_fast):
+        resume_after, previously_completed, fail_fast, work_unit_names=None):
     """
     Launch sub processes to run models in step according to specification in step_info.
 
+    If work_unit_names are specified (i.e. step is dynamically scheduled) the sub processes pull
+    work units from a shared queue until it is empty, otherwise each sub process runs its own
+    apportioned pipeline.
+
     If resume_after is LAST_CHECKPOINT, then pick up where previous run left off, using breadcrumbs
-    from previous run. If some sub-processes completed in the prior run, then skip rerunning them.
+    from previous run. If some sub-processes (or work units) completed in the prior run, then skip
+    rerunning them.
 
     If resume_after specifies a checkpiont, skip checkpoints that precede the resume_after
 
-    Drop 'completed' breadcrumbs for this run as sub-processes terminate
+    Drop 'completed' breadcrumbs for this run as sub-processes terminate (or work units complete)
 
-    Wait for all sub-processes to terminate and return list of those that completed successfully.
+    Wait for all sub-processes to terminate and return list of those (or of the work units) that
+    completed successfully. Rather than polling, we wait (with multiprocessing.connection.wait)
+    for a sub-process to send a progress message or to terminate (i.e. for its sentinel to be ready.)
 
     Parameters
     ----------
@@ -1036,23 +1276,35 @@ def run_sub_simulations(
     resume_after : str or None
         name of simulation to resume after, or LAST_CHECKPOINT to resume where previous run left off
     previously_completed : list of str
-        names of processes that successfully completed in previous run
+        names of processes (or work units) that successfully completed in previous run
     fail_fast : bool
         whether to raise error if a sub process terminates with nonzero exitcode
+    work_unit_names : list of str or None
+        names of work units to run if step is dynamically scheduled
 
     Returns
     -------
     completed : list of str
-        names of sub_processes that completed successfully
+        names of sub_processes (or work units) that completed successfully
 
     """
-    def log_queued_messages():
-        for process, queue in zip(procs, queues):
-            while not queue.empty():
-                msg = queue.get(block=False)
+    def log_queued_messages(conn):
+        process = readers[conn]
+        try:
+            while conn.poll():
+                msg = conn.recv()
+                if 'work_unit' in msg:
+                    work_unit = msg['work_unit']
+                    info(f"{process.name} work unit {work_unit} : {tracing.format_elapsed_time(msg['time'])}")
+                    completed.add(work_unit)
+                    drop_breadcrumb(step_name, 'completed', list(completed))
+                    continue
                 model_name = msg['model']
                 info(f"{process.name} {model_name} : {tracing.format_elapsed_time(msg['time'])}")
                 mem.trace_memory_info(f"{process.name}.{model_name}.completed")
+        except EOFError:
+            # all send ends are closed, so stop waiting on it
+            del readers[conn]
 
     def check_proc_status():
         # we want to drop 'completed' breadcrumb when it happens, lest we terminate
@@ -1062,10 +1314,12 @@ def run_sub_simulations(
                 pass  # still running
             elif p.exitcode == 0:
                 # completed successfully
-                if p.name not in completed:
+                if p.name not in succeeded:
                     info(f"process {p.name} completed")
-                    completed.add(p.name)
-                    drop_breadcrumb(step_name, 'completed', list(completed))
+                    succeeded.add(p.name)
+                    if not dynamic:
+                        completed.add(p.name)
+                        drop_breadcrumb(step_name, 'completed', list(completed))
                     mem.trace_memory_info(f"{p.name}.completed")
             else:
                 # process failed
@@ -1073,6 +1327,9 @@ def run_sub_simulations(
                     warning(f"process {p.name} failed with exitcode {p.exitcode}")
                     failed.add(p.name)
                     mem.trace_memory_info(f"{p.name}.failed")
+                    if barrier is not None:
+                        # so any processes waiting on failed process get BrokenBarrierError instead of hanging
+                        barrier.abort()
                     if fail_fast:
                         warning(f"fail_fast terminating remaining running processes")
                         for op in procs:
@@ -1085,6 +1342,7 @@ def run_sub_simulations(
                         raise RuntimeError("Process %s failed" % (p.name,))
 
     step_name = step_info['name']
+    dynamic = bool(work_unit_names)
 
     t0 = tracing.print_elapsed_time()
     info(f'run_sub_simulations step {step_name} models resume_after {resume_after}')
@@ -1092,12 +1350,15 @@ def run_sub_simulations(
     # if resuming and some processes completed successfully in previous run
     if previously_completed:
         assert resume_after is not None
-        assert set(previously_completed).issubset(set(process_names))
+        assert set(previously_completed).issubset(set(work_unit_names or process_names))
 
         if resume_after == LAST_CHECKPOINT:
             # if we are resuming where previous run left off, then we can skip running
             # any subprocudures that successfully complete the previous run
-            process_names = [name for name in process_names if name not in previously_completed]
+            if dynamic:
+                work_unit_names = [name for name in work_unit_names if name not in previously_completed]
+            else:
+                process_names = [name for name in process_names if name not in previously_completed]
             info(f'step {step_name}: skipping {len(previously_completed)} previously completed subprocedures')
         else:
             # if we are resuming after a specific model, then force all subprocesses to run
@@ -1108,20 +1369,39 @@ def run_sub_simulations(
     if resume_after is None and step_info['step_num'] > 0:
         resume_after = LAST_CHECKPOINT
 
+    work_queue = None
+    if dynamic:
+        # no point in starting more sub processes than there are work units left to run
+        process_names = process_names[:len(work_unit_names)]
+        work_queue = multiprocessing.Queue()
+        for work_unit in work_unit_names:
+            work_queue.put(work_unit)
+        # sentinel to tell each sub process there are no more work units
+        for _ in process_names:
+            work_queue.put(None)
+        info(f'step {step_name}: queued {len(work_unit_names)} work units for {len(process_names)} processes')
+
+    # so sub processes can synchronize with one another (e.g. to shadow price location choices)
+    barrier = None
+    if not dynamic and len(process_names) > 1:
+        barrier = multiprocessing.Barrier(len(process_names))
+
     num_simulations = len(process_names)
     procs = []
-    queues = []
+    conns = []
+    readers = {}  # {<receive end of sub process pipe>: <sub process>}
 
     completed = set(previously_completed)
+    succeeded = set([])
     failed = set([])  # so we can log process failure first time it happens
     drop_breadcrumb(step_name, 'completed', list(completed))
 
     for i, process_name in enumerate(process_names):
-        q = multiprocessing.Queue()
+        reader, conn = multiprocessing.Pipe(duplex=False)
         locutor = (i == 0)
 
         args = OrderedDict(locutor=locutor,
-                           queue=q,
+                           conn=conn,
                            injectables=injectables,
                            step_info=step_info,
                            resume_after=resume_after)
@@ -1133,14 +1413,15 @@ def run_sub_simulations(
         #     debug(f"create_process {process_name} shared_data_buffers {k}={shared_data_buffers[k]}")
 
         p = multiprocessing.Process(target=mp_run_simulation, name=process_name,
-                                    args=(locutor, q, injectables, step_info, resume_after,),
+                                    args=(locutor, conn, injectables, step_info, resume_after, work_queue, barrier,),
                                     kwargs=shared_data_buffers)
 
         procs.append(p)
-        queues.append(q)
+        conns.append(conn)
+        readers[reader] = p
 
     # - start processes
-    for i, p in zip(list(range(num_simulations)), procs):
+    for i, p, conn in zip(list(range(num_simulations)), procs, conns):
         info(f"start process {p.name}")
         p.start()
 
@@ -1162,22 +1443,32 @@ def run_sub_simulations(
         if sys.platform == 'win32':
             time.sleep(1)
 
+        # close our copy of send end of pipe so reader gets EOFError once sub process terminates
+        conn.close()
+
         mem.trace_memory_info(f"{p.name}.start")
 
-    while multiprocessing.active_children():
-        # log queued messages as they are received
-        log_queued_messages()
+    sentinels = {p.sentinel: p for p in procs}
+    while sentinels:
+        # wait until a sub process sends a message or terminates (or it is time to trace memory usage)
+        ready = multiprocessing.connection.wait(list(readers) + list(sentinels),
+                                                timeout=mem.MEM_PARENT_TRACE_TICK_LEN)
+
+        # log messages as they are received
+        for conn in [r for r in ready if r in readers]:
+            log_queued_messages(conn)
+
+        for sentinel in [r for r in ready if r in sentinels]:
+            p = sentinels.pop(sentinel)
+            p.join()
+            # log any messages the sub process sent before terminating
+            for conn in [r for r, rp in readers.items() if rp is p]:
+                log_queued_messages(conn)
+
         # monitor sub process status and drop breadcrumbs or fail_fast as they terminate
         check_proc_status()
         # monitor memory usage
         mem.trace_memory_info("run_sub_simulations.idle", trace_ticks=mem.MEM_PARENT_TRACE_TICK_LEN)
-        time.sleep(1)
-
-    # clean up any messages or breadcrumbs that occurred while we slept
-    log_queued_messages()
-    check_proc_status()
-
-    # no need to join() explicitly since multiprocessing.active_children joins completed procs
 
     for p in procs:
         assert p.exitcode is not None
@@ -1186,7 +1477,7 @@ def run_sub_simulations(
             assert p.name in failed
         else:
             info(f"Process {p.name} completed with exitcode {p.exitcode}")
-            assert p.name in completed
+            assert p.name in succeeded
 
     t0 = tracing.print_elapsed_time('run_sub_simulations step %s' % step_name, t0)
 
@@ -1210,12 +1501,10 @@ def run_sub_task(p):
     t0 = tracing.print_elapsed_time()
     p.start()
 
-    while multiprocessing.active_children():
+    # wake up to trace memory usage until sub process terminates
+    while not multiprocessing.connection.wait([p.sentinel], timeout=mem.MEM_PARENT_TRACE_TICK_LEN):
         mem.trace_memory_info("run_sub_simulations.idle", trace_ticks=mem.MEM_PARENT_TRACE_TICK_LEN)
-        time.sleep(1)
-
-    # no need to join explicitly since multiprocessing.active_children joins completed procs
-    # p.join()
+    p.join()
 
     t0 = tracing.print_elapsed_time('#run_model sub_process %s' % p.name, t0)
     # info(f'{p.name}.exitcode = {p.exitcode}')
@@ -1275,6 +1564,7 @@ def run_multiprocess(injectables):
     * run each (single or multiprocess) step in turn
 
     Drop breadcrumbs along the way to facilitate resuming in a later run
+    (and record elapsed seconds for each phase of each step, to show where the time went)
 
     Parameters
     ----------
@@ -1307,6 +1597,13 @@ def run_multiprocess(injectables):
     def find_breadcrumb(crumb, default=None):
         return old_breadcrumbs.get(step_name, {}).get(crumb, default)
 
+    def drop_phase_breadcrumb(phase, phase_t0):
+        # phases skipped on resume keep elapsed time from previous run (if any)
+        if phase_t0 is not None:
+            elapsed[phase] = round(time.time() - phase_t0, 3)
+        drop_breadcrumb(step_name, 'elapsed', dict(elapsed))
+        drop_breadcrumb(step_name, phase)
+
     # - allocate shared data
     shared_data_buffers = {}
 
@@ -1317,75 +1614,93 @@ def run_multiprocess(injectables):
     t0 = tracing.print_elapsed_time('allocate shared skim buffer', t0)
     mem.trace_memory_info("allocate_shared_skim_buffer.completed")
 
-    # combine shared_skim_buffer and shared_shadow_pricing_buffer in shared_data_buffer
-    t0 = tracing.print_elapsed_time()
-    shared_data_buffers.update(allocate_shared_shadow_pricing_buffers())
-    t0 = tracing.print_elapsed_time('allocate shared shadow_pricing buffer', t0)
-    mem.trace_memory_info("allocate_shared_shadow_pricing_buffers.completed")
-
-    # - mp_setup_skims
-    if len(shared_data_buffers) > 0:
-        run_sub_task(
-            multiprocessing.Process(
-                target=mp_setup_skims, name='mp_setup_skims', args=(injectables,),
-                kwargs=shared_data_buffers)
-        )
-        t0 = tracing.print_elapsed_time('setup shared_data_buffers', t0)
-        mem.trace_memory_info("mp_setup_skims.completed")
-
-    # - for each step in run list
-    for step_info in run_list['multiprocess_steps']:
-
-        step_name = step_info['name']
-
-        num_processes = step_info['num_processes']
-        slice_info = step_info.get('slice', None)
-
-        if num_processes == 1:
-            sub_proc_names = [step_name]
-        else:
-            sub_proc_names = ["%s_%s" % (step_name, i) for i in range(num_processes)]
-
-        # - mp_apportion_pipeline
-        if not skip_phase('apportion') and num_processes > 1:
+    # free shared memory segments even if a step fails, lest they outlive the run (e.g. in /dev/shm)
+    try:
+        # combine shared_skim_buffer and shared_shadow_pricing_buffer in shared_data_buffer
+        t0 = tracing.print_elapsed_time()
+        shared_data_buffers.update(allocate_shared_shadow_pricing_buffers())
+        t0 = tracing.print_elapsed_time('allocate shared shadow_pricing buffer', t0)
+        mem.trace_memory_info("allocate_shared_shadow_pricing_buffers.completed")
+
+        # - mp_setup_skims
+        if len(shared_data_buffers) > 0:
             run_sub_task(
                 multiprocessing.Process(
-                    target=mp_apportion_pipeline, name='%s_apportion' % step_name,
-                    args=(injectables, sub_proc_names, step_info))
+                    target=mp_setup_skims, name='mp_setup_skims', args=(injectables,),
+                    kwargs=shared_data_buffers)
             )
-        drop_breadcrumb(step_name, 'apportion')
-
-        # - run_sub_simulations
-        if not skip_phase('simulate'):
-            resume_after = step_info.get('resume_after', None)
+            t0 = tracing.print_elapsed_time('setup shared_data_buffers', t0)
+            mem.trace_memory_info("mp_setup_skims.completed")
 
-            previously_completed = find_breadcrumb('completed', default=[])
+        # - for each step in run list
+        for step_info in run_list['multiprocess_steps']:
 
-            completed = run_sub_simulations(injectables,
-                                            shared_data_buffers,
-                                            step_info,
-                                            sub_proc_names,
-                                            resume_after, previously_completed, fail_fast)
+            step_name = step_info['name']
 
-            if len(completed) != num_processes:
-                raise RuntimeError("%s processes failed in step %s" %
-                                   (num_processes - len(completed), step_name))
-        drop_breadcrumb(step_name, 'simulate')
+            num_processes = step_info['num_processes']
+            slice_info = step_info.get('slice', None)
 
-        # - mp_coalesce_pipelines
-        if not skip_phase('coalesce') and num_processes > 1:
-            run_sub_task(
-                multiprocessing.Process(
-                    target=mp_coalesce_pipelines, name='%s_coalesce' % step_name,
-                    args=(injectables, sub_proc_names, slice_info))
-            )
-        drop_breadcrumb(step_name, 'coalesce')
-
-    # add checkpoint with final tables even if not intermediate checkpointing
-    if not pipeline.intermediate_checkpoint():
-        pipeline.open_pipeline('_')
-        pipeline.add_checkpoint(pipeline.FINAL_CHECKPOINT_NAME)
-        pipeline.close_pipeline()
+            if num_processes == 1:
+                sub_proc_names = [step_name]
+            else:
+                sub_proc_names = ["%s_%s" % (step_name, i) for i in range(num_processes)]
+
+            # dynamically scheduled steps apportion and coalesce work unit pipelines rather than sub_proc pipelines
+            work_unit_names = ["%s_unit_%s" % (step_name, i) for i in range(step_info.get('num_work_units', 0))]
+            pipeline_names = work_unit_names or sub_proc_names
+
+            elapsed = dict(find_breadcrumb('elapsed', default={}))
+
+            # - mp_apportion_pipeline
+            phase_t0 = None
+            if not skip_phase('apportion') and num_processes > 1:
+                phase_t0 = time.time()
+                run_sub_task(
+                    multiprocessing.Process(
+                        target=mp_apportion_pipeline, name='%s_apportion' % step_name,
+                        args=(injectables, pipeline_names, step_info))
+                )
+            drop_phase_breadcrumb('apportion', phase_t0)
+
+            # - run_sub_simulations
+            phase_t0 = None
+            if not skip_phase('simulate'):
+                phase_t0 = time.time()
+                resume_after = step_info.get('resume_after', None)
+
+                previously_completed = find_breadcrumb('completed', default=[])
+
+                completed = run_sub_simulations(injectables,
+                                                shared_data_buffers,
+                                                step_info,
+                                                sub_proc_names,
+                                                resume_after, previously_completed, fail_fast,
+                                                work_unit_names=work_unit_names)
+
+                if len(completed) != len(pipeline_names):
+                    raise RuntimeError("%s %s failed in step %s" %
+                                       (len(pipeline_names) - len(completed),
+                                        'work units' if work_unit_names else 'processes', step_name))
+            drop_phase_breadcrumb('simulate', phase_t0)
+
+            # - mp_coalesce_pipelines
+            phase_t0 = None
+            if not skip_phase('coalesce') and num_processes > 1:
+                phase_t0 = time.time()
+                run_sub_task(
+                    multiprocessing.Process(
+                        target=mp_coalesce_pipelines, name='%s_coalesce' % step_name,
+                        args=(injectables, pipeline_names, slice_info))
+                )
+            drop_phase_breadcrumb('coalesce', phase_t0)
+
+        # add checkpoint with final tables even if not intermediate checkpointing
+        if not pipeline.intermediate_checkpoint():
+            pipeline.open_pipeline('_')
+            pipeline.add_checkpoint(pipeline.FINAL_CHECKPOINT_NAME)
+            pipeline.close_pipeline()
+    finally:
+        release_shared_skim_buffers(shared_data_buffers)
 
     mem.log_global_hwm()  # main process
 
@@ -1589,6 +1904,23 @@ def get_run_list():
 
             multiprocess_steps[istep]['num_processes'] = num_processes
 
+            # - validate num_work_units (only dynamically schedule steps with more work units than processes)
+            num_work_units = step.get('num_work_units', 0)
+
+            if not isinstance(num_work_units, int) or num_work_units < 0:
+                raise RuntimeError("bad value (%s) for num_work_units for step %s"
+                                   " in multiprocess_steps" % (num_work_units, name))
+
+            if num_work_units and num_processes == 1:
+                info(f"Ignoring num_work_units ({num_work_units}) for single process step {name}")
+                num_work_units = 0
+
+            if num_work_units and num_work_units < num_processes:
+                raise RuntimeError(f"num_work_units ({num_work_units}) less than num_processes ({num_processes}) "
+                                   f"for step {name} in multiprocess_steps")
+
+            multiprocess_steps[istep]['num_work_units'] = num_work_units
+
             # - validate chunk_size and assign default
             chunk_size = step.get('chunk_size', None)
             if chunk_size is None:
@@ -1650,6 +1982,20 @@ def get_run_list():
 
             multiprocess_steps[istep]['models'] = step_models
 
+        # - shadow priced models (and initialize_tvpb) synchronize across all sub-processes
+        # so can't be run on work units
+        if any(step['num_work_units'] for step in multiprocess_steps):
+            shadow_settings = config.read_model_settings('shadow_pricing.yaml')
+            shadow_pricing_models = list((shadow_settings.get('shadow_pricing_models', None) or {}).values())
+            for step in multiprocess_steps:
+                shadow_priced = [m for m in step['models'] if m in shadow_pricing_models]
+                if step['num_work_units'] and shadow_priced:
+                    raise RuntimeError(f"step {step['name']} with num_work_units has shadow priced models "
+                                       f"{shadow_priced} (run them in a separate step without num_work_units)")
+                if step['num_work_units'] and 'initialize_tvpb' in step['models']:
+                    raise RuntimeError(f"step {step['name']} with num_work_units has initialize_tvpb "
+                                       f"(run it in a separate step without num_work_units)")
+
         run_list['multiprocess_steps'] = multiprocess_steps
 
         # - add resume breadcrumbs
@@ -1761,6 +2107,7 @@ def write_breadcrumbs(breadcrumbs):
         - apportion: true
           coalesce: true
           completed: [mp_households_0, mp_households_1]
+          elapsed: {apportion: 1.032, coalesce: 2.117, simulate: 95.408}
           name: mp_households
           simulate: true
 
@@ -4,6 +4,7 @@ from builtins import range
 
 import logging
 import warnings
+import numba
 import numpy as np
 import pandas as pd
 
@@ -16,6 +17,7 @@ from activitysim.core import simulate
 from activitysim.core import los
 from activitysim.core import pathbuilder_cache
 
+from activitysim.core import util
 from activitysim.core.util import reindex
 
 from activitysim.core import expressions
@@ -29,6 +31,7 @@ TIMING = True
 TRACE_CHUNK = True
 ERR_CHECK = True
 TRACE_COMPLEXITY = False  # diagnostic: log the omaz,dmaz pairs with the greatest number of virtual tap-tap paths
+VECTORIZED_BEST_PATHS = True  # select best utility paths with numba kernel rather than pandas merges (unless tracing)
 
 UNAVAILABLE = -999
 
@@ -80,6 +83,118 @@ def compute_utilities(network_los, model_settings, choosers, model_constants,
     return utilities
 
 
+@numba.njit(nogil=True)
+def _insert_path(utilities, btaps, ataps, sets, num_paths, utility, btap, atap, path_set):
+    """
+    insert path into utilities (and btaps, ataps, sets) list of num_paths best paths, sorted by descending
+    utility (with earlier inserted paths first if utilities are equal), dropping the worst path if list is full
+
+    Returns
+    -------
+    new num_paths
+    """
+    max_paths = utilities.shape[0]
+    k = num_paths
+    if k == max_paths:
+        if not utility > utilities[max_paths - 1]:
+            return num_paths
+        k = max_paths - 1
+    else:
+        num_paths += 1
+    while k > 0 and utilities[k - 1] < utility:
+        utilities[k] = utilities[k - 1]
+        btaps[k] = btaps[k - 1]
+        ataps[k] = ataps[k - 1]
+        sets[k] = sets[k - 1]
+        k -= 1
+    utilities[k] = utility
+    btaps[k] = btap
+    ataps[k] = atap
+    sets[k] = path_set
+    return num_paths
+
+
+@numba.njit(nogil=True)
+def _path_uids(seq_access, seq_egress, access_ptr, access_tap, egress_ptr, egress_tap, seq_base_uid, num_taps):
+    """
+    tap_cache uids of the tap-tap legs of all candidate access btap, egress atap paths of each chooser
+    (with duplicates)
+    """
+    num_uids = 0
+    for seq in range(seq_access.shape[0]):
+        if seq_access[seq] >= 0 and seq_egress[seq] >= 0:
+            num_uids += \
+                (access_ptr[seq_access[seq] + 1] - access_ptr[seq_access[seq]]) * \
+                (egress_ptr[seq_egress[seq] + 1] - egress_ptr[seq_egress[seq]])
+
+    uids = np.empty(num_uids, dtype=np.int64)
+    n = 0
+    for seq in range(seq_access.shape[0]):
+        if seq_access[seq] < 0 or seq_egress[seq] < 0:
+            continue
+        for i in range(access_ptr[seq_access[seq]], access_ptr[seq_access[seq] + 1]):
+            for j in range(egress_ptr[seq_egress[seq]], egress_ptr[seq_egress[seq] + 1]):
+                if access_tap[i] != egress_tap[j]:
+                    uids[n] = seq_base_uid[seq] + access_tap[i] * num_taps + egress_tap[j]
+                    n += 1
+    return uids[:n]
+
+
+@numba.njit(nogil=True)
+def _best_paths(seq_access, seq_egress, access_ptr, access_tap, access_utility, egress_ptr, egress_tap,
+                egress_utility, seq_base_uid, num_taps, tap_tap_utilities, max_paths_per_tap_set,
+                path_utility, path_btap, path_atap, path_set):
+    """
+    select the best (highest utility) access btap, tap-tap set, egress atap paths of each chooser seq
+
+    Access (and egress) taps of access group g are access_tap[access_ptr[g]:access_ptr[g+1]] (CSR layout),
+    seq_access[seq] is the access group of chooser seq (or -1 if none), and tap_tap_utilities is the tap_cache
+    data indexed by seq_base_uid[seq] + btap * num_taps + atap (with btap and atap tap ordinals)
+
+    For each chooser, the max_paths_per_tap_set best paths of each set are chosen, and then the
+    path_utility.shape[1] best of those across sets, which are written to path_utility, path_btap,
+    path_atap and path_set (set ordinal) in descending order of utility.
+
+    Returns
+    -------
+    num_paths: int ndarray with number of paths of each chooser seq
+    """
+    num_sets = tap_tap_utilities.shape[1]
+    set_utility = np.empty((num_sets, max_paths_per_tap_set), dtype=np.float64)
+    set_btap = np.empty((num_sets, max_paths_per_tap_set), dtype=np.int64)
+    set_atap = np.empty((num_sets, max_paths_per_tap_set), dtype=np.int64)
+    set_set = np.empty((num_sets, max_paths_per_tap_set), dtype=np.int64)
+    set_count = np.zeros(num_sets, dtype=np.int64)
+
+    num_paths = np.zeros(seq_access.shape[0], dtype=np.int64)
+    for seq in range(seq_access.shape[0]):
+        if seq_access[seq] < 0 or seq_egress[seq] < 0:
+            continue
+
+        set_count[:] = 0
+        for i in range(access_ptr[seq_access[seq]], access_ptr[seq_access[seq] + 1]):
+            btap = access_tap[i]
+            for j in range(egress_ptr[seq_egress[seq]], egress_ptr[seq_egress[seq] + 1]):
+                atap = egress_tap[j]
+                # don't want transit trips that start and stop in same tap
+                if atap == btap:
+                    continue
+                uid = seq_base_uid[seq] + btap * num_taps + atap
+                for s in range(num_sets):
+                    utility = (np.float64(tap_tap_utilities[uid, s]) + access_utility[i]) + egress_utility[j]
+                    set_count[s] = _insert_path(set_utility[s], set_btap[s], set_atap[s], set_set[s], set_count[s],
+                                                utility, btap, atap, s)
+
+        n = 0
+        for s in range(num_sets):
+            for k in range(set_count[s]):
+                n = _insert_path(path_utility[seq], path_btap[seq], path_atap[seq], path_set[seq], n,
+                                 set_utility[s, k], set_btap[s, k], set_atap[s, k], s)
+        num_paths[seq] = n
+
+    return num_paths
+
+
 class TransitVirtualPathBuilder(object):
     """
     Transit virtual path builder for three zone systems
@@ -93,6 +208,10 @@ class TransitVirtualPathBuilder(object):
         # note: pathbuilder_cache is lightweight until opened
         self.tap_cache = pathbuilder_cache.TVPBCache(self.network_los, self.uid_calculator, CACHE_TAG)
 
+        # optional LRU cache of logsums (and best transit times) of previously built virtual paths
+        logsum_cache_size = network_los.setting('tvpb_logsum_cache_size', 0)
+        self.logsum_cache = pathbuilder_cache.TVPBLogsumCache(logsum_cache_size) if logsum_cache_size else None
+
         assert network_los.zone_system == los.THREE_ZONE, \
             f"TransitVirtualPathBuilder: network_los zone_system not THREE_ZONE"
 
@@ -338,12 +457,73 @@ class TransitVirtualPathBuilder(object):
 
         return transit_df
 
+    def populate_tap_cache(self, recipe, transit_df, chooser_attributes, path_info, trace_label):
+        """
+        compute tap_tap utilities for rows of transit_df whose uids are not yet in the DYNAMIC tap_cache
+        and add them to the cache
+
+        Parameters
+        ----------
+        recipe: str
+           'recipe' key in network_los.yaml TVPB_SETTINGS e.g. tour_mode_choice
+        transit_df: pandas.DataFrame
+            with uid index and btap, atap, and chooser_attributes columns
+        chooser_attributes: pandas.DataFrame
+        path_info: dict
+        trace_label: str
+        """
+
+        trace_label = tracing.extend_trace_label(trace_label, 'populate_tap_cache')
+
+        uncached = self.tap_cache.uncached(transit_df.index.values)
+        if not uncached.any():
+            return
+
+        with chunk.chunk_log(trace_label):
+
+            model_constants = self.network_los.setting(f'TVPB_SETTINGS.{recipe}.CONSTANTS')
+            tap_tap_settings = self.network_los.setting(f'TVPB_SETTINGS.{recipe}.tap_tap_settings')
+            attributes_as_columns = tap_tap_settings.get('attributes_as_columns', [])
+
+            locals_dict = path_info.copy()
+            locals_dict.update(model_constants)
+
+            chooser_columns = ['btap', 'atap'] + list(chooser_attributes.columns)
+            uncached_df = transit_df.loc[uncached, chooser_columns]
+            uncached_df = uncached_df[~uncached_df.index.duplicated()]
+
+            # add any scalar attributes specified as column attributes in settings (as does initialize_tvpb)
+            for attribute_name in attributes_as_columns:
+                if attribute_name not in uncached_df:
+                    uncached_df[attribute_name] = locals_dict[attribute_name]
+
+            chunk.log_df(trace_label, "uncached_df", uncached_df)
+
+            utilities_df = compute_utilities(
+                self.network_los,
+                tap_tap_settings,
+                choosers=uncached_df,
+                model_constants=locals_dict,
+                trace_label=trace_label)
+            chunk.log_df(trace_label, "utilities_df", utilities_df)
+
+            assert list(utilities_df.columns) == self.uid_calculator.set_names
+            self.tap_cache.add_to_cache(uncached_df.index.values, utilities_df.values)
+
+            logger.debug(f"{trace_label} added {len(uncached_df)} uids to tap_cache")
+
+            del uncached_df
+            chunk.log_df(trace_label, "uncached_df", None)
+            del utilities_df
+            chunk.log_df(trace_label, "utilities_df", None)
+
     def lookup_tap_tap_utilities(self, recipe, maz_od_df, access_df, egress_df, chooser_attributes,
                                  path_info, trace_label):
         """
         create transit_df and compute utilities for all atap-btap pairs between omaz in access and dmaz in egress_df
         look up the utilities in the precomputed tap_cache data (which is indexed by uid_calculator unique_ids)
         (unique_id can used as a zero-based index into the data array)
+        if tap_cache is DYNAMIC, utilities not already in the cache are computed and added to it first
 
         transit_df contains all possible access omaz/btap to egress dmaz/atap transit path pairs for each chooser
 
@@ -389,9 +569,15 @@ class TransitVirtualPathBuilder(object):
                 scalar_attributes = {k: locals_dict[k] for k in attribute_segments.keys() if k not in transit_df}
 
                 transit_df.index = self.uid_calculator.get_unique_ids(transit_df, scalar_attributes)
-                transit_df = transit_df[['idx', 'btap', 'atap']]  # just needed chooser_columns for uid calculation
                 chunk.log_df(trace_label, "transit_df add uid index", transit_df)
 
+            if self.tap_cache.is_dynamic:
+                with memo("#TVPB lookup_tap_tap_utilities populate dynamic cache"):
+                    self.populate_tap_cache(recipe, transit_df, chooser_attributes, path_info, trace_label)
+
+            transit_df = transit_df[['idx', 'btap', 'atap']]  # just needed chooser_columns for uid calculation
+            chunk.log_df(trace_label, "transit_df", transit_df)
+
             with memo("#TVPB lookup_tap_tap_utilities reindex transit_df"):
                 utilities = self.tap_cache.data
                 i = 0
@@ -564,6 +750,135 @@ class TransitVirtualPathBuilder(object):
 
         return path_df
 
+    def leg_taps(self, maz_od_df, leg_df, leg, maz_col, tap_col):
+        """
+        group leg_df (access_df or egress_df) taps and utilities by (idx, maz) in CSR layout for _best_paths
+
+        Returns
+        -------
+        seq_group: int ndarray with group of each maz_od_df row (-1 if no taps)
+        ptr: int ndarray of group offsets (taps of group g are at [ptr[g]:ptr[g+1]])
+        taps: int ndarray of tap ordinals (preserving leg_df order within each group)
+        utilities: float64 ndarray of leg utilities
+        """
+        if len(leg_df) == 0:
+            return np.full(len(maz_od_df), -1, dtype=np.int64), np.zeros(1, dtype=np.int64), \
+                np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+
+        keys = pd.MultiIndex.from_arrays([leg_df['idx'].values, leg_df[maz_col].values])
+        group_codes, group_keys = pd.factorize(keys)
+        order = np.argsort(group_codes, kind='stable')
+
+        ptr = np.zeros(len(group_keys) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(group_codes, minlength=len(group_keys)), out=ptr[1:])
+
+        tap_ordinals = self.uid_calculator.ordinalizers[tap_col]
+        taps = tap_ordinals.index.get_indexer(leg_df[tap_col].values)[order].astype(np.int64)
+        assert (taps >= 0).all(), f"{leg} taps not in tap_df"
+
+        utilities = leg_df[leg].values[order].astype(np.float64)
+
+        seq_group = \
+            group_keys.get_indexer(pd.MultiIndex.from_arrays([maz_od_df['idx'].values, maz_od_df[maz_col].values]))
+
+        return seq_group.astype(np.int64), ptr, taps, utilities
+
+    def vectorized_best_paths(self, recipe, path_type, maz_od_df, access_df, egress_df, chooser_attributes,
+                              path_info, trace_label):
+        """
+        select best utility paths for maz_od_df choosers with the _best_paths numba kernel,
+        looking tap-tap utilities up directly in tap_cache (populating it first if it is DYNAMIC)
+
+        Equivalent to compute_tap_tap followed by best_paths (for units 'utility') but without materializing
+        the per-chooser access x egress path candidates as (merged) DataFrames.
+
+        Returns
+        -------
+        utilities: float64 ndarray with one row per maz_od_df seq and a column per path (in path_num order)
+            with UNAVAILABLE utility for missing paths
+        path_df: pandas.DataFrame with one row per path and seq, path_num, btap, atap, path_set, utility columns
+        """
+
+        trace_label = tracing.extend_trace_label(trace_label, 'vectorized_best_paths')
+
+        with chunk.chunk_log(trace_label):
+
+            path_settings = self.network_los.setting(f'TVPB_SETTINGS.{recipe}.path_types.{path_type}')
+            max_paths_per_tap_set = path_settings.get('max_paths_per_tap_set', 1)
+            max_paths_across_tap_sets = path_settings.get('max_paths_across_tap_sets', 1)
+
+            if not self.tap_cache.is_open:
+                with memo("#TVPB vectorized_best_paths tap_cache.open"):
+                    self.tap_cache.open()
+
+            seq_access, access_ptr, access_tap, access_utility = \
+                self.leg_taps(maz_od_df, access_df, 'access', 'omaz', 'btap')
+            seq_egress, egress_ptr, egress_tap, egress_utility = \
+                self.leg_taps(maz_od_df, egress_df, 'egress', 'dmaz', 'atap')
+
+            # uid of the first btap, atap pair for each chooser's attributes
+            # (uid of other tap pairs is base uid + btap * num_taps + atap since taps are last in uid order)
+            tap_ids = self.uid_calculator.tap_ids
+            num_taps = len(tap_ids)
+            base_df = chooser_attributes.copy()
+            base_df['btap'] = tap_ids[0]
+            base_df['atap'] = tap_ids[0]
+            attribute_segments = \
+                self.network_los.setting('TVPB_SETTINGS.tour_mode_choice.tap_tap_settings.attribute_segments')
+            scalar_attributes = {k: path_info[k] for k in attribute_segments.keys() if k not in base_df}
+            base_uids = self.uid_calculator.get_unique_ids(base_df, scalar_attributes)
+            seq_base_uid = base_uids[chooser_attributes.index.get_indexer(maz_od_df['idx'].values)].astype(np.int64)
+            del base_df
+
+            if self.tap_cache.is_dynamic:
+                with memo("#TVPB vectorized_best_paths populate dynamic cache"):
+                    uids = np.unique(_path_uids(seq_access, seq_egress, access_ptr, access_tap,
+                                                egress_ptr, egress_tap, seq_base_uid, num_taps))
+                    uids = uids[self.tap_cache.uncached(uids)]
+                    if len(uids) > 0:
+                        # decode uid into tap pair and attribute combination (skim offset)
+                        offsets, od = np.divmod(uids, num_taps * num_taps)
+                        btap, atap = np.divmod(od, num_taps)
+                        uncached_df = pd.DataFrame({'btap': tap_ids[btap], 'atap': tap_ids[atap]}, index=uids)
+                        attribute_combinations_df = self.uid_calculator.scalar_attribute_combinations()
+                        for c in chooser_attributes.columns:
+                            uncached_df[c] = attribute_combinations_df[c].values[offsets]
+                        chunk.log_df(trace_label, "uncached_df", uncached_df)
+                        self.populate_tap_cache(recipe, uncached_df, chooser_attributes, path_info, trace_label)
+                        del uncached_df
+                        chunk.log_df(trace_label, "uncached_df", None)
+
+            num_choosers = len(maz_od_df)
+            path_utility = np.full((num_choosers, max_paths_across_tap_sets), UNAVAILABLE, dtype=np.float64)
+            path_btap = np.zeros((num_choosers, max_paths_across_tap_sets), dtype=np.int64)
+            path_atap = np.zeros((num_choosers, max_paths_across_tap_sets), dtype=np.int64)
+            path_set = np.zeros((num_choosers, max_paths_across_tap_sets), dtype=np.int64)
+            chunk.log_df(trace_label, "path_utility", path_utility)
+
+            with memo("#TVPB vectorized_best_paths _best_paths"):
+                num_paths = _best_paths(seq_access, seq_egress, access_ptr, access_tap, access_utility,
+                                        egress_ptr, egress_tap, egress_utility, seq_base_uid, num_taps,
+                                        self.tap_cache.data, max_paths_per_tap_set,
+                                        path_utility, path_btap, path_atap, path_set)
+
+            # utilities for paths that don't exist are UNAVAILABLE
+            utilities = path_utility[:, :num_paths.max(initial=0)]
+
+            # one row per path
+            has_path = np.arange(max_paths_across_tap_sets) < num_paths[:, None]
+            path_df = pd.DataFrame({
+                'seq': np.repeat(maz_od_df['seq'].values, num_paths),
+                'path_num': np.nonzero(has_path)[1],
+                'btap': tap_ids[path_btap[has_path]],
+                'atap': tap_ids[path_atap[has_path]],
+                'path_set': np.array(self.uid_calculator.set_names, dtype=object)[path_set[has_path]],
+                'utility': path_utility[has_path],
+            })
+
+            chunk.log_df(trace_label, "path_utility", None)
+
+        return utilities, path_df
+
     def build_virtual_path(self, recipe, path_type, orig, dest, tod, demographic_segment,
                            want_choices, trace_label,
                            filter_targets=None, trace=False, override_choices=None):
@@ -650,42 +965,63 @@ class TransitVirtualPathBuilder(object):
                 trace_label=trace_label, trace=trace)
         chunk.log_df(trace_label, "egress_df", egress_df)
 
-        # L200 will drop all rows if all trips are intra-tap.
-        if np.array_equal(access_df['btap'].values, egress_df['atap'].values):
-            trace = False
+        if units == 'utility' and not trace and VECTORIZED_BEST_PATHS:
+
+            with memo("#TVPB build_virtual_path vectorized_best_paths"):
+                utilities, path_df = self.vectorized_best_paths(
+                    recipe, path_type,
+                    maz_od_df, access_df, egress_df, chooser_attributes,
+                    path_info=path_info, trace_label=trace_label)
+            chunk.log_df(trace_label, "path_df", path_df)
+
+            if len(path_df) == 0:
+                want_choices = False
 
-        # path_info for use by expressions (e.g. penalty for drive access if no parking at access tap)
-        with memo("#TVPB build_virtual_path compute_tap_tap"):
-            if len(access_df) * len(egress_df) == 0:
+            del access_df
+            chunk.log_df(trace_label, "access_df", None)
+            del egress_df
+            chunk.log_df(trace_label, "egress_df", None)
+
+        else:
+
+            utilities = None
+
+            # L200 will drop all rows if all trips are intra-tap.
+            if np.array_equal(access_df['btap'].values, egress_df['atap'].values):
                 trace = False
-            transit_df = self.compute_tap_tap(
-                recipe,
-                maz_od_df,
-                access_df,
-                egress_df,
-                chooser_attributes,
-                path_info=path_info,
-                trace_label=trace_label, trace=trace)
-        chunk.log_df(trace_label, "transit_df", transit_df)
-
-        # Cannot trace if df is empty. Prob happened at L200
-        if len(transit_df) == 0:
-            want_choices = False
-
-        with memo("#TVPB build_virtual_path best_paths"):
-            path_df = self.best_paths(
-                recipe, path_type,
-                maz_od_df, access_df, egress_df, transit_df,
-                trace_label, trace)
-        chunk.log_df(trace_label, "path_df", path_df)
-
-        # now that we have created path_df, we are done with the dataframes for the separate legs
-        del access_df
-        chunk.log_df(trace_label, "access_df", None)
-        del egress_df
-        chunk.log_df(trace_label, "egress_df", None)
-        del transit_df
-        chunk.log_df(trace_label, "transit_df", None)
+
+            # path_info for use by expressions (e.g. penalty for drive access if no parking at access tap)
+            with memo("#TVPB build_virtual_path compute_tap_tap"):
+                if len(access_df) * len(egress_df) == 0:
+                    trace = False
+                transit_df = self.compute_tap_tap(
+                    recipe,
+                    maz_od_df,
+                    access_df,
+                    egress_df,
+                    chooser_attributes,
+                    path_info=path_info,
+                    trace_label=trace_label, trace=trace)
+            chunk.log_df(trace_label, "transit_df", transit_df)
+
+            # Cannot trace if df is empty. Prob happened at L200
+            if len(transit_df) == 0:
+                want_choices = False
+
+            with memo("#TVPB build_virtual_path best_paths"):
+                path_df = self.best_paths(
+                    recipe, path_type,
+                    maz_od_df, access_df, egress_df, transit_df,
+                    trace_label, trace)
+            chunk.log_df(trace_label, "path_df", path_df)
+
+            # now that we have created path_df, we are done with the dataframes for the separate legs
+            del access_df
+            chunk.log_df(trace_label, "access_df", None)
+            del egress_df
+            chunk.log_df(trace_label, "egress_df", None)
+            del transit_df
+            chunk.log_df(trace_label, "transit_df", None)
 
         if units == 'utility':
 
@@ -693,15 +1029,20 @@ class TransitVirtualPathBuilder(object):
             with memo("#TVPB build_virtual_path logsums"):
                 # one row per seq with utilities in columns
                 # path_num 0-based to aligh with logit.make_choices 0-based choice indexes
-                path_df['path_num'] = path_df.groupby('seq').cumcount()
-                chunk.log_df(trace_label, "path_df", path_df)
+                if utilities is not None:
+                    # vectorized_best_paths already numbered paths and filled missing paths with UNAVAILABLE
+                    utilities_df = pd.DataFrame(utilities, index=maz_od_df.seq)
+                    del utilities
+                else:
+                    path_df['path_num'] = path_df.groupby('seq').cumcount()
+                    chunk.log_df(trace_label, "path_df", path_df)
 
-                utilities_df = path_df[['seq', 'path_num', units]].set_index(['seq', 'path_num']).unstack()
-                utilities_df.columns = utilities_df.columns.droplevel()  # for legibility
+                    utilities_df = path_df[['seq', 'path_num', units]].set_index(['seq', 'path_num']).unstack()
+                    utilities_df.columns = utilities_df.columns.droplevel()  # for legibility
 
-                # add rows missing because no access or egress availability
-                utilities_df = pd.concat([pd.DataFrame(index=maz_od_df.seq), utilities_df], axis=1)
-                utilities_df = utilities_df.fillna(UNAVAILABLE)  # set utilities for missing paths to UNAVAILABLE
+                    # add rows missing because no access or egress availability
+                    utilities_df = pd.concat([pd.DataFrame(index=maz_od_df.seq), utilities_df], axis=1)
+                    utilities_df = utilities_df.fillna(UNAVAILABLE)  # set utilities for missing paths to UNAVAILABLE
 
                 chunk.log_df(trace_label, "utilities_df", utilities_df)
 
@@ -804,6 +1145,62 @@ class TransitVirtualPathBuilder(object):
 
         return results
 
+    def cached_virtual_path(self, recipe, path_type, orig, dest, tod, demographic_segment, want_choices,
+                            trace_label):
+        """
+        build_virtual_path, using logsum_cache (if enabled) for rows whose logsums (or best transit times)
+        were computed by a previous call
+
+        Paths are always built if want_choices (since choices are not cached) but their logsums are cached.
+
+        Returns
+        -------
+        build_virtual_path results (DataFrame with just logsum column if results came from cache
+        and not want_choices)
+        """
+
+        if self.logsum_cache is None:
+            return self.build_virtual_path(recipe, path_type, orig, dest, tod, demographic_segment,
+                                           want_choices=want_choices, trace_label=trace_label)
+
+        units = self.units_for_recipe(recipe)
+        stats_tag = f'{recipe}.{path_type}'
+        keys = self.logsum_cache.keys(recipe, path_type, orig, dest, tod, demographic_segment)
+
+        if want_choices:
+            results = self.build_virtual_path(recipe, path_type, orig, dest, tod, demographic_segment,
+                                              want_choices=want_choices, trace_label=trace_label)
+            self.logsum_cache.store(keys, results['logsum'].values)
+            return results
+
+        values, hit = self.logsum_cache.lookup(keys, stats_tag)
+
+        logger.info(f"{trace_label} logsum_cache {util.INT(hit.sum())} hits of {util.INT(len(hit))} lookups "
+                    f"(cumulative {stats_tag} hit rate {self.logsum_cache.hit_rate(stats_tag):.1%}, "
+                    f"{util.INT(len(self.logsum_cache))} cached)")
+
+        if not hit.all():
+            miss = ~hit
+            miss_results = \
+                self.build_virtual_path(recipe, path_type, orig[miss], dest[miss],
+                                        tod if isinstance(tod, str) else tod[miss],
+                                        None if demographic_segment is None else demographic_segment[miss],
+                                        want_choices=False, trace_label=trace_label)
+            miss_values = miss_results['logsum'].values if units == 'utility' else miss_results.values
+            self.logsum_cache.store(keys[miss], miss_values)
+
+            if not hit.any():
+                return miss_results
+
+            values[miss] = miss_values
+
+        if units == 'utility':
+            results = pd.DataFrame({'logsum': values}, index=orig.index)
+        else:
+            results = pd.Series(values, index=orig.index)
+
+        return results
+
     def get_tvpb_logsum(
             self, path_type, orig, dest, tod, demographic_segment, want_choices,
             recipe='tour_mode_choice', trace_label=None):
@@ -815,8 +1212,8 @@ class TransitVirtualPathBuilder(object):
         with chunk.chunk_log(trace_label):
 
             logsum_df = \
-                self.build_virtual_path(recipe, path_type, orig, dest, tod, demographic_segment,
-                                        want_choices=want_choices, trace_label=trace_label)
+                self.cached_virtual_path(recipe, path_type, orig, dest, tod, demographic_segment,
+                                         want_choices=want_choices, trace_label=trace_label)
 
             trace_hh_id = inject.get_injectable("trace_hh_id", None)
             if (all(logsum_df['logsum'] == UNAVAILABLE)) or (len(logsum_df) == 0):
@@ -843,9 +1240,9 @@ class TransitVirtualPathBuilder(object):
 
         with chunk.chunk_log(trace_label):
             result = \
-                self.build_virtual_path(recipe, path_type, orig, dest, tod,
-                                        demographic_segment=None, want_choices=False,
-                                        trace_label=trace_label)
+                self.cached_virtual_path(recipe, path_type, orig, dest, tod,
+                                         demographic_segment=None, want_choices=False,
+                                         trace_label=trace_label)
 
             trace_od = inject.get_injectable("trace_od", None)
             if trace_od:
@@ -72,6 +72,19 @@ def memo(tag, console=False, disable_gc=True):
 class TVPBCache(object):
     """
     Transit virtual path builder cache for three zone systems
+
+    The tvpb_cache_type network_los setting specifies the type of cache:
+
+    STATIC (the default) cache is fully populated by the initialize_tvpb step before any models are run,
+    and is shared with subprocesses via a shared data buffer when multiprocessing.
+
+    DYNAMIC cache is populated on demand (by TransitVirtualPathBuilder.lookup_tap_tap_utilities) with utilities
+    for the uids that are actually looked up. Utilities are stored in a file-backed memmap (so that the filled
+    portion persists for subsequent runs unless rebuild_tvpb_cache) with a one byte per uid validity flag array
+    in a second memmap file. Both memmaps are opened read/write by every process, so when multiprocessing,
+    subprocesses share (and fill) the same data via the os page cache.
+    Concurrent writes are safe without locking because utilities for a uid are the same no matter which process
+    computes them, and utilities are always written before the validity flag is set.
     """
     def __init__(self, network_los, uid_calculator, cache_tag):
 
@@ -82,15 +95,28 @@ class TVPBCache(object):
         self.network_los = network_los
         self.uid_calculator = uid_calculator
 
+        self.cache_type = network_los.setting('tvpb_cache_type', STATIC)
+        assert self.cache_type in [STATIC, DYNAMIC], f"unrecognized tvpb_cache_type setting '{self.cache_type}'"
+
         self.is_open = False
         self.is_changed = False
         self._data = None
+        self._valid = None
+
+    @property
+    def is_dynamic(self):
+        return self.cache_type == DYNAMIC
 
     @property
     def cache_path(self):
         file_type = 'mmap'
         return os.path.join(config.get_cache_dir(), f'{self.cache_tag}.{file_type}')
 
+    @property
+    def valid_path(self):
+        # DYNAMIC cache validity flags
+        return os.path.join(config.get_cache_dir(), f'{self.cache_tag}_valid.mmap')
+
     @property
     def csv_trace_path(self):
         file_type = 'csv'
@@ -100,9 +126,10 @@ class TVPBCache(object):
         """
         Called prior to
         """
-        if os.path.isfile(self.cache_path):
-            logger.debug(f"deleting cache {self.cache_path}")
-            os.unlink(self.cache_path)
+        for path in [self.cache_path, self.valid_path]:
+            if os.path.isfile(path):
+                logger.debug(f"deleting cache {path}")
+                os.unlink(path)
 
     def write_static_cache(self, data):
 
@@ -127,12 +154,86 @@ class TVPBCache(object):
         logger.debug(f"#TVPB CACHE write_static_cache wrote static cache table "
                      f"({data.shape}) to {self.cache_path}")
 
+    def create_dynamic_cache(self):
+        """
+        create empty DYNAMIC cache data and validity flag memmap files, unless they already exist
+
+        Files are created with a temp name and then linked to their canonical names (which fails if the file
+        already exists) so processes racing to create the cache never replace a file another process has opened.
+        """
+
+        assert self.is_dynamic
+
+        num_rows, num_sets = self.uid_calculator.fully_populated_shape
+
+        for path, shape, dtype_name in [(self.cache_path, (num_rows, num_sets), DTYPE_NAME),
+                                        (self.valid_path, (num_rows,), 'uint8')]:
+
+            if os.path.isfile(path):
+                continue
+
+            # memmap w+ creates a sparse zero-filled file, so disk (and RAM) is only used for filled uids
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            mm_data = np.memmap(temp_path, shape=shape, dtype=dtype_name, mode='w+')
+            mm_data.flush()
+            mm_data._mmap.close()
+            del mm_data
+
+            try:
+                os.link(temp_path, path)
+                logger.debug(f"TVPBCache.create_dynamic_cache created {path} {shape}")
+            except FileExistsError:
+                pass
+            os.unlink(temp_path)
+
+    def open_dynamic_cache(self):
+        """
+        open (creating if necessary) DYNAMIC cache data and validity flag memmaps read/write
+        """
+
+        self.create_dynamic_cache()
+
+        num_rows, num_sets = self.uid_calculator.fully_populated_shape
+
+        data = np.memmap(self.cache_path, shape=(num_rows, num_sets), dtype=DTYPE_NAME, mode='r+')
+        valid = np.memmap(self.valid_path, shape=(num_rows,), dtype='uint8', mode='r+')
+
+        logger.info(f"TVPBCache.open {self.cache_tag} DYNAMIC cache with {util.INT(self.num_valid(valid))} "
+                    f"of {util.INT(num_rows)} uids populated")
+
+        return data, valid
+
+    @staticmethod
+    def num_valid(valid):
+        return np.count_nonzero(valid)
+
+    def uncached(self, uids):
+        """
+        return boolean mask of uids whose utilities are not (yet) in DYNAMIC cache
+        """
+        assert self.is_open and self.is_dynamic
+        return self._valid[uids] == 0
+
+    def add_to_cache(self, uids, utilities):
+        """
+        add utilities (ndarray with one column per set) for uids to DYNAMIC cache
+        """
+        assert self.is_open and self.is_dynamic
+        assert utilities.shape == (len(uids), self._data.shape[1])
+
+        # write utilities before validity flags so other processes never read utilities of a uid flagged as valid
+        # before they have been written
+        self._data[uids, :] = utilities
+        self._valid[uids] = 1
+        self.is_changed = True
+
     def open(self):
         """
-        open STATIC cache and populate with cached data
+        open STATIC cache and populate with cached data, or open DYNAMIC cache
 
         if multiprocessing
-            always STATIC cache with data fully_populated preloaded shared data buffer
+            STATIC cache with data fully_populated preloaded shared data buffer
+            DYNAMIC cache memmaps are shared (via os page cache) with other processes
         """
         # MMAP only supported for fully_populated_uids (STATIC)
         # otherwise we would have to store uid index as float, which has roundoff issues for float32
@@ -140,6 +241,10 @@ class TVPBCache(object):
         assert not self.is_open, f"TVPBCache open called but already open"
         self.is_open = True
 
+        if self.is_dynamic:
+            self._data, self._valid = self.open_dynamic_cache()
+            return
+
         if self.network_los.multiprocess():
             # multiprocessing usex preloaded fully_populated shared data buffer
             with memo("TVPBCache.open get_data_and_lock_from_buffers"):
@@ -183,9 +288,17 @@ class TVPBCache(object):
 
         assert self.is_open, f"TVPBCache close called but not open"
 
+        if self.is_dynamic:
+            if self.is_changed:
+                self._data.flush()
+                self._valid.flush()
+                logger.debug(f"TVPBCache.close {self.cache_tag} DYNAMIC cache has "
+                             f"{util.INT(self.num_valid(self._valid))} uids populated")
+            self._valid = None
+
         self.is_open = False
+        self.is_changed = False
         self._data = None
-        self.cache_type = None
 
     @property
     def data(self):
@@ -209,7 +322,8 @@ class TVPBCache(object):
         """
 
         assert not self.is_open
-        assert shared == self.network_los.multiprocess()
+        # (single process initialize_tvpb uses a shared buffer if it fans out to a pool of worker processes)
+        assert shared or not self.network_los.multiprocess()
 
         dtype_name = DTYPE_NAME
         dtype = np.dtype(DTYPE_NAME)
@@ -272,17 +386,15 @@ class TVPBCache(object):
             np.copyto(np_wrapped_data_buffer, np.nan)
             logger.debug(f"TVPBCache.load_data_to_buffer - saved cache file not found.")
 
-    def get_data_and_lock_from_buffers(self):
+    @staticmethod
+    def wrap_data_buffer(data_buffer):
         """
-        return shared data buffer previously allocated by allocate_data_buffer and injected mp_tasks.run_simulation
+        wrap shared data buffer allocated by allocate_data_buffer as numpy array
+
         Returns
         -------
-        either multiprocessing.Array and lock or multiprocessing.RawArray and None according to RAWARRAY
+        numpy array and lock (multiprocessing.Array) or None (multiprocessing.RawArray) according to RAWARRAY
         """
-        data_buffers = inject.get_injectable('data_buffers', None)
-        assert self.cache_tag in data_buffers  # internal error
-        logger.debug(f"TVPBCache.get_data_and_lock_from_buffers")
-        data_buffer = data_buffers[self.cache_tag]
         if RAWARRAY:
             data = np.ctypeslib.as_array(data_buffer)
             lock = None
@@ -292,6 +404,222 @@ class TVPBCache(object):
 
         return data, lock
 
+    def get_data_and_lock_from_buffers(self):
+        """
+        return shared data buffer previously allocated by allocate_data_buffer and injected mp_tasks.run_simulation
+        Returns
+        -------
+        either multiprocessing.Array and lock or multiprocessing.RawArray and None according to RAWARRAY
+        """
+        data_buffers = inject.get_injectable('data_buffers', None)
+        assert self.cache_tag in data_buffers  # internal error
+        logger.debug(f"TVPBCache.get_data_and_lock_from_buffers")
+        return self.wrap_data_buffer(data_buffers[self.cache_tag])
+
+    @property
+    def progress_tag(self):
+        # shared buffer tag for initialize_tvpb progress counters
+        return f'{self.cache_tag}_progress'
+
+    def allocate_progress_buffer(self):
+        """
+        allocate shared initialize_tvpb progress buffer with a counter per attribute combination (skim offset)
+        of the number of od rows whose utilities have been computed
+
+        This allows processes to determine when the STATIC cache is fully populated without scanning it for nans.
+
+        Returns
+        -------
+        multiprocessing.Array (with lock, since counters are incremented by multiple processes)
+        """
+        num_offsets = self.uid_calculator.skim_shape[0]
+        return multiprocessing.Array('q', num_offsets)
+
+    def get_progress_and_lock_from_buffers(self):
+        """
+        return numpy wrapped progress buffer allocated by allocate_progress_buffer and its lock
+        """
+        data_buffers = inject.get_injectable('data_buffers', None)
+        assert self.progress_tag in data_buffers  # internal error
+        progress_buffer = data_buffers[self.progress_tag]
+        return np.ctypeslib.as_array(progress_buffer.get_obj()), progress_buffer.get_lock()
+
+
+class TVPBLogsumCache(object):
+    """
+    Bounded least recently used (LRU) cache of TVPB logsums (or best transit times) keyed by
+    (recipe, path_type, omaz, dmaz, tod, demographic_segment)
+
+    The same maz od pairs, time periods and segments recur heavily across the models that use tvpb logsums
+    (e.g. location choice, scheduling, tour and trip mode choice) so TransitVirtualPathBuilder can skip
+    building virtual paths for rows whose logsums are already in the cache.
+
+    Keys are packed into int64 (attribute code, omaz, dmaz) where the attribute code enumerates the
+    (recipe, path_type, tod, demographic_segment) combinations seen so far, so that lookups and stores
+    are vectorized searches of sorted key arrays rather than per row dict operations.
+    Recency is tracked by stamping each entry with a counter as it is stored or looked up.
+
+    The cache is local to the process (each multiprocessing subprocess has its own cache).
+    """
+
+    ZONE_BITS = 24
+    ATTRIBUTE_BITS = 63 - 2 * ZONE_BITS
+
+    def __init__(self, max_size):
+
+        assert max_size > 0
+        self.max_size = max_size
+
+        # sorted packed keys, with values and last used stamps in the same order
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._values = np.zeros(0, dtype=np.float64)
+        self._last_used = np.zeros(0, dtype=np.int64)
+        self._clock = 0
+
+        # {(recipe, path_type, tod, demographic_segment): attribute_code}
+        self._attribute_codes = {}
+
+        # {stats_tag: [num_lookups, num_hits]} for hit rate instrumentation
+        self.stats = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _attribute_code(self, attributes):
+        code = self._attribute_codes.setdefault(attributes, len(self._attribute_codes))
+        assert code < (1 << self.ATTRIBUTE_BITS), \
+            "TVPBLogsumCache too many (recipe, path_type, tod, demographic_segment) combinations"
+        return code
+
+    def _tick(self, n):
+        stamps = np.arange(self._clock, self._clock + n, dtype=np.int64)
+        self._clock += n
+        return stamps
+
+    def keys(self, recipe, path_type, orig, dest, tod, demographic_segment):
+        """
+        packed int64 cache keys for orig, dest, tod, demographic_segment rows
+
+        Parameters
+        ----------
+        recipe: str
+        path_type: str
+        orig: pandas.Series of omaz zone_ids
+        dest: pandas.Series of dmaz zone_ids
+        tod: str or pandas.Series
+        demographic_segment: pandas.Series or None
+
+        Returns
+        -------
+        int64 ndarray
+        """
+        num_rows = len(orig)
+
+        # enumerate the (tod, demographic_segment) combinations of rows, then map them to attribute codes
+        tod_codes, tods = (np.zeros(num_rows, dtype=np.int64), [tod]) if isinstance(tod, str) \
+            else pd.factorize(tod.values)
+        segment_codes, segments = (np.zeros(num_rows, dtype=np.int64), [None]) if demographic_segment is None \
+            else pd.factorize(demographic_segment.values)
+        row_codes, combinations = pd.factorize(tod_codes * len(segments) + segment_codes)
+
+        attribute_codes = [self._attribute_code((recipe, path_type,
+                                                 tods[c // len(segments)], segments[c % len(segments)]))
+                           for c in combinations]
+
+        orig = orig.values.astype(np.int64)
+        dest = dest.values.astype(np.int64)
+        max_zone_id = (1 << self.ZONE_BITS) - 1
+        assert num_rows == 0 or (orig.min() >= 0 and dest.min() >= 0 and
+                                 orig.max() <= max_zone_id and dest.max() <= max_zone_id), \
+            f"TVPBLogsumCache maz zone_ids must be between 0 and {max_zone_id}"
+
+        attribute_codes = np.asarray(attribute_codes, dtype=np.int64)[row_codes]
+        return (attribute_codes << (2 * self.ZONE_BITS)) | (orig << self.ZONE_BITS) | dest
+
+    def _find(self, keys):
+        # positions of keys in (sorted) self._keys, and whether they were found there
+        # (searching in sorted order is much more cache friendly than searching in row order)
+        order = np.argsort(keys)
+        positions = np.empty(len(keys), dtype=np.int64)
+        positions[order] = np.searchsorted(self._keys, keys[order])
+        found = np.zeros(len(keys), dtype=bool)
+        in_range = positions < len(self._keys)
+        found[in_range] = self._keys[positions[in_range]] == keys[in_range]
+        return positions, found
+
+    def lookup(self, keys, stats_tag):
+        """
+        look up cached values of keys (and mark them as most recently used)
+
+        Returns
+        -------
+        values: float ndarray of cached values (nan if not in cache)
+        hit: boolean ndarray, True where key was in cache
+        """
+        positions, hit = self._find(keys)
+
+        values = np.full(len(keys), np.nan)
+        values[hit] = self._values[positions[hit]]
+        self._last_used[positions[hit]] = self._tick(len(keys))[hit]
+
+        stats = self.stats.setdefault(stats_tag, [0, 0])
+        stats[0] += len(keys)
+        stats[1] += int(hit.sum())
+
+        return values, hit
+
+    def store(self, keys, values):
+        """
+        add values of keys to cache, evicting least recently used values if cache is full
+        """
+        keys = np.asanyarray(keys, dtype=np.int64)
+        values = np.asanyarray(values, dtype=np.float64)
+        stamps = self._tick(len(keys))
+
+        # last value of each distinct key (rows often repeat od pairs)
+        keys, last = np.unique(keys[::-1], return_index=True)
+        values = values[::-1][last]
+        stamps = stamps[::-1][last]
+
+        positions, found = self._find(keys)
+
+        # update values of keys already in cache
+        self._values[positions[found]] = values[found]
+        self._last_used[positions[found]] = stamps[found]
+
+        # insert new keys (np.unique sorted them) keeping self._keys sorted
+        new = ~found
+        if new.any():
+            self._keys = np.insert(self._keys, positions[new], keys[new])
+            self._values = np.insert(self._values, positions[new], values[new])
+            self._last_used = np.insert(self._last_used, positions[new], stamps[new])
+
+        num_evict = len(self._keys) - self.max_size
+        if num_evict > 0:
+            keep = np.ones(len(self._keys), dtype=bool)
+            keep[np.argpartition(self._last_used, num_evict - 1)[:num_evict]] = False
+            self._keys = self._keys[keep]
+            self._values = self._values[keep]
+            self._last_used = self._last_used[keep]
+
+    def hit_rate(self, stats_tag=None):
+        """
+        fraction of lookups (of stats_tag, or of all lookups if stats_tag is None) that were cache hits
+        """
+        stats = [self.stats.get(stats_tag, [0, 0])] if stats_tag else list(self.stats.values())
+        num_lookups = sum(s[0] for s in stats)
+        num_hits = sum(s[1] for s in stats)
+        return num_hits / num_lookups if num_lookups else 0.0
+
+    def stats_df(self):
+        """
+        DataFrame with lookups, hits and hit_rate columns indexed by stats_tag
+        """
+        df = pd.DataFrame.from_dict(self.stats, orient='index', columns=['lookups', 'hits'])
+        df.index.name = 'stats_tag'
+        df['hit_rate'] = df.hits / df.lookups
+        return df
+
 
 class TapTapUidCalculator(object):
     """
@@ -6,6 +6,7 @@ from builtins import object
 
 import os
 import logging
+import hashlib
 import datetime as dt
 
 import pandas as pd
@@ -17,6 +18,7 @@ from . import config
 from . import random
 from . import tracing
 from . import mem
+from . import pipeline_store
 
 
 from . import util
@@ -34,6 +36,14 @@ NON_TABLE_COLUMNS = [CHECKPOINT_NAME, TIMESTAMP]
 # name used for storing the checkpoints dataframe to the pipeline store
 CHECKPOINT_TABLE_NAME = 'checkpoints'
 
+# prefix of keys of column maps of tables checkpointed as column deltas (see write_table_checkpoint)
+COLUMN_MAP_TABLE_NAME = 'column_map'
+TABLE_KEY = 'table_key'
+
+# name of table mapping keys of tables mirrored from another pipeline store to that store (see read_df)
+MIRRORED_TABLE_NAME = 'mirrored_tables'
+STORE_PATH = 'store_path'
+
 # name of the first step/checkpoint created when the pipeline is started
 INITIAL_CHECKPOINT_NAME = 'init'
 FINAL_CHECKPOINT_NAME = 'final'
@@ -59,6 +69,12 @@ class Pipeline(object):
 
         self.replaced_tables = {}
 
+        # fingerprints and store keys of checkpointed columns, if checkpoint_column_deltas
+        self.column_checkpoints = {}
+
+        # {<table_key>: (<store_path>, <table_key in that store>)} of tables read from another store
+        self.mirrored_tables = {}
+
         self._rng = random.Random()
 
         self.open_files = {}
@@ -117,22 +133,19 @@ def open_pipeline_store(overwrite=False):
     pipeline_file_path = config.pipeline_file_path(inject.get_injectable('pipeline_file_name'))
 
     if overwrite:
-        try:
-            if os.path.isfile(pipeline_file_path):
-                logger.debug("removing pipeline store: %s" % pipeline_file_path)
-                os.unlink(pipeline_file_path)
-        except Exception as e:
-            print(e)
-            logger.warning("Error removing %s: %s" % (pipeline_file_path, e))
+        pipeline_store.delete_store(pipeline_file_path)
+
+    _PIPELINE.pipeline_store = pipeline_store.open_store(pipeline_file_path, mode='a')
 
-    _PIPELINE.pipeline_store = pd.HDFStore(pipeline_file_path, mode='a')
+    _PIPELINE.mirrored_tables = read_mirrored_tables(_PIPELINE.pipeline_store)
 
     logger.debug(f"opened pipeline_store {pipeline_file_path}")
 
 
 def get_pipeline_store():
     """
-    Return the open pipeline hdf5 checkpoint store or return None if it not been opened
+    Return the open pipeline checkpoint store (pandas.HDFStore or pipeline_store.ParquetPipelineStore,
+    depending on pipeline_store_format setting) or return None if it not been opened
     """
     return _PIPELINE.pipeline_store
 
@@ -157,7 +170,7 @@ def read_df(table_name, checkpoint_name=None):
 
     The only exception is the checkpoints dataframe, which just has a table_name
 
-    An error will be raised by HDFStore if the table is not found
+    A KeyError will be raised by the store if the table is not found
 
     Parameters
     ----------
@@ -171,8 +184,98 @@ def read_df(table_name, checkpoint_name=None):
 
     """
 
+    table_key = pipeline_table_key(table_name, checkpoint_name)
+
+    if table_key in _PIPELINE.mirrored_tables:
+        store_path, mirrored_table_key = _PIPELINE.mirrored_tables[table_key]
+        logger.debug(f"read_df reading mirrored table {table_key} from {mirrored_table_key} in {store_path}")
+        with pipeline_store.open_store(store_path, mode='r') as store:
+            return read_store_table(store, mirrored_table_key)
+
     store = get_pipeline_store()
-    df = store[pipeline_table_key(table_name, checkpoint_name)]
+    df = read_store_table(store, table_key)
+
+    return df
+
+
+def read_mirrored_tables(store):
+    """
+    Read the map of tables that a (multiprocess sub-process) pipeline store reads from another store
+
+    Rather than writing an identical copy of each mirrored (not sliced) table to every sub-process
+    pipeline store, mp_tasks.apportion_pipeline writes a table (MIRRORED_TABLE_NAME) mapping their
+    table keys to the store path and table key of the (read-only) parent pipeline table.
+
+    Parameters
+    ----------
+    store : open pipeline store
+
+    Returns
+    -------
+    mirrored_tables : dict {<table_key>: (<store_path>, <table_key in that store>)}
+    """
+
+    if MIRRORED_TABLE_NAME not in store:
+        return {}
+
+    df = store[MIRRORED_TABLE_NAME]
+    return {table_key: (store_path, mirrored_table_key)
+            for table_key, store_path, mirrored_table_key in zip(df.index, df[STORE_PATH], df[TABLE_KEY])}
+
+
+def write_mirrored_tables(store, mirrored_tables):
+    """
+    Write the map of tables mirrored from another pipeline store (see read_mirrored_tables)
+
+    Parameters
+    ----------
+    store : open pipeline store
+    mirrored_tables : dict {<table_key>: (<store_path>, <table_key in that store>)}
+    """
+
+    df = pd.DataFrame({
+        STORE_PATH: [store_path for store_path, _ in mirrored_tables.values()],
+        TABLE_KEY: [mirrored_table_key for _, mirrored_table_key in mirrored_tables.values()],
+    }, index=pd.Index(list(mirrored_tables.keys()), dtype=str))
+
+    store[MIRRORED_TABLE_NAME] = df
+
+
+def column_map_key(table_key):
+    return f"{COLUMN_MAP_TABLE_NAME}/{table_key.strip('/')}"
+
+
+def read_store_table(store, table_key):
+    """
+    Read table from an open (possibly 'raw', not opened as pipeline) pipeline store
+
+    If the table was checkpointed as column deltas, reassemble it from the column fragments
+    listed in its column map, otherwise it is stored in its entirety under table_key.
+
+    Parameters
+    ----------
+    store : open pipeline store
+    table_key : str
+        as returned by pipeline_table_key
+
+    Returns
+    -------
+    df : pandas.DataFrame
+    """
+
+    map_key = column_map_key(table_key)
+    if map_key not in store:
+        return store[table_key]
+
+    # series with column name as index and key of fragment containing column as value
+    column_map = store[map_key][TABLE_KEY]
+
+    fragments = []
+    for fragment_key in column_map.unique():
+        fragment = store[fragment_key]
+        fragments.append(fragment[column_map.index[column_map == fragment_key]])
+
+    df = pd.concat(fragments, axis=1)[column_map.index]
 
     return df
 
@@ -197,6 +300,7 @@ def write_df(df, table_name, checkpoint_name=None):
     """
 
     # coerce column names to str as unicode names will cause PyTables to pickle them
+    # (and parquet requires str column names)
     df.columns = df.columns.astype(str)
 
     store = get_pipeline_store()
@@ -206,6 +310,103 @@ def write_df(df, table_name, checkpoint_name=None):
     store.flush()
 
 
+def fingerprint(values):
+    """
+    Return hash of dtype and values of a series or index, used to detect changed columns
+    """
+    hashes = pd.util.hash_pandas_object(values, index=False).values
+    return f"{values.dtype}:{hashlib.md5(hashes.tobytes()).hexdigest()}"
+
+
+def remember_column_checkpoints(df, table_name, checkpoint_name):
+    """
+    Remember fingerprints and store keys of the columns of a table loaded from checkpoint_name
+    so that subsequent checkpoints of the table can be written as column deltas
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        table as it was read from checkpoint_name
+    table_name : str
+    checkpoint_name : str
+    """
+
+    store = get_pipeline_store()
+    table_key = pipeline_table_key(table_name, checkpoint_name)
+
+    if table_key in _PIPELINE.mirrored_tables:
+        # not in this store, so the first checkpoint of the table in this store can't be written as deltas
+        return
+
+    # store keys of columns not written at checkpoint_name
+    map_key = column_map_key(table_key)
+    column_map = store[map_key][TABLE_KEY].to_dict() if map_key in store else {}
+
+    _PIPELINE.column_checkpoints[table_name] = {
+        'index': f"{df.index.name}:{fingerprint(df.index)}",
+        'columns': {c: (fingerprint(df[c]), column_map.get(c, table_key)) for c in df.columns},
+    }
+
+
+def write_table_checkpoint(df, table_name, checkpoint_name):
+    """
+    Write the checkpoint_name version of a table to the pipeline store.
+
+    If the checkpoint_column_deltas setting is True, only the columns that were added or changed
+    since the table was last checkpointed are written (unless the index changed) along with a
+    column map of the store keys of the unchanged columns, which read_store_table uses to reassemble
+    the table. Otherwise (or if all columns changed) the table is written in its entirety.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+    table_name : str
+    checkpoint_name : str
+    """
+
+    if not config.setting('checkpoint_column_deltas', False):
+        write_df(df, table_name, checkpoint_name)
+        return
+
+    df.columns = df.columns.astype(str)
+
+    table_key = pipeline_table_key(table_name, checkpoint_name)
+    index_fingerprint = f"{df.index.name}:{fingerprint(df.index)}"
+    column_fingerprints = {c: fingerprint(df[c]) for c in df.columns}
+
+    # column_map maps unchanged column names to the store key of the fragment they were written to
+    column_map = {}
+    previous = _PIPELINE.column_checkpoints.get(table_name)
+    if previous is not None and previous['index'] == index_fingerprint:
+        for c in df.columns:
+            previous_fingerprint, previous_key = previous['columns'].get(c, (None, None))
+            if previous_fingerprint == column_fingerprints[c]:
+                column_map[c] = previous_key
+
+    store = get_pipeline_store()
+    map_key = column_map_key(table_key)
+
+    changed_columns = [c for c in df.columns if c not in column_map]
+
+    if column_map:
+        logger.debug(f"write_table_checkpoint '{checkpoint_name}' table '{table_name}' "
+                     f"writing {len(changed_columns)} of {len(df.columns)} columns")
+        map_df = pd.DataFrame({TABLE_KEY: [column_map.get(c, table_key) for c in df.columns]}, index=df.columns)
+        store[map_key] = map_df
+        if changed_columns:
+            write_df(df[changed_columns], table_name, checkpoint_name)
+    else:
+        # forget any stale column map (e.g. from before we resumed)
+        if map_key in store:
+            store.remove(map_key)
+        write_df(df, table_name, checkpoint_name)
+
+    _PIPELINE.column_checkpoints[table_name] = {
+        'index': index_fingerprint,
+        'columns': {c: (column_fingerprints[c], column_map.get(c, table_key)) for c in df.columns},
+    }
+
+
 def rewrap(table_name, df=None):
     """
     Add or replace an orca registered table as a unitary DataFrame-backed DataFrameWrapper table
@@ -289,7 +490,7 @@ def add_checkpoint(checkpoint_name):
 
         logger.debug("add_checkpoint '%s' table '%s' %s" %
                      (checkpoint_name, table_name, util.df_size(df)))
-        write_df(df, table_name, checkpoint_name)
+        write_table_checkpoint(df, table_name, checkpoint_name)
 
         # remember which checkpoint it was last written
         _PIPELINE.last_checkpoint[table_name] = checkpoint_name
@@ -389,6 +590,8 @@ def load_checkpoint(checkpoint_name):
         # read dataframe from pipeline store
         df = read_df(table_name, checkpoint_name=_PIPELINE.last_checkpoint[table_name])
         logger.info("load_checkpoint table %s %s" % (table_name, df.shape))
+        if config.setting('checkpoint_column_deltas', False):
+            remember_column_checkpoints(df, table_name, _PIPELINE.last_checkpoint[table_name])
         # register it as an orca table
         rewrap(table_name, df)
         loaded_tables[table_name] = df
@@ -507,6 +710,7 @@ def open_pipeline(resume_after=None):
     _PIPELINE.is_open = True
 
     get_rn_generator().set_base_seed(inject.get_injectable('rng_base_seed', 0))
+    get_rn_generator().set_channel_type(config.setting('rng_channel_type', 'simple'))
 
     if resume_after:
         # open existing pipeline
@@ -709,7 +913,8 @@ def get_checkpoints():
         df = store[CHECKPOINT_TABLE_NAME]
     else:
         pipeline_file_path = config.pipeline_file_path(orca.get_injectable('pipeline_file_name'))
-        df = pd.read_hdf(pipeline_file_path, CHECKPOINT_TABLE_NAME)
+        with pipeline_store.open_store(pipeline_file_path, mode='r') as store:
+            df = store[CHECKPOINT_TABLE_NAME]
 
     # non-table columns first (column order in df is random because created from a dict)
     table_names = [name for name in df.columns.values if name not in NON_TABLE_COLUMNS]
@@ -824,6 +1029,8 @@ def drop_table(table_name):
 
         logger.debug("drop_table removing table %s from last_checkpoint" % table_name)
 
+        _PIPELINE.column_checkpoints.pop(table_name, None)
+
         _PIPELINE.last_checkpoint[table_name] = ''
 
 
@@ -863,7 +1070,7 @@ def cleanup_pipeline():
     checkpoints_df = get_checkpoints().tail(1).copy()
     checkpoints_df['checkpoint_name'] = FINAL_CHECKPOINT_NAME
 
-    with pd.HDFStore(final_pipeline_file_path, mode='w') as final_pipeline_store:
+    with pipeline_store.open_store(final_pipeline_file_path, mode='w') as final_pipeline_store:
 
         for table_name in checkpointed_tables():
             # patch last checkpoint name for all tables
@@ -879,4 +1086,14 @@ def cleanup_pipeline():
     close_pipeline()
 
     logger.debug(f"deleting all pipeline files except {final_pipeline_file_path}")
-    tracing.delete_output_files('h5', ignore=[final_pipeline_file_path])
+    if pipeline_store.store_format() == 'hdf5':
+        tracing.delete_output_files('h5', ignore=[final_pipeline_file_path])
+    else:
+        # main and sub-process pipeline stores are directories named <prefix>-<pipeline_file_name>
+        output_dir = inject.get_injectable('output_dir')
+        pipeline_file_name = inject.get_injectable('pipeline_file_name')
+        for file_name in os.listdir(output_dir):
+            file_path = os.path.join(output_dir, file_name)
+            if file_name.endswith(pipeline_file_name) and \
+                    os.path.realpath(file_path) != os.path.realpath(final_pipeline_file_path):
+                pipeline_store.delete_store(file_path)
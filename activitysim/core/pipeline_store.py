@@ -0,0 +1,183 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+import logging
+import os
+import shutil
+
+import pandas as pd
+
+from activitysim.core import config
+
+logger = logging.getLogger(__name__)
+
+PARQUET_SUFFIX = '.parquet'
+
+
+class HDF5PipelineStore(pd.HDFStore):
+    """
+    Pipeline store backed by a single hdf5 file (the default)
+
+    This is simply a pandas.HDFStore, optionally with compression (compression is the name of the
+    hdf5 complib, e.g. 'blosc:zstd')
+    """
+
+    def __init__(self, path, mode='a', compression=None):
+
+        if compression:
+            super().__init__(path, mode=mode, complib=compression, complevel=5)
+        else:
+            super().__init__(path, mode=mode)
+
+
+class ParquetPipelineStore(object):
+    """
+    Pipeline store backed by a directory with one parquet file per table key
+
+    Supports the subset of the pandas.HDFStore interface used by the pipeline: keys are the same
+    as hdf5 keys (e.g. '/checkpoints' or 'persons/init') and are stored in <path>/checkpoints.parquet
+    and <path>/persons/init.parquet respectively.
+
+    Since every table (and checkpoint version of a table) is a separate file, tables are written
+    without rewriting the rest of the store, can be read (memory mapped) concurrently by other
+    processes, and compression can be specified per column (compression can be either the name of
+    a parquet codec or a dict mapping column names to codecs)
+    """
+
+    def __init__(self, path, mode='a', compression='snappy'):
+
+        assert mode in ['r', 'a', 'w'], f"ParquetPipelineStore unsupported mode '{mode}'"
+
+        if mode == 'w':
+            delete_store(path)
+
+        if mode == 'r':
+            if not os.path.isdir(path):
+                raise FileNotFoundError(f"ParquetPipelineStore {path} not found")
+        else:
+            os.makedirs(path, exist_ok=True)
+
+        self.filename = path
+        self.mode = mode
+        self.compression = compression
+        self.is_open = True
+
+    def _file_path(self, key):
+        return os.path.join(self.filename, *key.strip('/').split('/')) + PARQUET_SUFFIX
+
+    def __contains__(self, key):
+        return os.path.isfile(self._file_path(key))
+
+    def __getitem__(self, key):
+
+        assert self.is_open, f"ParquetPipelineStore {self.filename} is not open"
+
+        file_path = self._file_path(key)
+        if not os.path.isfile(file_path):
+            raise KeyError(f"No object named {key} in the file")
+
+        return pd.read_parquet(file_path, memory_map=True)
+
+    def __setitem__(self, key, df):
+
+        assert self.is_open, f"ParquetPipelineStore {self.filename} is not open"
+        assert self.mode != 'r', f"ParquetPipelineStore {self.filename} opened read-only"
+
+        file_path = self._file_path(key)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+        # write to temp file and rename so readers never see a partially written table
+        temp_path = f"{file_path}.tmp"
+        df.to_parquet(temp_path, compression=self.compression)
+        os.replace(temp_path, file_path)
+
+    def remove(self, key):
+        """
+        Remove table from store
+        """
+        assert self.mode != 'r', f"ParquetPipelineStore {self.filename} opened read-only"
+        os.unlink(self._file_path(key))
+
+    def keys(self):
+        """
+        Return list of keys (with leading '/' like pandas.HDFStore.keys) of all tables in store
+        """
+        keys = []
+        for dir_path, _, file_names in os.walk(self.filename):
+            for file_name in file_names:
+                if file_name.endswith(PARQUET_SUFFIX):
+                    rel_path = os.path.relpath(os.path.join(dir_path, file_name), self.filename)
+                    keys.append('/' + rel_path[:-len(PARQUET_SUFFIX)].replace(os.sep, '/'))
+        return sorted(keys)
+
+    def flush(self):
+        # tables are written in their entirety by __setitem__
+        pass
+
+    def close(self):
+        self.is_open = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+PIPELINE_STORES = {
+    'hdf5': HDF5PipelineStore,
+    'parquet': ParquetPipelineStore,
+}
+
+
+def store_format():
+    """
+    Return the pipeline_store_format setting (name of PIPELINE_STORES class)
+    """
+
+    store_format = config.setting('pipeline_store_format', 'hdf5')
+
+    if store_format not in PIPELINE_STORES:
+        raise RuntimeError(f"Unrecognized pipeline_store_format setting '{store_format}'")
+
+    return store_format
+
+
+def open_store(path, mode='a'):
+    """
+    Open a pipeline store of the type specified by the pipeline_store_format setting
+
+    Parameters
+    ----------
+    path : str
+        path of pipeline file (or directory, depending on store type)
+    mode : str
+        'r', 'a' or 'w' as for pandas.HDFStore
+
+    Returns
+    -------
+    store : HDF5PipelineStore or ParquetPipelineStore
+    """
+
+    kwargs = {}
+    compression = config.setting('pipeline_store_compression', None)
+    if compression:
+        kwargs['compression'] = compression
+
+    return PIPELINE_STORES[store_format()](path, mode=mode, **kwargs)
+
+
+def delete_store(path):
+    """
+    Delete pipeline store file or directory, if it exists
+    """
+
+    try:
+        if os.path.isdir(path):
+            logger.debug(f"removing pipeline store: {path}")
+            shutil.rmtree(path)
+        elif os.path.isfile(path):
+            logger.debug(f"removing pipeline store: {path}")
+            os.unlink(path)
+    except Exception as e:
+        print(e)
+        logger.warning(f"Error removing {path}: {e}")
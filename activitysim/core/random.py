@@ -20,6 +20,17 @@ logger = logging.getLogger(__name__)
 _MAX_SEED = (1 << 32)
 _SEED_MASK = 0xffffffff
 
+# Philox4x32-10 multipliers and Weyl key increments
+# (Salmon, Moraes, Dror, Shaw 2011 "Parallel Random Numbers: As Easy as 1, 2, 3")
+_PHILOX_M0 = np.uint64(0xD2511F53)
+_PHILOX_M1 = np.uint64(0xCD9E8D57)
+_PHILOX_W0 = np.uint64(0x9E3779B9)
+_PHILOX_W1 = np.uint64(0xBB67AE85)
+_PHILOX_ROUNDS = 10
+
+_U32 = np.uint64(_SEED_MASK)
+_SHIFT_32 = np.uint64(32)
+
 
 def hash32(s):
     """
@@ -37,6 +48,50 @@ def hash32(s):
     return int(h, base=16) & _SEED_MASK
 
 
+def philox4x32(counter, key, rounds=_PHILOX_ROUNDS):
+    """
+    Vectorized Philox4x32 counter-based bijection.
+
+    Each element of the (broadcast) counter arrays is mapped to 4 pseudo-random 32 bit words
+    with no state other than the counter and key, so any element of a stream can be computed
+    directly without generating (or replaying) the elements that precede it.
+
+    Parameters
+    ----------
+    counter : tuple of 4 uint32 values or arrays (broadcastable)
+    key : tuple of 2 uint32 values or arrays (broadcastable)
+    rounds : int
+        number of rounds (10 is the standard, crush-resistant, choice)
+
+    Returns
+    -------
+    words : tuple of 4 numpy.ndarray of dtype uint64 holding uint32 values
+    """
+
+    # uint64 so that 32x32 bit products don't overflow
+    c0, c1, c2, c3 = [np.asanyarray(c, dtype=np.uint64) for c in counter]
+    k0, k1 = [np.asanyarray(k, dtype=np.uint64) for k in key]
+
+    for r in range(rounds):
+        if r > 0:
+            k0 = (k0 + _PHILOX_W0) & _U32
+            k1 = (k1 + _PHILOX_W1) & _U32
+        p0 = _PHILOX_M0 * c0
+        p1 = _PHILOX_M1 * c2
+        c0, c1, c2, c3 = \
+            (p1 >> _SHIFT_32) ^ c1 ^ k0, p1 & _U32, (p0 >> _SHIFT_32) ^ c3 ^ k1, p0 & _U32
+
+    return tuple(np.broadcast_arrays(c0, c1, c2, c3))
+
+
+def _words_to_uniform(hi, lo):
+    """
+    Convert pairs of uint32 words to 53 bit floats in range [0, 1)
+    (using the same construction as numpy.random.RandomState.random_sample)
+    """
+    return ((hi >> np.uint64(5)) * 67108864.0 + (lo >> np.uint64(6))) / 9007199254740992.0
+
+
 class SimpleChannel(object):
     """
 
@@ -362,11 +417,128 @@ class SimpleChannel(object):
         return sample
 
 
+class PhiloxChannel(SimpleChannel):
+    """
+    Counter-based alternative to SimpleChannel
+
+    Rather than reseeding a RandomState for every row and fast-forwarding it past the rands
+    already consumed this step, the k-th rand for a row is computed directly as
+
+        philox4x32(counter=(k, row_id_lo, row_id_hi, base_seed), key=(channel_seed, step_seed))
+
+    so the rands for all rows in df (and all n draws per row) are computed in a single vectorized
+    pass. Since the stream for a row depends only on its index value and the number of rands it
+    has already consumed in the step, results are the same regardless of chunking or of how
+    rows are apportioned among sub-processes.
+
+    The streams are NOT the same as those generated by SimpleChannel, so results will differ
+    from runs made with the (default) 'simple' rng_channel_type.
+    """
+
+    def _words_for_df(self, df, n):
+        """
+        Return 4 (len(df), n) arrays of uint32 words from the next n positions in each row's
+        stream, and advance the row offsets accordingly.
+        """
+
+        # assert no dupes
+        assert len(df.index.unique()) == len(df.index)
+
+        offsets = self.row_states.loc[df.index, 'offset'].values.astype(np.uint64)
+        row_ids = df.index.values.astype(np.int64).astype(np.uint64)
+
+        draws = offsets.reshape(-1, 1) + np.arange(n, dtype=np.uint64)
+        row_ids = row_ids.reshape(-1, 1)
+
+        counter = (draws & _U32, row_ids & _U32, row_ids >> _SHIFT_32, self.base_seed & _SEED_MASK)
+        key = (self.channel_seed, self.step_seed)
+        w0, w1, w2, w3 = philox4x32(counter, key)
+
+        self.row_states.loc[df.index, 'offset'] += n
+
+        return w0, w1, w2, w3
+
+    def random_for_df(self, df, step_name, n=1):
+        """
+        Return n floating point random numbers in range [0, 1) for each row in df
+
+        See SimpleChannel.random_for_df
+        """
+
+        assert self.step_name
+        assert self.step_name == step_name
+
+        w0, w1, _, _ = self._words_for_df(df, n)
+
+        return _words_to_uniform(w0, w1)
+
+    def normal_for_df(self, df, step_name, mu, sigma, lognormal=False):
+        """
+        Return a floating point random number in normal (or lognormal) distribution
+        for each row in df (Box-Muller transform of a pair of uniforms from a single counter)
+
+        See SimpleChannel.normal_for_df
+        """
+
+        assert self.step_name
+        assert self.step_name == step_name
+
+        w0, w1, w2, w3 = self._words_for_df(df, 1)
+
+        u1 = _words_to_uniform(w0[:, 0], w1[:, 0])
+        u2 = _words_to_uniform(w2[:, 0], w3[:, 0])
+
+        # 1 - u1 is in (0, 1] so log is finite
+        z = np.sqrt(-2.0 * np.log(1.0 - u1)) * np.cos(2.0 * np.pi * u2)
+
+        mu = mu.values if isinstance(mu, pd.Series) else np.asanyarray(mu)
+        sigma = sigma.values if isinstance(sigma, pd.Series) else np.asanyarray(sigma)
+
+        rands = mu + sigma * z
+        if lognormal:
+            rands = np.exp(rands)
+
+        return rands
+
+    def choice_for_df(self, df, step_name, a, size, replace):
+        """
+        Choose size elements of a for each row in df, concatenated into a single (flat) array
+
+        Sampling with replacement consumes size rands per row. Sampling without replacement
+        ranks a random key for every element of a, and so consumes len(a) rands per row.
+
+        See SimpleChannel.choice_for_df
+        """
+
+        assert self.step_name
+        assert self.step_name == step_name
+
+        a = np.arange(a) if np.isscalar(a) else np.asanyarray(a)
+
+        if replace:
+            w0, w1, _, _ = self._words_for_df(df, size)
+            positions = (_words_to_uniform(w0, w1) * len(a)).astype(np.int64)
+        else:
+            assert size <= len(a)
+            w0, w1, _, _ = self._words_for_df(df, len(a))
+            positions = np.argsort(_words_to_uniform(w0, w1), axis=1, kind='stable')[:, :size]
+
+        return a[positions].ravel()
+
+
+# rng_channel_type setting values
+CHANNEL_TYPES = {
+    'simple': SimpleChannel,
+    'philox': PhiloxChannel,
+}
+
+
 class Random(object):
 
     def __init__(self):
 
         self.channels = {}
+        self.channel_type = 'simple'
 
         # dict mapping df index name to channel name
         self.index_to_channel = {}
@@ -471,11 +643,11 @@ class Random(object):
         else:
             logger.debug("Adding channel '%s' %s ids" % (channel_name, len(domain_df.index)))
 
-            channel = SimpleChannel(channel_name,
-                                    self.base_seed,
-                                    domain_df,
-                                    self.step_name
-                                    )
+            channel = CHANNEL_TYPES[self.channel_type](channel_name,
+                                                       self.base_seed,
+                                                       domain_df,
+                                                       self.step_name
+                                                       )
 
             self.channels[channel_name] = channel
             self.index_to_channel[domain_df.index.name] = channel_name
@@ -527,6 +699,32 @@ class Random(object):
             logger.debug("Set random seed base to %s" % seed)
             self.base_seed = seed
 
+    def set_channel_type(self, channel_type):
+        """
+        Select the class used to generate per-row random streams for channels
+
+        'simple' (the default) reseeds a numpy RandomState for every row and produces the
+        legacy streams. 'philox' (PhiloxChannel) computes rands for all rows in a single
+        vectorized pass, but produces different streams.
+
+        Must be called before first step (before any channels are added or rands are consumed)
+
+        Parameters
+        ----------
+        channel_type : str
+            one of the keys of CHANNEL_TYPES
+        """
+
+        if self.step_name is not None or self.channels:
+            raise RuntimeError("Can only call set_channel_type before the first step.")
+
+        if channel_type not in CHANNEL_TYPES:
+            raise RuntimeError("Unknown rng_channel_type '%s' (expected one of %s)" %
+                               (channel_type, list(CHANNEL_TYPES.keys())))
+
+        logger.debug("Set random channel type to %s" % channel_type)
+        self.channel_type = channel_type
+
     def get_global_rng(self):
         """
         Return a numpy random number generator for use within current step.
@@ -3,10 +3,12 @@
 
 from builtins import range
 
+import ast
 import warnings
 import logging
 from collections import OrderedDict
 
+import numba
 import numpy as np
 import pandas as pd
 
@@ -28,6 +30,42 @@ SPEC_LABEL_NAME = 'Label'
 
 ALT_LOSER_UTIL = -900
 
+# kinds of compiled spec expressions
+EXPR_LOCALS = 'locals'  # '@' expressions, python eval in the context of locals_d
+EXPR_COLUMNS = 'columns'  # simple expressions that python can evaluate directly on chooser columns
+EXPR_PANDAS = 'pandas'  # all other simple expressions, evaluated by DataFrame.eval
+
+# ast node types for which python eval of an expression on chooser column Series gives the same
+# result as DataFrame.eval (bitwise and boolean operators are excluded as DataFrame.eval gives them
+# lower precedence than comparisons, chained comparisons are excluded as they are not elementwise,
+# and division is excluded as numexpr divides by constants using the reciprocal)
+_COLUMN_EXPR_NODES = (
+    ast.Expression, ast.Name, ast.Load, ast.Constant,
+    ast.BinOp, ast.Add, ast.Sub, ast.Mult,
+    ast.UnaryOp, ast.USub, ast.UAdd,
+    ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE,
+)
+
+# cache of compiled expressions, keyed by expression string
+_COMPILED_EXPRESSIONS = {}
+
+
+@numba.njit(nogil=True)
+def _accumulate_utilities(alt_utilities, expression_value, alts, alt_coefficients):
+    """
+    add the utilities of one spec expression to alt_utilities (num_alts, num_choosers) in place
+    (with no temporary arrays)
+
+    alts and alt_coefficients are the (row) indexes and values of the expression's nonzero coefficients,
+    so the work depends only on the nonzero terms, and each is a contiguous pass over an alternative's utilities.
+    """
+    num_choosers = alt_utilities.shape[1]
+    for k in range(alts.shape[0]):
+        alt = alts[k]
+        coefficient = alt_coefficients[k]
+        for i in range(num_choosers):
+            alt_utilities[alt, i] += coefficient * expression_value[i]
+
 
 def random_rows(df, n):
 
@@ -125,6 +163,10 @@ def read_model_spec(file_name):
         spec = spec.set_index(SPEC_LABEL_NAME, append=True)
         assert isinstance(spec.index, pd.MultiIndex)
 
+    # compile expressions once, up front, rather than when they are first evaluated
+    for expr in spec.index.get_level_values(SPEC_EXPRESSION_NAME):
+        compile_expression(expr)
+
     return spec
 
 
@@ -386,6 +428,95 @@ def eval_coefficients(spec, coefficients, estimator):
     return spec
 
 
+def compile_expression(expr):
+    """
+    Parse and compile a spec expression (once) so that it can be evaluated repeatedly (e.g. for
+    every chunk) without re-parsing.
+
+    '@' expressions are compiled to python code objects. Simple expressions that are just arithmetic
+    and (unchained) comparisons of chooser columns and constants are also compiled to python code
+    objects that can be evaluated directly on the chooser columns, bypassing the (comparatively slow)
+    DataFrame.eval expression parser. Everything else is left for DataFrame.eval.
+
+    Parameters
+    ----------
+    expr : str
+        spec expression
+
+    Returns
+    -------
+    kind : str
+        one of EXPR_LOCALS, EXPR_COLUMNS, EXPR_PANDAS
+    code : code object or None
+    names : tuple of str
+        names referenced by simple (EXPR_COLUMNS or EXPR_PANDAS) expressions that python can parse
+    """
+
+    compiled = _COMPILED_EXPRESSIONS.get(expr)
+
+    if compiled is None:
+
+        if expr.startswith('@'):
+            compiled = (EXPR_LOCALS, compile(expr[1:], '<expression>', 'eval'), ())
+        else:
+            compiled = (EXPR_PANDAS, None, ())
+            try:
+                tree = ast.parse(expr.strip(), mode='eval')
+            except SyntaxError:
+                tree = None
+
+            if tree is not None:
+                nodes = list(ast.walk(tree))
+                names = tuple(sorted({node.id for node in nodes if isinstance(node, ast.Name)}))
+                compiled = (EXPR_PANDAS, None, names)
+                if all(isinstance(node, _COLUMN_EXPR_NODES) for node in nodes) and \
+                        all(len(node.ops) == 1 for node in nodes if isinstance(node, ast.Compare)):
+                    if names:
+                        compiled = (EXPR_COLUMNS, compile(tree, '<expression>', 'eval'), names)
+
+        _COMPILED_EXPRESSIONS[expr] = compiled
+
+    return compiled
+
+
+def eval_expression(expr, df, globals_dict, locals_dict):
+    """
+    Evaluate a spec expression in the context of df (using compile_expression)
+
+    Parameters
+    ----------
+    expr : str
+        spec expression
+    df : pandas.DataFrame
+        choosers
+    globals_dict : dict
+        globals for '@' expressions
+    locals_dict : dict
+        locals for '@' expressions
+
+    Returns
+    -------
+    pandas.Series, numpy.ndarray or scalar
+    """
+
+    kind, code, names = compile_expression(expr)
+
+    if kind == EXPR_LOCALS:
+        return eval(code, globals_dict, locals_dict)
+
+    if kind == EXPR_COLUMNS and all(name in df.columns for name in names):
+        columns = {}
+        for name in names:
+            column = df[name]
+            # DataFrame.eval (numexpr) upcasts narrow ints, so we do too to get the same overflow behavior
+            if column.dtype.kind in 'iu' and column.dtype.itemsize < 8:
+                column = column.astype(np.int64)
+            columns[name] = column
+        return eval(code, {'__builtins__': {}}, columns)
+
+    return df.eval(expr)
+
+
 def eval_utilities(spec, choosers, locals_d=None, trace_label=None,
                    have_trace_targets=False, trace_all_rows=False,
                    estimator=None, trace_column_names=None, log_alt_losers=False):
@@ -434,44 +565,63 @@ def eval_utilities(spec, choosers, locals_d=None, trace_label=None,
     else:
         exprs = spec.index
 
-    expression_values = np.empty((spec.shape[0], choosers.shape[0]))
-    chunk.log_df(trace_label, "expression_values", expression_values)
+    # expression_values are only needed for estimation and tracing, otherwise the fused
+    # _accumulate_utilities kernel adds each expression's utilities directly to utilities
+    want_expression_values = estimator or ((trace_all_rows or have_trace_targets) and (len(choosers) > 0))
 
-    i = 0
-    for expr, coefficients in zip(exprs, spec.values):
+    if want_expression_values:
+        expression_values = np.empty((spec.shape[0], choosers.shape[0]))
+        chunk.log_df(trace_label, "expression_values", expression_values)
 
-        try:
-            with warnings.catch_warnings(record=True) as w:
-                # Cause all warnings to always be triggered.
-                warnings.simplefilter("always")
-                if expr.startswith('@'):
-                    expression_value = eval(expr[1:], globals_dict, locals_dict)
+    # utilities of each alternative (transposed so that _accumulate_utilities can update them contiguously)
+    alt_utilities = np.zeros((spec.shape[1], choosers.shape[0]))
+    chunk.log_df(trace_label, "utilities", alt_utilities)
+
+    coefficients = spec.astype(np.float64).values
 
-                else:
-                    expression_value = choosers.eval(expr)
+    with warnings.catch_warnings(record=True) as w:
+        # Cause all warnings to always be triggered.
+        warnings.simplefilter("always")
+
+        for i, expr in enumerate(exprs):
+
+            try:
+                expression_value = eval_expression(expr, choosers, globals_dict, locals_dict)
 
                 if len(w) > 0:
                     for wrn in w:
                         logger.warning(f"{trace_label} - {type(wrn).__name__} ({wrn.message}) evaluating: {str(expr)}")
+                    del w[:]
 
-        except Exception as err:
-            logger.exception(f"{trace_label} - {type(err).__name__} ({str(err)}) evaluating: {str(expr)}")
-            raise err
+            except Exception as err:
+                logger.exception(f"{trace_label} - {type(err).__name__} ({str(err)}) evaluating: {str(expr)}")
+                raise err
 
-        if log_alt_losers:
-            # utils for each alt for this expression
-            # FIXME if we always did tis, we cold uem these and skip np.dot below
-            utils = np.outer(expression_value, coefficients)
-            losers = np.amax(utils, axis=1) < ALT_LOSER_UTIL
+            if log_alt_losers:
+                # utils for each alt for this expression
+                utils = np.outer(expression_value, coefficients[i])
+                losers = np.amax(utils, axis=1) < ALT_LOSER_UTIL
 
-            if losers.any():
-                logger.warning(f"{trace_label} - {sum(losers)} choosers of {len(losers)} "
-                               f"with prohibitive utilities for all alternatives for expression: {expr}")
+                if losers.any():
+                    logger.warning(f"{trace_label} - {sum(losers)} choosers of {len(losers)} "
+                                   f"with prohibitive utilities for all alternatives for expression: {expr}")
 
-        expression_values[i] = expression_value
-        i += 1
+            # array with a value for every chooser (expressions may be scalars, bool, int or float Series, ...)
+            # in a dtype that numba supports (not e.g. float16 or object)
+            expression_value = np.asarray(expression_value)
+            if not (expression_value.dtype.kind in 'biu' or expression_value.dtype in (np.float32, np.float64)):
+                expression_value = expression_value.astype(np.float64)
+            expression_value = np.broadcast_to(expression_value, (choosers.shape[0],))
 
-    chunk.log_df(trace_label, "expression_values", expression_values)
+            if want_expression_values:
+                expression_values[i] = expression_value
+
+            alts = np.flatnonzero(coefficients[i])
+            if len(alts) > 0:
+                _accumulate_utilities(alt_utilities, expression_value, alts, coefficients[i, alts])
+
+    if want_expression_values:
+        chunk.log_df(trace_label, "expression_values", expression_values)
 
     if estimator:
         df = pd.DataFrame(
@@ -481,8 +631,9 @@ def eval_utilities(spec, choosers, locals_d=None, trace_label=None,
         df.index.name = choosers.index.name
         estimator.write_expression_values(df)
 
-    # - compute_utilities
-    utilities = np.dot(expression_values.transpose(), spec.astype(np.float64).values)
+    # (row major, as downstream kernels process utilities a chooser at a time)
+    utilities = np.ascontiguousarray(alt_utilities.transpose())
+    del alt_utilities
     utilities = pd.DataFrame(data=utilities, index=choosers.index, columns=spec.columns)
 
     chunk.log_df(trace_label, "utilities", utilities)
@@ -525,8 +676,9 @@ def eval_utilities(spec, choosers, locals_d=None, trace_label=None,
                                  tracing.extend_trace_label(trace_label, name),
                                  slicer=None, transpose=False)
 
-    del expression_values
-    chunk.log_df(trace_label, "expression_values", None)
+    if want_expression_values:
+        del expression_values
+        chunk.log_df(trace_label, "expression_values", None)
 
     # no longer our problem - but our caller should re-log this...
     chunk.log_df(trace_label, "utilities", None)
@@ -599,10 +751,7 @@ def eval_variables(exprs, df, locals_d=None):
     values = OrderedDict()
     for expr in exprs:
         try:
-            if expr.startswith('@'):
-                expr_values = to_array(eval(expr[1:], globals_dict, locals_dict))
-            else:
-                expr_values = to_array(df.eval(expr))
+            expr_values = to_array(eval_expression(expr, df, globals_dict, locals_dict))
             # read model spec should ensure uniqueness, otherwise we should uniquify
             assert expr not in values
             values[expr] = expr_values
@@ -731,31 +880,11 @@ def compute_nested_exp_utilities(raw_utilities, nest_spec):
     nested_utilities : pandas.DataFrame
         Will have the index of `raw_utilities` and columns for exponentiated leaf and node utilities
     """
-    nested_utilities = pd.DataFrame(index=raw_utilities.index)
-
-    for nest in logit.each_nest(nest_spec, post_order=True):
-
-        name = nest.name
+    nests = logit.nest_arrays(nest_spec)
 
-        if nest.is_leaf:
-            # leaf_utility = raw_utility / nest.product_of_coefficients
-            nested_utilities[name] = \
-                raw_utilities[name].astype(float) / nest.product_of_coefficients
+    exp_utilities = nests.exp_utilities(raw_utilities.values, raw_utilities.columns)
 
-        else:
-            # nest node
-            # the alternative nested_utilities will already have been computed due to post_order
-            # this will RuntimeWarning: divide by zero encountered in log
-            # if all nest alternative utilities are zero
-            # but the resulting inf will become 0 when exp is applied below
-            with np.errstate(divide='ignore'):
-                nested_utilities[name] = \
-                    nest.coefficient * np.log(nested_utilities[nest.alternatives].sum(axis=1))
-
-        # exponentiate the utility
-        nested_utilities[name] = np.exp(nested_utilities[name])
-
-    return nested_utilities
+    return pd.DataFrame(exp_utilities.T, index=raw_utilities.index, columns=nests.names)
 
 
 def compute_nested_probabilities(nested_exp_utilities, nest_spec, trace_label):
@@ -777,19 +906,20 @@ def compute_nested_probabilities(nested_exp_utilities, nest_spec, trace_label):
     nested_probabilities : pandas.DataFrame
         Will have the index of `nested_exp_utilities` and columns for leaf and node probabilities
     """
+    nests = logit.nest_arrays(nest_spec)
 
-    nested_probabilities = pd.DataFrame(index=nested_exp_utilities.index)
-
-    for nest in logit.each_nest(nest_spec, type='node', post_order=False):
+    exp_utilities = nested_exp_utilities[nests.names].values.T
+    probs = nests.nested_probabilities(exp_utilities, trace_label=trace_label, index=nested_exp_utilities.index)
 
-        probs = logit.utils_to_probs(nested_exp_utilities[nest.alternatives],
-                                     trace_label=trace_label,
-                                     exponentiated=True,
-                                     allow_zero_probs=True)
+    return nested_probabilities_df(probs, nests, nested_exp_utilities.index)
 
-        nested_probabilities = pd.concat([nested_probabilities, probs], axis=1)
 
-    return nested_probabilities
+def nested_probabilities_df(nested_probabilities, nests, index):
+    """
+    nested_probabilities array (from NestArrays.nested_probabilities) as DataFrame for tracing
+    """
+    return pd.DataFrame(nested_probabilities[nests.probability_ixs].T, index=index,
+                        columns=[nests.names[i] for i in nests.probability_ixs])
 
 
 def compute_base_probabilities(nested_probabilities, nests, spec):
@@ -812,22 +942,15 @@ def compute_base_probabilities(nested_probabilities, nests, spec):
     base_probabilities : pandas.DataFrame
         Will have the index of `nested_probabilities` and columns for leaf base probabilities
     """
+    nests = logit.nest_arrays(nests)
 
-    base_probabilities = pd.DataFrame(index=nested_probabilities.index)
-
-    for nest in logit.each_nest(nests, type='leaf', post_order=False):
-
-        # skip root: it has a prob of 1 but we didn't compute a nested probability column for it
-        ancestors = nest.ancestors[1:]
+    probs = np.ones((nests.num_nodes, len(nested_probabilities)), dtype=np.float64)
+    probs[nests.probability_ixs] = nested_probabilities[[nests.names[i] for i in nests.probability_ixs]].values.T
 
-        base_probabilities[nest.name] = nested_probabilities[ancestors].prod(axis=1)
-
-    # reorder alternative columns to match spec
     # since these are alternatives chosen by column index, order of columns matters
-    assert(set(base_probabilities.columns) == set(spec.columns))
-    base_probabilities = base_probabilities[spec.columns]
+    base_probabilities = nests.base_probabilities(probs, spec.columns)
 
-    return base_probabilities
+    return pd.DataFrame(base_probabilities, index=nested_probabilities.index, columns=spec.columns)
 
 
 def eval_mnl(choosers, spec, locals_d, custom_chooser, estimator,
@@ -984,36 +1107,41 @@ def eval_nl(choosers, spec, nest_spec, locals_d, custom_chooser, estimator,
         tracing.trace_df(raw_utilities, '%s.raw_utilities' % trace_label,
                          column_labels=['alternative', 'utility'])
 
-    # exponentiated utilities of leaves and nests
-    nested_exp_utilities = compute_nested_exp_utilities(raw_utilities, nest_spec)
+    nests = logit.nest_arrays(nest_spec)
+
+    # exponentiated utilities of leaves and nests (node rows, chooser columns)
+    nested_exp_utilities = nests.exp_utilities(raw_utilities.values, raw_utilities.columns)
     chunk.log_df(trace_label, "nested_exp_utilities", nested_exp_utilities)
 
     del raw_utilities
     chunk.log_df(trace_label, 'raw_utilities', None)
 
     if have_trace_targets:
-        tracing.trace_df(nested_exp_utilities, '%s.nested_exp_utilities' % trace_label,
+        tracing.trace_df(pd.DataFrame(nested_exp_utilities.T, index=choosers.index, columns=nests.names),
+                         '%s.nested_exp_utilities' % trace_label,
                          column_labels=['alternative', 'utility'])
 
     # probabilities of alternatives relative to siblings sharing the same nest
     nested_probabilities = \
-        compute_nested_probabilities(nested_exp_utilities, nest_spec, trace_label=trace_label)
+        nests.nested_probabilities(nested_exp_utilities, trace_label=trace_label, index=choosers.index)
     chunk.log_df(trace_label, "nested_probabilities", nested_probabilities)
 
     if want_logsums:
         # logsum of nest root
-        logsums = pd.Series(np.log(nested_exp_utilities.root), index=choosers.index)
+        logsums = pd.Series(nests.logsums(nested_exp_utilities), index=choosers.index)
         chunk.log_df(trace_label, "logsums", logsums)
 
     del nested_exp_utilities
     chunk.log_df(trace_label, 'nested_exp_utilities', None)
 
     if have_trace_targets:
-        tracing.trace_df(nested_probabilities, '%s.nested_probabilities' % trace_label,
+        tracing.trace_df(nested_probabilities_df(nested_probabilities, nests, choosers.index),
+                         '%s.nested_probabilities' % trace_label,
                          column_labels=['alternative', 'probability'])
 
     # global (flattened) leaf probabilities based on relative nest coefficients (in spec order)
-    base_probabilities = compute_base_probabilities(nested_probabilities, nest_spec, spec)
+    base_probabilities = pd.DataFrame(nests.base_probabilities(nested_probabilities, spec.columns),
+                                      index=choosers.index, columns=spec.columns)
     chunk.log_df(trace_label, "base_probabilities", base_probabilities)
 
     del nested_probabilities
@@ -1298,20 +1426,23 @@ def eval_nl_logsums(choosers, spec, nest_spec, locals_d, trace_label=None):
         tracing.trace_df(raw_utilities, '%s.raw_utilities' % trace_label,
                          column_labels=['alternative', 'utility'])
 
-    # - exponentiated utilities of leaves and nests
-    nested_exp_utilities = compute_nested_exp_utilities(raw_utilities, nest_spec)
+    nests = logit.nest_arrays(nest_spec)
+
+    # - exponentiated utilities of leaves and nests (node rows, chooser columns)
+    nested_exp_utilities = nests.exp_utilities(raw_utilities.values, raw_utilities.columns)
     chunk.log_df(trace_label, "nested_exp_utilities", nested_exp_utilities)
 
     del raw_utilities  # done with raw_utilities
     chunk.log_df(trace_label, 'raw_utilities', None)
 
     # - logsums
-    logsums = np.log(nested_exp_utilities.root)
+    logsums = nests.logsums(nested_exp_utilities)
     logsums = pd.Series(logsums, index=choosers.index)
     chunk.log_df(trace_label, "logsums", logsums)
 
     if have_trace_targets:
         # add logsum to nested_exp_utilities for tracing
+        nested_exp_utilities = pd.DataFrame(nested_exp_utilities.T, index=choosers.index, columns=nests.names)
         nested_exp_utilities['logsum'] = logsums
         tracing.trace_df(nested_exp_utilities, '%s.nested_exp_utilities' % trace_label,
                          column_labels=['alternative', 'utility'])
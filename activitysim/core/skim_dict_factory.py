@@ -3,9 +3,15 @@
 # from builtins import int
 
 import os
+import time
+import hashlib
 import multiprocessing
 import logging
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import shared_memory
+
 import numpy as np
+import pandas as pd
 import openmatrix as omx
 from abc import ABC, abstractmethod
 
@@ -18,6 +24,78 @@ from activitysim.core import skim_dictionary
 logger = logging.getLogger(__name__)
 
 
+def read_omx_matrix(omx_file_path, omx_key):
+    """
+    Read a single omx matrix (in an omx reader process)
+
+    Returns
+    -------
+    data : numpy.ndarray
+    elapsed : float
+        seconds to open, read and decompress
+    """
+    t0 = time.time()
+    with omx.open_file(omx_file_path) as omx_file:
+        data = omx_file[omx_key][:]
+    return data, time.time() - t0
+
+
+def skim_usage_file_path(skim_tag):
+    """
+    Return path of file in cache directory listing base keys of skims looked up during a prior run
+    """
+    return os.path.join(config.get_cache_dir(), f"skim_usage_{skim_tag}.txt")
+
+
+def write_skim_usage(skim_tag, skim_keys):
+    """
+    Persist base keys of skims looked up (e.g. SkimDict.get_skim_usage) to cache directory so that
+    subsequent runs with the used_skims_only network_los setting load only those skims
+
+    Keys are merged with those already in the skim usage file (rather than overwriting it) since a
+    run may only look up some of the skims the full model uses (e.g. if it only ran a subset of models,
+    resumed after a checkpoint, or only recorded usage of one of several sub-processes.)
+    Delete the file to start over.
+
+    Parameters
+    ----------
+    skim_tag: str
+    skim_keys: iterable of str or (key1, key2) tuples
+    """
+    base_keys = set(k[0] if isinstance(k, tuple) else k for k in skim_keys)
+
+    previous_keys = read_skim_usage(skim_tag) or set()
+    base_keys = sorted(base_keys | previous_keys)
+
+    file_path = skim_usage_file_path(skim_tag)
+    logger.info(f"write_skim_usage writing {len(base_keys)} {skim_tag} skim keys "
+                f"({len(base_keys) - len(previous_keys)} new) to {file_path}")
+
+    with open(file_path, 'w') as output_file:
+        for key in base_keys:
+            print(key, file=output_file)
+
+
+def read_skim_usage(skim_tag):
+    """
+    Read base keys of skims written by write_skim_usage
+
+    Returns
+    -------
+    set of str or None if there is no skim usage file for skim_tag (or it is empty)
+    """
+    file_path = skim_usage_file_path(skim_tag)
+
+    if not os.path.isfile(file_path):
+        return None
+
+    with open(file_path) as input_file:
+        skim_keys = set(line.strip() for line in input_file if line.strip())
+
+    # an empty usage file would mean loading no skims at all, so treat it as missing
+    return skim_keys or None
+
+
 class SkimData(object):
     """
     A facade for 3D skim data exposing numpy indexing and shape
@@ -52,12 +130,185 @@ class SkimData(object):
         return self._skim_data.shape
 
 
+# uint16 code reserved for missing (nan) values of uint16 quantized skim blocks
+QUANTIZED_NAN_CODE = np.iinfo(np.uint16).max
+
+
+def quantize_skim_block(values, codes):
+    """
+    Encode a 2D skim block as 16 bit codes, choosing whichever of float16 or uint16 (with scale and
+    offset) has the smaller max error over the block's range of values
+
+    Parameters
+    ----------
+    values: 2D numpy.ndarray of float
+    codes: 2D numpy.ndarray of uint16 to receive encoded values
+
+    Returns
+    -------
+    is_float16: bool
+        True if codes are float16 bit patterns, False if uint16 codes of (value - offset) / scale
+    scale: float
+    offset: float
+    max_error: float
+        max absolute difference between values and decoded values (excluding nan)
+    """
+
+    values = np.asanyarray(values, dtype=np.float64)
+    finite = np.isfinite(values)
+
+    lo = values[finite].min() if finite.any() else 0.0
+    hi = values[finite].max() if finite.any() else 0.0
+
+    # - uint16 with scale and offset (integer blocks small enough to fit are encoded losslessly)
+    if (hi - lo) < QUANTIZED_NAN_CODE and (values[finite] == np.rint(values[finite])).all():
+        scale = 1.0
+    else:
+        scale = (hi - lo) / (QUANTIZED_NAN_CODE - 1) or 1.0
+    uint16_codes = np.where(finite, np.rint((values - lo) / scale), QUANTIZED_NAN_CODE).astype(np.uint16)
+    uint16_error = np.abs(uint16_codes[finite] * scale + lo - values[finite]).max(initial=0)
+
+    # - float16 (relative precision, so better for blocks with wide range of mostly small values)
+    with np.errstate(over='ignore'):
+        float16_values = values.astype(np.float16)
+    float16_error = np.abs(float16_values[finite].astype(np.float64) - values[finite]).max(initial=0)
+
+    if float16_error < uint16_error:
+        codes[:] = float16_values.view(np.uint16)
+        return True, 1.0, 0.0, float16_error
+
+    codes[:] = uint16_codes
+    return False, scale, lo, uint16_error
+
+
+class SkimQuantization(object):
+    """
+    Per skim block encoding of quantized (16 bit) skim data, as chosen by quantize_skim_block
+
+    Encodings are written to the cache dir when skims are read from omx, and read back by
+    processes (e.g. multiprocessing sub-processes) using the quantized skim data.
+    """
+
+    def __init__(self, skim_info):
+
+        self.skim_info = skim_info
+
+        num_skims = skim_info.num_skims
+        self.is_float16 = np.zeros(num_skims, dtype=bool)
+        self.scale = np.ones(num_skims, dtype=np.float64)
+        self.offset = np.zeros(num_skims, dtype=np.float64)
+        self.max_error = np.zeros(num_skims, dtype=np.float64)
+
+    @staticmethod
+    def file_path(skim_info):
+        return os.path.join(config.get_cache_dir(), f"quantized_{skim_info.skim_tag}{skim_info.cache_suffix}.csv")
+
+    def encode(self, skim_key, values, codes):
+        """
+        quantize omx values of skim_key into codes (skim_data block) and remember block encoding
+        """
+        offset = self.skim_info.block_offsets[skim_key]
+        self.is_float16[offset], self.scale[offset], self.offset[offset], self.max_error[offset] = \
+            quantize_skim_block(values, codes)
+
+    def to_df(self):
+
+        omx_keys = self.skim_info.omx_keys
+        block_offsets = self.skim_info.block_offsets
+        df = pd.DataFrame({
+            'omx_key': [omx_keys[k] for k in omx_keys],
+            'block_offset': [block_offsets[k] for k in omx_keys]
+        }).sort_values('block_offset')
+
+        df['encoding'] = np.where(self.is_float16[df.block_offset], 'float16', 'uint16')
+        df['scale'] = self.scale[df.block_offset]
+        df['offset'] = self.offset[df.block_offset]
+        df['max_error'] = self.max_error[df.block_offset]
+
+        return df
+
+    def write(self):
+        """
+        write block encodings to cache dir, and a validation report of max error per key to output dir
+        """
+        df = self.to_df()
+
+        df.to_csv(self.file_path(self.skim_info), index=False)
+        df.to_csv(config.output_file_path(f"skim_quantization_{self.skim_info.skim_tag}.csv"), index=False)
+
+        worst = df.loc[df.max_error.idxmax()] if len(df) else None
+        logger.info(f"quantized {len(df)} {self.skim_info.skim_tag} skims "
+                    f"({(df.encoding == 'float16').sum()} float16, {(df.encoding == 'uint16').sum()} uint16)"
+                    + (f" max error {worst.max_error} ({worst.omx_key})" if worst is not None else ''))
+
+    @classmethod
+    def read(cls, skim_info):
+        """
+        read block encodings written by write, or return None if not found or not compatible with skim_info
+        """
+        file_path = cls.file_path(skim_info)
+        if not os.path.isfile(file_path):
+            return None
+
+        df = pd.read_csv(file_path)
+
+        block_offsets = {skim_info.omx_keys[k]: skim_info.block_offsets[k] for k in skim_info.omx_keys}
+        if dict(zip(df.omx_key, df.block_offset)) != block_offsets:
+            logger.warning(f"ignoring incompatible skim quantization file {file_path}")
+            return None
+
+        quantization = cls(skim_info)
+        quantization.is_float16[df.block_offset] = (df.encoding == 'float16').values
+        quantization.scale[df.block_offset] = df.scale.values
+        quantization.offset[df.block_offset] = df.offset.values
+        quantization.max_error[df.block_offset] = df.max_error.values
+
+        return quantization
+
+
+class QuantizedSkimData(SkimData):
+    """
+    SkimData facade for 16 bit quantized skim data that dequantizes looked up values on the fly
+
+    Each block (skim matrix) is either float16 or uint16 with a scale and offset, as specified
+    by a SkimQuantization, so SkimDict lookups (2D and 3D) work unchanged.
+    """
+
+    def __init__(self, skim_data, quantization, dtype):
+        super().__init__(skim_data)
+        self.quantization = quantization
+        self.dtype = np.dtype(dtype)
+
+    def __getitem__(self, indexes):
+
+        codes = np.asanyarray(super().__getitem__(indexes))
+        blocks = indexes[0] if skim_dictionary.ROW_MAJOR_LAYOUT else indexes[2]
+
+        q = self.quantization
+        if np.isscalar(blocks) or np.ndim(blocks) == 0:
+            if q.is_float16[blocks]:
+                return codes.view(np.float16).astype(self.dtype)
+            values = codes * q.scale[blocks] + q.offset[blocks]
+            nan_codes = (codes == QUANTIZED_NAN_CODE)
+        else:
+            is_float16 = q.is_float16[blocks]
+            values = np.where(is_float16, codes.view(np.float16), codes * q.scale[blocks] + q.offset[blocks])
+            nan_codes = (codes == QUANTIZED_NAN_CODE) & ~is_float16
+
+        if nan_codes.any():
+            values = np.where(nan_codes, np.nan, values)
+
+        return values.astype(self.dtype)
+
+
 class SkimInfo(object):
     def __init__(self, skim_tag, network_los):
         """
 
         skim_tag:           str             (e.g. 'TAZ')
         dtype_name:         str             (e.g. 'float32')
+        quantized:          bool            skims stored as 16 bit codes (skim_quantization setting)
+        storage_dtype_name: str             dtype of skim_data ('uint16' if quantized, else dtype_name)
         omx_manifest:       dict            dict mapping { omx_key: omx_file_name }
         omx_shape:          2D tuple        shape of omx matrix: (<number_of_zones>, <number_of_zones>)
         num_skims:          int             total number of individual skim matrices in omx files
@@ -69,6 +320,7 @@ class SkimInfo(object):
                                             ('DRV_COM_WLK_BOARDS', 'AM'): DRV_COM_WLK_BOARDS__AM, ...}
         base_keys:          list of str     e.g. 'BIKEDIST' or 'SOVTOLL_VTOLL' (base key of 3d skim)
         block_offsets:      dict            dict mapping skim key tuple to offset
+        unused_keys:        set of str      base keys in omx files not loaded because used_skims_only
 
         Parameters
         ----------
@@ -78,6 +330,8 @@ class SkimInfo(object):
         self.network_los = network_los
         self.skim_tag = skim_tag
         self.dtype_name = network_los.skim_dtype_name
+        self.quantized = network_los.setting('skim_quantization', False)
+        self.storage_dtype_name = 'uint16' if self.quantized else self.dtype_name
 
         self.omx_manifest = None
         self.omx_shape = None
@@ -88,6 +342,7 @@ class SkimInfo(object):
         self.omx_keys = None
         self.base_keys = None
         self.block_offsets = None
+        self.unused_keys = None
 
         self.load_skim_info(skim_tag)
 
@@ -154,6 +409,22 @@ class SkimInfo(object):
 
             self.omx_keys[skim_key] = skim_name
 
+        # - only load skims looked up in a prior run (as recorded by write_skim_usage)
+        self.unused_keys = set()
+        if self.network_los.setting('used_skims_only', False):
+            used_keys = read_skim_usage(skim_tag)
+            if used_keys is None:
+                logger.warning(f"used_skims_only: skim usage file {skim_usage_file_path(skim_tag)} "
+                               f"not found or empty, "
+                               f"loading all {skim_tag} skims")
+            else:
+                def base_key(skim_key):
+                    return skim_key[0] if isinstance(skim_key, tuple) else skim_key
+                self.unused_keys = set(base_key(k) for k in self.omx_keys) - used_keys
+                self.omx_keys = {k: v for k, v in self.omx_keys.items() if base_key(k) in used_keys}
+                logger.info(f"used_skims_only: loading {len(self.omx_keys)} {skim_tag} skims "
+                            f"(skipping {len(self.unused_keys)} unused base keys)")
+
         self.num_skims = len(self.omx_keys)
 
         # - key1_subkeys dict maps key1 to dict of subkeys with that key1
@@ -199,11 +470,29 @@ class SkimInfo(object):
         # list of base keys (keys
         self.base_keys = tuple(k for k in key1_block_offsets.keys())
 
+    @property
+    def cache_suffix(self):
+        """
+        suffix distinguishing cache files of skim subsets (used_skims_only) and quantized skims,
+        since they have a different shape (and block offsets) or dtype than full skims
+
+        The suffix of a skim subset includes a digest of its omx keys and their block offsets,
+        so subsets of different used keys don't share (and misread) the same cache files.
+        """
+        suffix = ''
+        if self.unused_keys:
+            layout = sorted((omx_key, self.block_offsets[skim_key]) for skim_key, omx_key in self.omx_keys.items())
+            suffix += f"_used_{hashlib.md5(str(layout).encode()).hexdigest()[:12]}"
+        if self.quantized:
+            suffix += '_q16'
+        return suffix
+
     def print(self):
         print(f"SkimInfo for {self.skim_tag}")
         print(f"omx_shape {self.omx_shape}")
         print(f"num_skims {self.num_skims}")
         print(f"skim_data_shape {self.skim_data_shape}")
+        print(f"storage_dtype_name {self.storage_dtype_name}")
         print(f"offset_map_name {self.offset_map_name}")
         # print(f"omx_manifest {self.omx_manifest}")
         # print(f"offset_map {self.offset_map}")
@@ -250,8 +539,26 @@ class AbstractSkimFactory(ABC):
     def _skim_data_from_buffer(self, skim_info, skim_buffer):
         assert False, "Not supported"
 
-    def _memmap_skim_data_path(self, skim_tag):
-        return os.path.join(config.get_cache_dir(), f"cached_{skim_tag}.mmap")
+    def release_skim_buffer(self, skim_buffer):
+        """
+        For multiprocessing - free buffer allocated by allocate_skim_buffer, if not garbage collected
+        """
+        pass
+
+    def _memmap_skim_data_path(self, skim_info):
+        return os.path.join(config.get_cache_dir(), f"cached_{skim_info.skim_tag}{skim_info.cache_suffix}.mmap")
+
+    def _wrap_skim_data(self, skim_info, skim_data):
+        """
+        wrap 3D skim data array (or quack-alike) in SkimData facade, dequantizing if skims are quantized
+        """
+        if skim_info.quantized:
+            quantization = SkimQuantization.read(skim_info)
+            assert quantization is not None, \
+                f"skim quantization file {SkimQuantization.file_path(skim_info)} not found"
+            return QuantizedSkimData(skim_data, quantization, skim_info.dtype_name)
+
+        return skim_data if isinstance(skim_data, SkimData) else SkimData(skim_data)
 
     def load_skim_info(self, skim_tag):
         return SkimInfo(skim_tag, self.network_los)
@@ -259,9 +566,46 @@ class AbstractSkimFactory(ABC):
     def _read_skims_from_omx(self, skim_info, skim_data):
         """
         read skims from omx file into skim_data
+
+        If the omx_read_processes setting is greater than 1, independent omx matrices are read
+        and decompressed concurrently by a pool of that many reader processes (PyTables is not
+        thread-safe and holds the GIL while reading, so threads would not overlap decompression)
+
+        If skims are quantized, each matrix is encoded as it is read, and the block encodings are
+        written to the cache dir.
+        """
+
+        def block(skim_key):
+            offset = skim_info.block_offsets[skim_key]
+            if skim_dictionary.ROW_MAJOR_LAYOUT:
+                return skim_data[offset, :, :]
+            else:
+                return skim_data[:, :, offset]
+
+        quantization = SkimQuantization(skim_info) if skim_info.quantized else None
+
+        def store(skim_key, omx_data):
+            if quantization:
+                quantization.encode(skim_key, omx_data[:], block(skim_key))
+            else:
+                # this will trigger omx readslice to read and copy data to skim_data's buffer
+                block(skim_key)[:] = omx_data[:]
+
+        num_readers = self.network_los.setting('omx_read_processes', 1)
+
+        if num_readers > 1:
+            self._read_skims_from_omx_concurrently(skim_info, store, num_readers)
+        else:
+            self._read_skims_from_omx_serially(skim_info, store)
+
+        if quantization:
+            quantization.write()
+
+    def _read_skims_from_omx_serially(self, skim_info, store):
+        """
+        read skims from omx files, one file at a time, passing each matrix to store(skim_key, omx_data)
         """
 
-        skim_tag = skim_info.skim_tag
         omx_keys = skim_info.omx_keys
         omx_manifest = skim_info.omx_manifest  # dict mapping { omx_key: skim_name }
 
@@ -277,37 +621,80 @@ class AbstractSkimFactory(ABC):
 
                     if omx_manifest[omx_key] == omx_file_path:
 
-                        offset = skim_info.block_offsets[skim_key]
                         logger.debug(f"_read_skims_from_omx file {omx_file_path} omx_key {omx_key} "
-                                     f"skim_key {skim_key} to offset {offset}")
-
-                        if skim_dictionary.ROW_MAJOR_LAYOUT:
-                            a = skim_data[offset, :, :]
-                        else:
-                            a = skim_data[:, :, offset]
+                                     f"skim_key {skim_key} to offset {skim_info.block_offsets[skim_key]}")
 
-                        # this will trigger omx readslice to read and copy data to skim_data's buffer
-                        omx_data = omx_file[omx_key]
-                        a[:] = omx_data[:]
+                        store(skim_key, omx_file[omx_key])
 
                         num_skims_loaded += 1
 
             logger.info(f"_read_skims_from_omx loaded {num_skims_loaded} skims from {omx_file_path}")
 
+    def _read_skims_from_omx_concurrently(self, skim_info, store, num_readers):
+        """
+        read skims from omx files using a pool of num_readers omx reader processes,
+        passing each matrix to store(skim_key, omx_data) as it arrives
+
+        Each reader opens its own omx file handle for the duration of a single read, and at most
+        2 * num_readers matrices are in flight at once, to bound open handles and memory use.
+        """
+
+        omx_manifest = skim_info.omx_manifest
+        pending_keys = list(skim_info.omx_keys.items())
+        pending_keys.reverse()
+
+        logger.info(f"_read_skims_from_omx reading {len(pending_keys)} {skim_info.skim_tag} skims "
+                    f"with {num_readers} reader processes")
+
+        t0 = time.time()
+        read_time = 0
+        with ProcessPoolExecutor(max_workers=num_readers) as executor:
+
+            in_flight = {}
+            while pending_keys or in_flight:
+
+                while pending_keys and len(in_flight) < 2 * num_readers:
+                    skim_key, omx_key = pending_keys.pop()
+                    future = executor.submit(read_omx_matrix, omx_manifest[omx_key], omx_key)
+                    in_flight[future] = (skim_key, omx_key)
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    skim_key, omx_key = in_flight.pop(future)
+                    omx_data, elapsed = future.result()
+                    store(skim_key, omx_data)
+                    read_time += elapsed
+                    logger.debug(f"_read_skims_from_omx omx_key {omx_key} skim_key {skim_key} "
+                                 f"to offset {skim_info.block_offsets[skim_key]} read in {elapsed:.3f} seconds")
+
+        logger.info(f"_read_skims_from_omx loaded {len(skim_info.omx_keys)} {skim_info.skim_tag} skims "
+                    f"in {time.time() - t0:.3f} seconds ({read_time:.3f} seconds total read time)")
+
     def _open_existing_readonly_memmap_skim_cache(self, skim_info):
         """
             read cached memmapped skim data from canonically named cache file(s) in output directory into skim_data
             return True if it was there and we read it, return False if not found
         """
 
-        dtype = np.dtype(skim_info.dtype_name)
+        dtype = np.dtype(skim_info.storage_dtype_name)
 
-        skim_cache_path = self._memmap_skim_data_path(skim_info.skim_tag)
+        skim_cache_path = self._memmap_skim_data_path(skim_info)
 
         if not os.path.isfile(skim_cache_path):
             logger.warning(f"read_skim_cache file not found: {skim_cache_path}")
             return None
 
+        if skim_info.quantized and not os.path.isfile(SkimQuantization.file_path(skim_info)):
+            logger.warning(f"ignoring {skim_info.skim_tag} skim_cache {skim_cache_path} "
+                           f"since skim quantization file not found")
+            return None
+
+        expected_size = int(np.prod(skim_info.skim_data_shape)) * dtype.itemsize
+        if os.path.getsize(skim_cache_path) != expected_size:
+            logger.warning(f"ignoring incompatible {skim_info.skim_tag} skim_cache {skim_cache_path} "
+                           f"({os.path.getsize(skim_cache_path)} bytes instead of {expected_size})")
+            return None
+
         logger.info(f"reading skim cache {skim_info.skim_tag} {skim_info.skim_data_shape} from {skim_cache_path}")
 
         try:
@@ -324,9 +711,9 @@ class AbstractSkimFactory(ABC):
             write skim data from skim_data to canonically named cache file(s) in output directory
         """
 
-        dtype = np.dtype(skim_info.dtype_name)
+        dtype = np.dtype(skim_info.storage_dtype_name)
 
-        skim_cache_path = self._memmap_skim_data_path(skim_info.skim_tag)
+        skim_cache_path = self._memmap_skim_data_path(skim_info)
 
         logger.info(f"writing skim cache {skim_info.skim_tag} {skim_info.skim_data_shape} to {skim_cache_path}")
 
@@ -369,7 +756,7 @@ class NumpyArraySkimFactory(AbstractSkimFactory):
         assert shared == self.network_los.multiprocess(), \
             f"NumpyArraySkimFactory.allocate_skim_buffer shared {shared} multiprocess {not shared}"
 
-        dtype_name = skim_info.dtype_name
+        dtype_name = skim_info.storage_dtype_name
         dtype = np.dtype(dtype_name)
 
         # multiprocessing.RawArray argument buffer_size must be int, not np.int64
@@ -384,6 +771,8 @@ class NumpyArraySkimFactory(AbstractSkimFactory):
                 typecode = 'd'
             elif dtype_name == 'float32':
                 typecode = 'f'
+            elif dtype_name == 'uint16':
+                typecode = 'H'
             else:
                 raise RuntimeError("allocate_skim_buffer unrecognized dtype %s" % dtype_name)
 
@@ -407,7 +796,7 @@ class NumpyArraySkimFactory(AbstractSkimFactory):
 
         """
 
-        dtype = np.dtype(skim_info.dtype_name)
+        dtype = np.dtype(skim_info.storage_dtype_name)
         assert len(skim_buffer) == util.iprod(skim_info.skim_data_shape)
         skim_data = np.frombuffer(skim_buffer, dtype=dtype).reshape(skim_info.skim_data_shape)
         return skim_data
@@ -476,13 +865,118 @@ class NumpyArraySkimFactory(AbstractSkimFactory):
             skim_buffer = self.allocate_skim_buffer(skim_info, shared=False)
             self.load_skims_to_buffer(skim_info, skim_buffer)
 
-        skim_data = SkimData(self._skim_data_from_buffer(skim_info, skim_buffer))
+        skim_data = self._wrap_skim_data(skim_info, self._skim_data_from_buffer(skim_info, skim_buffer))
 
         logger.info(f"get_skim_data {skim_tag} {type(skim_data).__name__} shape {skim_data.shape}")
 
         return skim_data
 
 
+class SharedMemorySkimFactory(NumpyArraySkimFactory):
+    """
+    NumpyArraySkimFactory variant that allocates shared skim buffers as named
+    multiprocessing.shared_memory.SharedMemory segments rather than multiprocessing.RawArrays.
+
+    SharedMemory objects are pickled by name, so sub-processes attach to the existing segment
+    rather than inheriting (or, on Windows, re-mapping) an anonymous buffer, and the segment
+    can be loaded in place, without an intermediate copy. When reading from the skim cache, skim
+    blocks are copied into the shared buffer in parallel threads (numpy copies release the GIL.)
+
+    The segments are owned by the main process, which should call release_skim_buffer when done.
+    """
+
+    def __init__(self, network_los):
+        super().__init__(network_los)
+
+    def allocate_skim_buffer(self, skim_info, shared=False):
+        """
+        Allocate a ram skim buffer to use as frombuffer for SkimData
+        If shared is True, return a SharedMemory segment, otherwise a numpy.ndarray
+
+        Parameters
+        ----------
+        skim_info: SkimInfo
+        shared: boolean
+
+        Returns
+        -------
+        multiprocessing.shared_memory.SharedMemory or numpy.ndarray
+        """
+
+        if not shared:
+            return super().allocate_skim_buffer(skim_info, shared=False)
+
+        assert self.network_los.multiprocess(), \
+            f"SharedMemorySkimFactory.allocate_skim_buffer shared {shared} " \
+            f"multiprocess {self.network_los.multiprocess()}"
+
+        dtype = np.dtype(skim_info.storage_dtype_name)
+        csz = util.iprod(skim_info.skim_data_shape) * dtype.itemsize
+
+        buffer = shared_memory.SharedMemory(create=True, size=csz)
+
+        logger.info(f"allocate_skim_buffer shared {shared} {skim_info.skim_tag} shape {skim_info.skim_data_shape} "
+                    f"total size: {util.INT(csz)} ({util.GB(csz)}) shared_memory name {buffer.name}")
+
+        return buffer
+
+    def release_skim_buffer(self, skim_buffer):
+        """
+        Free shared memory segment allocated by allocate_skim_buffer (called by owning process)
+        """
+        if isinstance(skim_buffer, shared_memory.SharedMemory):
+            skim_buffer.close()
+            skim_buffer.unlink()
+
+    def _skim_data_from_buffer(self, skim_info, skim_buffer):
+
+        if not isinstance(skim_buffer, shared_memory.SharedMemory):
+            return super()._skim_data_from_buffer(skim_info, skim_buffer)
+
+        dtype = np.dtype(skim_info.storage_dtype_name)
+        return np.ndarray(skim_info.skim_data_shape, dtype=dtype, buffer=skim_buffer.buf)
+
+    def load_skims_to_buffer(self, skim_info, skim_buffer):
+        """
+        Load skims from disk store (omx or cache) into ram skim buffer (SharedMemory or numpy.ndarray)
+
+        Parameters
+        ----------
+        skim_info: SkimInfo
+        skim_buffer: SharedMemory or 1D numpy.ndarray sized to hold all skims
+        """
+
+        read_cache = self.network_los.setting('read_skim_cache', False)
+
+        if read_cache:
+
+            cache_data = self._open_existing_readonly_memmap_skim_cache(skim_info)
+
+            if cache_data is not None:
+
+                skim_data = self._skim_data_from_buffer(skim_info, skim_buffer)
+                assert cache_data.shape == skim_data.shape
+
+                def copy_block(offset):
+                    if skim_dictionary.ROW_MAJOR_LAYOUT:
+                        np.copyto(skim_data[offset], cache_data[offset])
+                    else:
+                        np.copyto(skim_data[..., offset], cache_data[..., offset])
+
+                num_threads = self.network_los.setting('skim_load_threads', os.cpu_count())
+                with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                    list(executor.map(copy_block, range(skim_info.num_skims)))
+
+                cache_data._mmap.close()
+                del cache_data
+
+                logger.info(f"load_skims_to_buffer {skim_info.skim_tag} shape {skim_data.shape} "
+                            f"from skim cache with {num_threads} threads")
+                return
+
+        super().load_skims_to_buffer(skim_info, skim_buffer)
+
+
 class JitMemMapSkimData(SkimData):
     """
     SkimData subclass for just-in-time memmap.
@@ -495,7 +989,7 @@ class JitMemMapSkimData(SkimData):
     def __init__(self, skim_cache_path, skim_info):
         super().__init__(skim_info)
         self.skim_cache_path = skim_cache_path
-        self.dtype = np.dtype(skim_info.dtype_name)
+        self.dtype = np.dtype(skim_info.storage_dtype_name)
         self._shape = skim_info.skim_data_shape
 
     def __getitem__(self, indexes):
@@ -554,8 +1048,9 @@ class MemMapSkimFactory(AbstractSkimFactory):
         # don't expect legacy shared memory buffers
         assert not inject.get_injectable('data_buffers', {}).get(skim_tag)
 
-        skim_cache_path = self._memmap_skim_data_path(skim_tag)
-        if not os.path.isfile(skim_cache_path):
+        skim_cache_path = self._memmap_skim_data_path(skim_info)
+        if not os.path.isfile(skim_cache_path) or \
+                (skim_info.quantized and not os.path.isfile(SkimQuantization.file_path(skim_info))):
             self.copy_omx_to_mmap_file(skim_info)
 
         JIT = True  # FIXME - this should be a network_los setting, along with selection of the factory?
@@ -564,7 +1059,8 @@ class MemMapSkimFactory(AbstractSkimFactory):
         else:
             # WARNING: memmap gobbles ram up to skim size - see note above
             skim_data = self._open_existing_readonly_memmap_skim_cache(skim_info)
-            skim_data = SkimData(skim_data)
+
+        skim_data = self._wrap_skim_data(skim_info, skim_data)
 
         logger.info(f"get_skim_data {skim_tag} {type(skim_data).__name__} shape {skim_data.shape}")
 
@@ -18,6 +18,11 @@ NOT_IN_SKIM_NAN = np.nan
 
 ROW_MAJOR_LAYOUT = True
 
+# OffsetMapper maps zone_ids with a dense lookup table (indexed by zone_id) unless the span of zone_ids
+# is greater than both of these, in which case it uses binary search of sorted zone_ids instead
+DENSE_OFFSET_LOOKUP_MAX_SPARSITY = 10
+DENSE_OFFSET_LOOKUP_MIN_SPAN = 1 << 20
+
 
 class OffsetMapper(object):
     """
@@ -34,11 +39,16 @@ class OffsetMapper(object):
         pandas series with zone_id index and skim array offset values. Ordinarily, index is just range(0, omx_size)
         if series has duplicate offset values, this can map multiple zone_ids to a single skim array index
         (e.g. can map maz zone_ids to corresponding taz skim offset)
+
+    offset_series is mapped with numpy indexing, using either a dense int32 lookup table indexed by zone_id
+    (offset_lookup) or, if zone_ids are very sparse, a binary search of the sorted zone_ids (sorted_zone_ids)
     """
 
     def __init__(self, offset_int=None, offset_list=None, offset_series=None):
 
         self.offset_int = self.offset_series = None
+        self.offset_lookup = self.min_zone_id = None
+        self.sorted_zone_ids = self.sorted_offsets = None
 
         assert (offset_int is not None) + (offset_list is not None) + (offset_series is not None) <= 1
 
@@ -70,6 +80,29 @@ class OffsetMapper(object):
         self.offset_series = offset_series
         self.offset_int = None
 
+        self.offset_lookup = self.min_zone_id = None
+        self.sorted_zone_ids = self.sorted_offsets = None
+
+        zone_ids = offset_series.index.values
+        offsets = offset_series.values
+        if not (np.issubdtype(zone_ids.dtype, np.integer) and np.issubdtype(offsets.dtype, np.integer)):
+            # map will fall back to pandas Series.map
+            return
+
+        if len(zone_ids) == 0:
+            self.sorted_zone_ids = self.sorted_offsets = np.array([], dtype=np.int32)
+            return
+
+        span = int(zone_ids.max()) - int(zone_ids.min()) + 1
+        if span <= max(DENSE_OFFSET_LOOKUP_MAX_SPARSITY * len(zone_ids), DENSE_OFFSET_LOOKUP_MIN_SPAN):
+            self.min_zone_id = int(zone_ids.min())
+            self.offset_lookup = np.full(span, NOT_IN_SKIM_ZONE_ID, dtype=np.int32)
+            self.offset_lookup[zone_ids - self.min_zone_id] = offsets
+        else:
+            order = np.argsort(zone_ids, kind='stable')
+            self.sorted_zone_ids = zone_ids[order]
+            self.sorted_offsets = offsets[order].astype(np.int32)
+
     def set_offset_list(self, offset_list):
         """
         Convenience method to set offset_series using an integer list the same size as target skim dimension
@@ -117,19 +150,37 @@ class OffsetMapper(object):
 
         Returns
         -------
-        offsets : numpy array of int
+        offsets : numpy array of int (NOT_IN_SKIM_ZONE_ID for zone_ids not in offset_series)
         """
 
         if self.offset_series is not None:
             assert(self.offset_int is None)
             assert isinstance(self.offset_series, pd.Series)
 
-            # FIXME - turns out it is faster to use series.map if zone_ids is a series
-            # offsets = quick_loc_series(zone_ids, self.offset_series).fillna(NOT_IN_SKIM_ZONE_ID).astype(int)
-
-            if isinstance(zone_ids, np.ndarray):
-                zone_ids = pd.Series(zone_ids)
-            offsets = zone_ids.map(self.offset_series, na_action='ignore').fillna(NOT_IN_SKIM_ZONE_ID).astype(int)
+            ids = np.asanyarray(zone_ids)
+            if isinstance(zone_ids, (pd.Series, pd.Index)):
+                ids = zone_ids.values
+
+            if self.offset_lookup is not None and np.issubdtype(ids.dtype, np.integer):
+                # dense lookup table indexed by zone_id
+                lookup = self.offset_lookup
+                idx = ids - self.min_zone_id
+                if len(idx) == 0 or (idx.min() >= 0 and idx.max() < len(lookup)):
+                    offsets = lookup[idx]
+                else:
+                    in_range = (idx >= 0) & (idx < len(lookup))
+                    offsets = np.where(in_range, lookup[np.where(in_range, idx, 0)], NOT_IN_SKIM_ZONE_ID)
+            elif self.sorted_zone_ids is not None and np.issubdtype(ids.dtype, np.integer):
+                # binary search of sorted zone_ids
+                sorted_zone_ids = self.sorted_zone_ids
+                if len(sorted_zone_ids) == 0:
+                    return np.full(len(ids), NOT_IN_SKIM_ZONE_ID, dtype=np.int32)
+                pos = np.minimum(np.searchsorted(sorted_zone_ids, ids), len(sorted_zone_ids) - 1)
+                offsets = np.where(sorted_zone_ids[pos] == ids, self.sorted_offsets[pos], NOT_IN_SKIM_ZONE_ID)
+            else:
+                # non-integer zone_ids (e.g. float with nans)
+                offsets = pd.Series(ids).map(self.offset_series, na_action='ignore')\
+                    .fillna(NOT_IN_SKIM_ZONE_ID).astype(int).values
 
         elif self.offset_int:
             assert (self.offset_series is None)
@@ -217,6 +268,26 @@ class SkimDict(object):
         """
         return self.usage
 
+    def _assert_loaded(self, key, loaded):
+        """
+        Raise a descriptive error if skim key was not loaded
+
+        Parameters
+        ----------
+        key: str or (key1, key2) tuple
+        loaded: bool
+        """
+        if loaded:
+            return
+
+        base_key = key[0] if isinstance(key, tuple) else key
+        if base_key in (getattr(self.skim_info, 'unused_keys', None) or ()):
+            raise RuntimeError(f"SkimDict {self.skim_tag} skim key '{key}' was not loaded because it is not "
+                               f"listed in skim usage file for used_skims_only. "
+                               f"Rerun with used_skims_only False and track_skim_usage to update skim usage.")
+
+        assert False, f"SkimDict lookup key '{key}' not in skims"
+
     def _lookup(self, orig, dest, block_offsets):
         """
         Return list of skim values of skims(s) at orig/dest for the skim(s) at block_offset in skim_data
@@ -285,7 +356,7 @@ class SkimDict(object):
         self.usage.add(key)
 
         block_offset = self.skim_info.block_offsets.get(key)
-        assert block_offset is not None, f"SkimDict lookup key '{key}' not in skims"
+        self._assert_loaded(key, block_offset is not None)
 
         try:
             result = self._lookup(orig, dest, block_offset)
@@ -324,7 +395,7 @@ class SkimDict(object):
 
         self.usage.add(key)  # should we keep usage stats by (key, dim3)?
 
-        assert key in self.skim_dim3, f"3d skim key {key} not in skims."
+        self._assert_loaded(key, key in self.skim_dim3)
 
         # map dim3 to block_offsets
         skim_keys_to_indexes = self.skim_dim3[key]
@@ -568,7 +639,7 @@ class MazSkimDict(SkimDict):
     MazSkimDict provides a facade that allows skim-like lookup by maz orig,dest zone_id
     when there are often too many maz zones to create maz skims.
 
-    Dependencies: network_los.load_data must have already loaded: taz skim_dict, maz_to_maz_df, and maz_taz_df
+    Dependencies: network_los.load_data must have already loaded: taz skim_dict, maz_pairs, and maz_taz_df
 
     It performs lookups from a sparse list of maz-maz od pairs on selected attributes (e.g. WALKDIST)
     where accuracy for nearby od pairs is critical. And is backed by a fallback taz skim dict
@@ -577,7 +648,7 @@ class MazSkimDict(SkimDict):
 
     def __init__(self, skim_tag, network_los, taz_skim_dict):
         """
-        we need network_los because we have dependencies on network_los.load_data (e.g. maz_to_maz_df, maz_taz_df,
+        we need network_los because we have dependencies on network_los.load_data (e.g. maz_pairs, maz_taz_df,
         and the fallback taz skim_dict)
 
         We require taz_skim_dict as an explicit parameter to emphasize that we are piggybacking on taz_skim_dict's
@@ -600,7 +671,7 @@ class MazSkimDict(SkimDict):
 
         self.dtype = np.dtype(self.skim_info.dtype_name)
         self.base_keys = taz_skim_dict.skim_info.base_keys
-        self.sparse_keys = list(set(network_los.maz_to_maz_df.columns) - {'OMAZ', 'DMAZ'})
+        self.sparse_keys = list(network_los.maz_pairs.columns)
         self.sparse_key_usage = set()
 
     def _offset_mapper(self):
@@ -803,7 +874,6 @@ class DataFrameMatrix(object):
         not_in_skim = (row_indexes == NOT_IN_SKIM_ZONE_ID)
         if not_in_skim.any():
             logger.warning(f"DataFrameMatrix: {not_in_skim.sum()} row_ids of {len(row_ids)} not in skim.")
-            not_in_skim = not_in_skim.values
             logger.warning(f"row_ids: {row_ids[not_in_skim]}")
             logger.warning(f"col_ids: {col_ids[not_in_skim]}")
             raise RuntimeError(f"DataFrameMatrix: {not_in_skim.sum()} row_ids of {len(row_ids)} not in skim.")
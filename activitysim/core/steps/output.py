@@ -8,6 +8,7 @@ import numpy as np
 from activitysim.core import pipeline
 from activitysim.core import inject
 from activitysim.core import config
+from activitysim.core import skim_dict_factory
 
 from activitysim.core.config import setting
 
@@ -18,9 +19,11 @@ def track_skim_usage(output_dir):
     """
     write statistics on skim usage (diagnostic to detect loading of un-needed skims)
 
-    FIXME - have not yet implemented a facility to avoid loading of unused skims
-
-    FIXME - if resume_after, this will only reflect skims used after resume
+    Also persists the keys of the skims used to the cache directory so that subsequent runs
+    with the used_skims_only network_los setting will only load those skims.
+    Keys are merged into any existing skim usage files, since skims used in this run may be
+    incomplete (e.g. if resume_after, or in multiprocess runs, where this only reflects skims used
+    by the sub-process running this step.)
 
     Parameters
     ----------
@@ -44,6 +47,15 @@ def track_skim_usage(output_dir):
         for key in unused:
             print(key, file=output_file)
 
+    # - persist usage by skim_info (maz skim_dict shares the taz skim_info and skim_data)
+    network_los = inject.get_injectable('network_los')
+    skim_usage = {}
+    for skim_dict in network_los.skim_dicts.values():
+        skim_usage.setdefault(skim_dict.skim_info.skim_tag, set()).update(skim_dict.usage)
+
+    for skim_tag, usage in skim_usage.items():
+        skim_dict_factory.write_skim_usage(skim_tag, usage)
+
 
 def previous_write_data_dictionary(output_dir):
     """
@@ -0,0 +1,48 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+import numpy as np
+import numpy.testing as npt
+
+from .. import interaction_sample
+
+
+def test_sample_positions():
+
+    probs = np.array([
+        [0.2, 0.3, 0.0, 0.5],
+        [0.0, 0.0, 1.0, 0.0],
+        [0.25, 0.25, 0.25, 0.25]])
+    cum_probs = probs.cumsum(axis=1)
+
+    rands = np.array([
+        [0.99, 0.2, 0.5, 0.1, 0.49],
+        [0.0, 0.3, 0.6, 0.9, 0.999],
+        [0.0, 0.25, 0.5, 0.75, 1.0]])
+
+    positions = interaction_sample._sample_positions(probs, rands)
+
+    # same as first occurrence of cum_probs > rand for each rand (or 0 if none)
+    expected = np.stack([np.argmax(cum_probs > rands[:, [i]], axis=1) for i in range(rands.shape[1])], axis=1)
+    npt.assert_array_equal(positions, expected)
+    npt.assert_array_equal(positions[2], [0, 1, 2, 3, 0])
+
+
+def test_count_picks():
+
+    positions = np.array([
+        [3, 1, 3, 3, 0],
+        [2, 2, 2, 2, 2],
+        [4, 3, 2, 1, 0]])
+
+    pick_count, first_pick = interaction_sample.count_picks(positions)
+
+    npt.assert_array_equal(pick_count, [
+        [3, 1, 3, 3, 1],
+        [5, 5, 5, 5, 5],
+        [1, 1, 1, 1, 1]])
+
+    npt.assert_array_equal(first_pick, [
+        [True, True, False, False, True],
+        [True, False, False, False, False],
+        [True, True, True, True, True]])
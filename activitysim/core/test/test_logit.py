@@ -4,6 +4,7 @@
 import os.path
 
 import numpy as np
+import numpy.testing as npt
 import pandas as pd
 
 import pandas.testing as pdt
@@ -11,6 +12,8 @@ import pytest
 
 from ..simulate import eval_variables
 from .. import logit
+from .. import interaction_simulate
+from .. import chunk
 from .. import inject
 
 
@@ -117,6 +120,34 @@ def test_make_choices_real_probs(utilities):
         pd.Series([1, 2], index=[0, 1]))
 
 
+def test_utils_to_probs_overwrite_utils(utilities, test_data):
+
+    utils = utilities.copy()
+    probs = logit.utils_to_probs(utils, trace_label=None, overwrite_utils=True)
+    pdt.assert_frame_equal(probs, test_data['probabilities'])
+    assert np.shares_memory(probs.values, utils.values)
+
+    # float32 utilities are computed in float32
+    utils = utilities.astype(np.float32)
+    probs = logit.utils_to_probs(utils, trace_label=None, overwrite_utils=True)
+    assert probs.values.dtype == np.float32
+    pdt.assert_frame_equal(probs, test_data['probabilities'].astype(np.float32), rtol=1e-5)
+
+
+def test_make_choices_cumulative_probs():
+
+    rng = np.random.default_rng(0)
+    probs = pd.DataFrame(rng.random((100, 20)))
+    probs = probs.div(probs.sum(axis=1), axis=0)
+    choices, rands = logit.make_choices(probs)
+
+    expected = np.argmax(probs.values.cumsum(axis=1) > rands.values.reshape(-1, 1), axis=1)
+    npt.assert_array_equal(choices.values, expected)
+
+    choices32, _ = logit.make_choices(probs.astype(np.float32))
+    npt.assert_array_equal(choices32.values, choices.values)
+
+
 @pytest.fixture(scope='module')
 def interaction_choosers():
     return pd.DataFrame({
@@ -159,3 +190,111 @@ def test_interaction_dataset_sampled(
 
     interacted, expected = interacted.align(expected, axis=1)
     pdt.assert_frame_equal(interacted, expected)
+
+
+class DistanceSkim(object):
+    # minimal skim wrapper, looking up the distance between orig and dest columns of the df it is set on
+
+    def __init__(self, orig_key, dest_key):
+        self.orig_key = orig_key
+        self.dest_key = dest_key
+        self.df = None
+
+    def set_df(self, df):
+        self.df = df
+
+    def __getitem__(self, key):
+        return (self.df[self.dest_key] - self.df[self.orig_key]).abs()
+
+
+def test_eval_interaction_terms(interaction_alts):
+
+    add_canonical_dirs()
+    inject.add_injectable("settings", {'check_for_variability': True})
+
+    choosers = pd.DataFrame({
+        'size': [1, 2, 3, 2],
+        'prop': [5, 6, 7, 8],
+        'home_zone': [1, 4, 2, 3]},
+        index=['w', 'x', 'y', 'z'])
+
+    alternatives = interaction_alts.copy()
+    alternatives.index.name = 'zone'
+    alternatives['zone'] = alternatives.index
+
+    skim = DistanceSkim('home_zone', 'zone')
+    locals_d = {'skim': skim}
+
+    spec = pd.DataFrame({'coefficient': [0.5, 2.0, -1.0, 0.25, 3.0, 1.0, -0.5, 1.5]},
+                        index=['size * 2', 'prop > 15', 'size * prop', 'prop_chooser', '@df.prop * 0.1',
+                               "_dist@skim['DIST']", '@_dist * df.prop_chooser', "@np.log1p(df['prop_chooser'])"])
+
+    terms = interaction_simulate.interaction_terms(spec, choosers, alternatives, skim, locals_d)
+
+    # chooser prop column is renamed prop_chooser in interaction dataset
+    assert [source for _, _, source, _ in terms] == \
+        ['choosers', 'alternatives', 'interaction', 'choosers', 'alternatives',
+         'interaction', 'interaction', 'choosers']
+
+    # interaction dataset columns used by df methods and attributes can't be determined
+    for expr in ["@df.eval('size * 2')", '@df.size', '@df[df.columns[0]]']:
+        unknown = pd.DataFrame({'coefficient': [1.0]}, index=[expr])
+        assert interaction_simulate.interaction_terms(unknown, choosers, alternatives, skim, locals_d) is None
+
+    for sample_size in [4, 2]:
+        interacted = logit.interaction_dataset(choosers, alternatives, sample_size=sample_size)
+        skim.set_df(interacted)
+
+        with chunk.chunk_log('test_eval_interaction_terms', base=True):
+            expected, _ = interaction_simulate.eval_interaction_utilities(spec, interacted, locals_d, 'test', None)
+
+            sample = alternatives.index.get_indexer(interacted.index)
+            utilities = interaction_simulate.eval_interaction_terms(terms, choosers, alternatives,
+                                                                    sample, sample_size, skim, locals_d, 'test')
+
+        assert utilities.shape == (len(choosers), sample_size)
+        npt.assert_array_equal(utilities.ravel(), expected.utility.values)
+
+        # skim was looked up on a narrow interaction dataset with just the columns it needed
+        assert sorted(skim.df.columns) == ['home_zone', 'prop', 'prop_chooser', 'size', 'zone']
+        npt.assert_array_equal(skim.df.index, interacted.index)
+
+
+def test_nest_arrays():
+
+    nest_spec = {'name': 'root', 'coefficient': 1.0, 'alternatives': [
+        {'name': 'motorized', 'coefficient': 0.8, 'alternatives': [
+            {'name': 'auto', 'coefficient': 0.5, 'alternatives': ['drive', 'carpool']}, 'transit']},
+        'walk']}
+    columns = ['walk', 'transit', 'carpool', 'drive']
+    # last chooser has no available motorized alternatives
+    utils = np.array([[0.0, 1.0, -1.0, 2.0],
+                      [1.0, -999.0, 0.5, 0.5],
+                      [0.5, -999.0, -999.0, -999.0]])
+
+    nests = logit.nest_arrays(nest_spec)
+    assert logit.nest_arrays(nest_spec) is nests
+    assert nests.names == ['drive', 'carpool', 'auto', 'transit', 'motorized', 'walk', 'root']
+
+    exp_utilities = nests.exp_utilities(utils, columns)
+    probs = nests.nested_probabilities(exp_utilities)
+    base_probs = nests.base_probabilities(probs, columns)
+
+    # brute force nested logit for choosers with available alternatives in all nests
+    utils = utils[:2]
+    exp_auto = np.exp(utils[:, 3] / 0.4) + np.exp(utils[:, 2] / 0.4)
+    exp_motorized = np.exp(0.5 * np.log(exp_auto)) + np.exp(utils[:, 1] / 0.8)
+    exp_root = np.exp(0.8 * np.log(exp_motorized)) + np.exp(utils[:, 0])
+    p_motorized = np.exp(0.8 * np.log(exp_motorized)) / exp_root
+    p_auto = np.exp(0.5 * np.log(exp_auto)) / exp_motorized
+    expected = np.stack([np.exp(utils[:, 0]) / exp_root,
+                         p_motorized * np.exp(utils[:, 1] / 0.8) / exp_motorized,
+                         p_motorized * p_auto * np.exp(utils[:, 2] / 0.4) / exp_auto,
+                         p_motorized * p_auto * np.exp(utils[:, 3] / 0.4) / exp_auto], axis=1)
+
+    np.testing.assert_allclose(base_probs[:2], expected, rtol=1e-12)
+    np.testing.assert_allclose(nests.logsums(exp_utilities)[:2], np.log(exp_root), rtol=1e-12)
+
+    # nests with all unavailable alternatives get zero (not nan) probabilities
+    assert (probs[:nests.root, 2] == [0, 0, 0, 0, 0, 1]).all()
+    assert (base_probs[2] == [1, 0, 0, 0]).all()
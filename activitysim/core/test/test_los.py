@@ -2,6 +2,9 @@
 # See full license in LICENSE.txt.
 
 import os
+import pickle
+import shutil
+from multiprocessing import shared_memory
 
 import numpy as np
 import pandas as pd
@@ -10,8 +13,10 @@ import pandas.testing as pdt
 import pytest
 
 
+from .. import config
 from .. import inject
 from .. import los
+from .. import skim_dict_factory
 
 
 def teardown_function(func):
@@ -155,6 +160,166 @@ def test_three_zone():
     np.testing.assert_almost_equal(dist, [0.24, 0.14, 2.55, 1.9, 0.62])
 
 
+def test_maz_pairs():
+
+    add_canonical_dirs('configs_2z')
+
+    network_los = los.Network_LOS()
+    network_los.load_data()
+    pairs = network_los.maz_pairs
+
+    # compare to outer join of maz_to_maz tables
+    walk = pd.read_csv(os.path.join(inject.get_injectable('data_dir'), 'maz_to_maz_walk.csv'))
+    bike = pd.read_csv(os.path.join(inject.get_injectable('data_dir'), 'maz_to_maz_bike.csv'))
+    expected = pd.merge(walk, bike, on=['OMAZ', 'DMAZ'], how='outer')
+    assert set(pairs.columns) == set(expected.columns) - {'OMAZ', 'DMAZ'}
+    assert pairs.num_pairs == len(expected)
+
+    for c in pairs.columns:
+        npt.assert_array_equal(network_los.get_mazpairs(expected.OMAZ, expected.DMAZ, c),
+                               expected[c].values.astype(np.float32))
+
+    # pairs not in tables (including zone_ids beyond the largest OMAZ) are nan
+    values = network_los.get_mazpairs([1000, 1000, -1, 10**9], [10**9, -1, 1000, 1000], 'DIST')
+    assert np.isnan(values).all()
+
+    with pytest.raises(KeyError):
+        network_los.get_mazpairs([1000], [2000], 'BOGUS')
+
+    # round trip through shared buffers
+    buffers = pairs.allocate_shared_buffers(los.MAZ_PAIRS_BUFFER_TAG)
+    pairs.copy_to_buffers(buffers, los.MAZ_PAIRS_BUFFER_TAG)
+    shared_pairs = pairs.from_buffers(buffers, los.MAZ_PAIRS_BUFFER_TAG, pairs.columns)
+    pdt.assert_frame_equal(shared_pairs.to_frame(), pairs.to_frame())
+
+    # round trip through los cache
+    network_los = los.Network_LOS()
+    network_los.los_settings['write_los_cache'] = True
+    cache_path = network_los.los_cache_path('maz_to_maz', network_los.maz_to_maz_file_paths(),
+                                            {'dtype': network_los.skim_dtype_name})
+    shutil.rmtree(cache_path, ignore_errors=True)
+    network_los.load_maz_pairs()
+
+    network_los.los_settings['read_los_cache'] = True
+    network_los.los_settings['write_los_cache'] = False
+    cached_pairs = network_los.load_maz_pairs()
+    assert isinstance(cached_pairs.data, np.memmap)
+    pdt.assert_frame_equal(cached_pairs.to_frame(), pairs.to_frame())
+
+    del cached_pairs
+    shutil.rmtree(cache_path)
+
+
+def test_shared_maz_pairs(monkeypatch):
+
+    add_canonical_dirs('configs_2z')
+    config.override_setting('multiprocess', True)
+
+    network_los = los.Network_LOS()
+
+    load_maz_pairs = network_los.load_maz_pairs
+    loaded = []
+
+    def counting_load_maz_pairs():
+        loaded.append(True)
+        return load_maz_pairs()
+
+    monkeypatch.setattr(network_los, 'load_maz_pairs', counting_load_maz_pairs)
+
+    # maz_to_maz tables are loaded once, to both size and fill their shared buffers
+    skim_buffers = network_los.allocate_shared_skim_buffers()
+    network_los.load_shared_data(skim_buffers)
+    assert len(loaded) == 1
+
+    inject.add_injectable('data_buffers', skim_buffers)
+    network_los.load_data()
+    assert len(loaded) == 1
+
+    pdt.assert_frame_equal(network_los.maz_pairs.to_frame(), load_maz_pairs().to_frame())
+
+    inject.remove_injectable('data_buffers')
+
+
+def test_los_cache(monkeypatch):
+
+    add_canonical_dirs('configs_3z')
+
+    network_los = los.Network_LOS()
+    network_los.los_settings['write_los_cache'] = True
+    network_los.load_data()
+
+    cache_dir = config.get_cache_dir()
+    cache_files = [f for f in os.listdir(cache_dir) if f.startswith('los_')]
+    assert len(cache_files) == 4  # maz, maz_to_maz, and walk and drive maz_to_tap
+
+    # should not need to read any csv files
+    network_los2 = los.Network_LOS()
+    network_los2.los_settings['read_los_cache'] = True
+    with monkeypatch.context() as m:
+        m.setattr(pd, 'read_csv', None)
+        network_los2.load_data()
+
+    pdt.assert_frame_equal(network_los2.maz_taz_df, network_los.maz_taz_df)
+    for mode in ['walk', 'drive']:
+        pdt.assert_frame_equal(network_los2.maz_to_tap_dfs[mode], network_los.maz_to_tap_dfs[mode])
+    pdt.assert_frame_equal(network_los2.maz_pairs.to_frame(), network_los.maz_pairs.to_frame())
+
+    # changed maz_to_tap settings should not match cached table
+    network_los3 = los.Network_LOS()
+    network_los3.los_settings['read_los_cache'] = True
+    network_los3.los_settings['maz_to_tap']['walk']['max_dist'] = 1
+    with pytest.raises(TypeError):
+        with monkeypatch.context() as m:
+            m.setattr(pd, 'read_csv', None)
+            network_los3.load_data()
+
+    del network_los2
+    for f in cache_files:
+        path = os.path.join(cache_dir, f)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.unlink(path)
+
+
+def test_dynamic_tvpb_cache():
+
+    add_canonical_dirs('configs_3z')
+
+    network_los = los.Network_LOS()
+    network_los.los_settings['tvpb_cache_type'] = 'dynamic'
+    network_los.load_skim_info()
+
+    tap_cache = network_los.tvpb.tap_cache
+    assert tap_cache.is_dynamic
+    tap_cache.cleanup()
+
+    num_rows, num_sets = network_los.tvpb.uid_calculator.fully_populated_shape
+    uids = np.array([3, 1, num_rows - 1])
+    utilities = np.arange(len(uids) * num_sets, dtype=np.float32).reshape(len(uids), num_sets)
+
+    tap_cache.open()
+    assert tap_cache.uncached(uids).all()
+    tap_cache.add_to_cache(uids, utilities)
+    npt.assert_array_equal(tap_cache.uncached(np.array([0, 1, 2, 3])), [True, False, True, False])
+    npt.assert_array_equal(tap_cache.data[uids], utilities)
+    tap_cache.close()
+
+    # populated uids persist for subsequent runs
+    network_los = los.Network_LOS()
+    network_los.los_settings['tvpb_cache_type'] = 'dynamic'
+    network_los.load_skim_info()
+    tap_cache = network_los.tvpb.tap_cache
+    tap_cache.open()
+    assert not tap_cache.uncached(uids).any()
+    npt.assert_array_equal(tap_cache.data[uids], utilities)
+    tap_cache.close()
+
+    tap_cache.cleanup()
+    assert not os.path.isfile(tap_cache.cache_path)
+    assert not os.path.isfile(tap_cache.valid_path)
+
+
 def test_30_minute_windows():
 
     add_canonical_dirs('configs_test_misc')
@@ -212,3 +377,161 @@ def test_skim_time_periods_future_warning():
 
     with pytest.warns(FutureWarning) as warning_test:
         network_los = los.Network_LOS(los_settings_file_name='settings_legacy_hours_key.yaml')
+
+
+def test_shared_memory_skims():
+
+    add_canonical_dirs('configs_1z')
+    config.override_setting('multiprocess', True)
+
+    network_los = los.Network_LOS()
+    network_los.skim_dict_factory = skim_dict_factory.SharedMemorySkimFactory(network_los)
+
+    # main process allocates and loads shared memory segments
+    skim_buffers = network_los.allocate_shared_skim_buffers()
+    assert isinstance(skim_buffers['taz'], shared_memory.SharedMemory)
+    network_los.load_shared_data(skim_buffers)
+
+    # sub processes attach to shared memory segments by name
+    inject.add_injectable('data_buffers', pickle.loads(pickle.dumps(skim_buffers)))
+    network_los.load_data()
+
+    od_df = pd.DataFrame({
+        'orig': [5, 23, 23, 23],
+        'dest': [7, 20, 21, 22]
+    })
+
+    skims = network_los.get_default_skim_dict().wrap('orig', 'dest')
+    skims.set_df(od_df)
+    pdt.assert_series_equal(skims['DIST'], pd.Series([0.4, 2.55, 1.9, 0.62]).astype(np.float32))
+
+    inject.remove_injectable('data_buffers')
+    network_los.release_shared_skim_buffers(skim_buffers)
+
+
+def test_concurrent_omx_reader():
+
+    add_canonical_dirs('configs_1z')
+
+    network_los = los.Network_LOS()
+    skim_info = network_los.skims_info['taz']
+    factory = network_los.skim_dict_factory
+
+    skim_data = factory._skim_data_from_buffer(skim_info, factory.allocate_skim_buffer(skim_info))
+    factory._read_skims_from_omx(skim_info, skim_data)
+
+    network_los.los_settings['omx_read_processes'] = 2
+    concurrent_skim_data = factory._skim_data_from_buffer(skim_info, factory.allocate_skim_buffer(skim_info))
+    factory._read_skims_from_omx(skim_info, concurrent_skim_data)
+
+    npt.assert_array_equal(concurrent_skim_data, skim_data)
+    assert skim_data.any()
+
+
+def test_used_skims_only():
+
+    add_canonical_dirs('configs_1z')
+
+    od_df = pd.DataFrame({
+        'orig': [5, 23, 23, 23],
+        'dest': [7, 20, 21, 22]
+    })
+
+    # record skim usage as track_skim_usage would at end of prior run
+    network_los = los.Network_LOS()
+    if os.path.isfile(skim_dict_factory.skim_usage_file_path('taz')):
+        os.unlink(skim_dict_factory.skim_usage_file_path('taz'))
+    network_los.load_data()
+    skims = network_los.get_default_skim_dict().wrap('orig', 'dest')
+    skims.set_df(od_df)
+    dist = skims['DIST']
+    skim_dict_factory.write_skim_usage('taz', network_los.get_default_skim_dict().get_skim_usage())
+    assert skim_dict_factory.read_skim_usage('taz') == {'DIST'}
+    num_skims = network_los.skims_info['taz'].num_skims
+
+    network_los = los.Network_LOS()
+    network_los.los_settings['used_skims_only'] = True
+    network_los.load_skim_info()
+    assert network_los.skims_info['taz'].num_skims == 1 < num_skims
+    cache_suffix = network_los.skims_info['taz'].cache_suffix
+    assert cache_suffix.startswith('_used_')
+    network_los.load_data()
+
+    skim_dict = network_los.get_default_skim_dict()
+    skims = skim_dict.wrap('orig', 'dest')
+    skims.set_df(od_df)
+    pdt.assert_series_equal(skims['DIST'], dist)
+
+    with pytest.raises(RuntimeError) as excinfo:
+        skims['DISTBIKE']
+    assert "not listed in skim usage file" in str(excinfo.value)
+
+    # usage from later (e.g. partial) runs is merged with rather than replacing earlier usage
+    skim_dict_factory.write_skim_usage('taz', [('DISTBIKE', 'AM')])
+    assert skim_dict_factory.read_skim_usage('taz') == {'DIST', 'DISTBIKE'}
+
+    # skim cache files of different skim subsets are distinct
+    network_los = los.Network_LOS()
+    network_los.los_settings['used_skims_only'] = True
+    network_los.load_skim_info()
+    assert network_los.skims_info['taz'].cache_suffix.startswith('_used_')
+    assert network_los.skims_info['taz'].cache_suffix != cache_suffix
+
+    # empty usage file is treated as missing (load all skims) rather than loading none
+    open(skim_dict_factory.skim_usage_file_path('taz'), 'w').close()
+    assert skim_dict_factory.read_skim_usage('taz') is None
+    network_los = los.Network_LOS()
+    network_los.los_settings['used_skims_only'] = True
+    network_los.load_skim_info()
+    assert network_los.skims_info['taz'].num_skims == num_skims
+
+    os.unlink(skim_dict_factory.skim_usage_file_path('taz'))
+
+
+def test_skim_cache_size_mismatch():
+
+    add_canonical_dirs('configs_1z')
+
+    network_los = los.Network_LOS()
+    skim_info = network_los.skims_info['taz']
+    factory = network_los.skim_dict_factory
+
+    # skim cache file that doesn't match skim_info shape is ignored rather than misread
+    skim_cache_path = factory._memmap_skim_data_path(skim_info)
+    factory.copy_omx_to_mmap_file(skim_info)
+    assert factory._open_existing_readonly_memmap_skim_cache(skim_info) is not None
+
+    with open(skim_cache_path, 'ab') as f:
+        f.write(np.zeros(1, dtype=skim_info.storage_dtype_name).tobytes())
+    assert factory._open_existing_readonly_memmap_skim_cache(skim_info) is None
+
+    os.unlink(skim_cache_path)
+
+
+def test_quantized_skims():
+
+    add_canonical_dirs('configs_1z')
+
+    od_df = pd.DataFrame({
+        'orig': [5, 23, 23, 23],
+        'dest': [7, 20, 21, 22]
+    })
+
+    network_los = los.Network_LOS()
+    network_los.los_settings['skim_quantization'] = True
+    network_los.load_skim_info()
+    skim_info = network_los.skims_info['taz']
+    assert skim_info.storage_dtype_name == 'uint16'
+
+    network_los.load_data()
+    skims = network_los.get_default_skim_dict().wrap('orig', 'dest')
+    skims.set_df(od_df)
+    pdt.assert_series_equal(skims['DIST'], pd.Series([0.4, 2.55, 1.9, 0.62]).astype(np.float32), atol=1e-3)
+
+    # validation report of max error per key
+    report = pd.read_csv(config.output_file_path('skim_quantization_taz.csv'))
+    assert len(report) == skim_info.num_skims
+    uint16 = (report.encoding == 'uint16')
+    assert (report.max_error[uint16] <= report.scale[uint16] / 2 + 1e-6).all()
+
+    os.unlink(skim_dict_factory.SkimQuantization.file_path(skim_info))
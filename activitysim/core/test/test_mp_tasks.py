@@ -0,0 +1,205 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+import os
+import time
+
+import pandas.testing as pdt
+import pytest
+
+from activitysim.core import config
+from activitysim.core import inject
+from activitysim.core import mp_tasks
+from activitysim.core import pipeline
+from activitysim.core import tracing
+
+from .extensions import steps
+
+STEP_NAME = 'mp_step'
+SUB_PROC_NAMES = ['mp_step_0', 'mp_step_1']
+WORK_UNIT_NAMES = ['mp_step_unit_0', 'mp_step_unit_1', 'mp_step_unit_2']
+
+
+def step_wait_for_peers():
+    # locutor fails while the other sub processes wait for it at the sub_process_barrier
+    if inject.get_injectable('locutor'):
+        raise RuntimeError("locutor failed")
+    inject.get_injectable('sub_process_barrier').wait()
+
+
+def setup_function():
+
+    inject.reinject_decorated_tables()
+
+    configs_dir = os.path.join(os.path.dirname(__file__), 'configs')
+    inject.add_injectable("configs_dir", configs_dir)
+
+    output_dir = os.path.join(os.path.dirname(__file__), 'output')
+    inject.add_injectable("output_dir", output_dir)
+
+    data_dir = os.path.join(os.path.dirname(__file__), 'data')
+    inject.add_injectable("data_dir", data_dir)
+
+    # so sub processes don't register abm steps
+    inject.add_injectable('preload_injectables', True)
+
+    inject.remove_injectable('breadcrumbs')
+
+    inject.clear_cache()
+
+    tracing.config_logger()
+
+    inject.add_step('step1', steps.step1)
+    inject.add_step('step2', steps.step2)
+    inject.add_step('step3', steps.step3)
+    inject.add_step('step_add_col', steps.step_add_col)
+    inject.add_step('step_wait_for_peers', step_wait_for_peers)
+
+
+def teardown_function(func):
+    if os.path.exists(mp_tasks.breadcrumbs_file_path()):
+        os.unlink(mp_tasks.breadcrumbs_file_path())
+    inject.remove_injectable('preload_injectables')
+    inject.remove_injectable('pipeline_file_prefix')
+    inject.remove_injectable('breadcrumbs')
+    inject.clear_cache()
+    inject.reinject_decorated_tables()
+
+
+def step_info():
+    return {
+        'name': STEP_NAME,
+        'models': ['step_add_col.table_name=table1;column_name=c2'],
+        'num_processes': len(SUB_PROC_NAMES),
+        'chunk_size': 0,
+        'step_num': 1,
+        'slice': {'tables': ['table1']},
+        'last_checkpoint_in_previous_multiprocess_step': 'step3',
+    }
+
+
+def injectables():
+    return {k: inject.get_injectable(k) for k in ['configs_dir', 'output_dir', 'data_dir']}
+
+
+def apportion(pipeline_names):
+    # single process run of the models preceding the multiprocess step
+    inject.reinject_decorated_tables(injectables=False)
+    pipeline.run(models=['step1', 'step2', 'step3'], resume_after=None)
+    pipeline.close_pipeline()
+
+    mp_tasks.apportion_pipeline(pipeline_names, step_info())
+
+
+def coalesced_table1(pipeline_names):
+    mp_tasks.coalesce_pipelines(pipeline_names, step_info()['slice'])
+
+    pipeline.open_pipeline('_')
+    assert pipeline.last_checkpoint() == STEP_NAME
+    table1 = pipeline.get_table('table1')
+    pipeline.close_pipeline()
+
+    return table1
+
+
+def last_checkpoint(pipeline_name):
+    inject.add_injectable('pipeline_file_prefix', pipeline_name)
+    pipeline.open_pipeline('_')
+    checkpoint_name = pipeline.last_checkpoint()
+    pipeline.close_pipeline()
+    inject.remove_injectable('pipeline_file_prefix')
+    return checkpoint_name
+
+
+def test_dynamic_work_units():
+
+    # - static run with one apportioned pipeline per sub process
+    apportion(SUB_PROC_NAMES)
+    completed = mp_tasks.run_sub_simulations(injectables(), {}, step_info(), SUB_PROC_NAMES,
+                                             None, [], fail_fast=True)
+    assert sorted(completed) == SUB_PROC_NAMES
+    static_table1 = coalesced_table1(SUB_PROC_NAMES)
+    assert static_table1.c2.tolist() == (static_table1.index + 1000).tolist()
+
+    # - dynamic run with more work units than sub processes
+    apportion(WORK_UNIT_NAMES)
+    completed = mp_tasks.run_sub_simulations(injectables(), {}, step_info(), SUB_PROC_NAMES,
+                                             None, [], fail_fast=True, work_unit_names=WORK_UNIT_NAMES)
+    assert sorted(completed) == WORK_UNIT_NAMES
+    assert sorted(mp_tasks.read_breadcrumbs()[STEP_NAME]['completed']) == WORK_UNIT_NAMES
+
+    # each work unit ran in its own pipeline, regardless of which sub process ran it
+    assert all(last_checkpoint(name) == STEP_NAME for name in WORK_UNIT_NAMES)
+
+    # coalesced rows are in order of apportioned pipelines
+    pdt.assert_frame_equal(coalesced_table1(WORK_UNIT_NAMES).sort_index(), static_table1.sort_index())
+
+
+def test_dynamic_work_units_resume():
+
+    apportion(WORK_UNIT_NAMES)
+
+    # resuming where previous run left off skips work units it completed
+    previously_completed = WORK_UNIT_NAMES[:2]
+    completed = mp_tasks.run_sub_simulations(injectables(), {}, step_info(), SUB_PROC_NAMES,
+                                             mp_tasks.LAST_CHECKPOINT, previously_completed,
+                                             fail_fast=True, work_unit_names=WORK_UNIT_NAMES)
+    assert sorted(completed) == WORK_UNIT_NAMES
+
+    assert [last_checkpoint(name) for name in WORK_UNIT_NAMES] == ['step3', 'step3', STEP_NAME]
+
+
+def test_failed_sub_process():
+
+    info = step_info()
+    info['models'] = ['step_wait_for_peers']
+
+    apportion(SUB_PROC_NAMES)
+
+    # peers waiting for failed sub process at barrier fail too, rather than hanging
+    t0 = time.time()
+    completed = mp_tasks.run_sub_simulations(injectables(), {}, info, SUB_PROC_NAMES,
+                                             None, [], fail_fast=False)
+    assert completed == []
+    assert time.time() - t0 < 60
+
+    # with fail_fast, raise as soon as sub process fails
+    with pytest.raises(RuntimeError) as excinfo:
+        mp_tasks.run_sub_simulations(injectables(), {}, info, SUB_PROC_NAMES,
+                                     None, [], fail_fast=True)
+    assert "failed" in str(excinfo.value)
+
+
+def test_run_list_num_work_units(tmp_path):
+
+    def run_list_step(num_processes, num_work_units, last_model='step3'):
+        config.override_setting('models', ['step1', 'step2', last_model])
+        config.override_setting('multiprocess', True)
+        config.override_setting('multiprocess_steps', [
+            {'name': 'mp_initialize', 'begin': 'step1'},
+            {'name': STEP_NAME, 'begin': last_model, 'slice': {'tables': ['table1']},
+             'num_processes': num_processes, 'num_work_units': num_work_units},
+        ])
+        return mp_tasks.get_run_list()['multiprocess_steps'][1]
+
+    assert run_list_step(num_processes=2, num_work_units=3)['num_work_units'] == 3
+
+    # ignored if only one process
+    assert run_list_step(num_processes=1, num_work_units=3)['num_work_units'] == 0
+
+    with pytest.raises(RuntimeError) as excinfo:
+        run_list_step(num_processes=2, num_work_units=1)
+    assert "less than num_processes" in str(excinfo.value)
+
+    # shadow priced models synchronize across sub processes, so can't be run on work units
+    with open(os.path.join(tmp_path, 'shadow_pricing.yaml'), 'w') as f:
+        f.write("shadow_pricing_models:\n  school: step3\n")
+    inject.add_injectable('configs_dir', [str(tmp_path), inject.get_injectable('configs_dir')])
+
+    with pytest.raises(RuntimeError) as excinfo:
+        run_list_step(num_processes=2, num_work_units=3)
+    assert "shadow priced models" in str(excinfo.value)
+
+    # as does initialize_tvpb
+    with pytest.raises(RuntimeError) as excinfo:
+        run_list_step(num_processes=2, num_work_units=3, last_model='initialize_tvpb')
+    assert "has initialize_tvpb" in str(excinfo.value)
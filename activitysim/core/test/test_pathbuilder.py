@@ -0,0 +1,118 @@
+# ActivitySim
+# See full license in LICENSE.txt.
+
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+
+from .. import pathbuilder
+from .. import pathbuilder_cache
+
+
+def best_paths_reference(access, egress, tap_tap_utilities, max_paths_per_tap_set, max_paths_across_tap_sets):
+    # brute force best paths for a single chooser with access and egress lists of (tap, utility)
+    num_taps = int(np.sqrt(tap_tap_utilities.shape[0]))
+    candidates = []
+    for s in range(tap_tap_utilities.shape[1]):
+        set_paths = [((float(tap_tap_utilities[b * num_taps + a, s]) + au) + eu, b, a, s)
+                     for b, au in access for a, eu in egress if a != b]
+        # stable sorts keep candidate order for equal utilities
+        candidates += sorted(set_paths, key=lambda p: -p[0])[:max_paths_per_tap_set]
+    return sorted(candidates, key=lambda p: -p[0])[:max_paths_across_tap_sets]
+
+
+def test_best_paths():
+
+    rng = np.random.default_rng(0)
+    num_taps = 6
+    num_sets = 3
+    # rounded so there are ties
+    tap_tap_utilities = np.round(rng.normal(size=(num_taps * num_taps, num_sets)), 1).astype(np.float32)
+
+    access = [[(0, -1.0), (2, -0.5), (3, -1.0)], [(1, -0.2)], []]
+    egress = [[(2, -0.3), (4, -0.3), (5, -0.1)], [(1, 0.0)], [(0, -1.0)]]
+
+    def csr(legs):
+        ptr = np.cumsum([0] + [len(leg) for leg in legs])
+        taps = np.array([t for leg in legs for t, _ in leg], dtype=np.int64)
+        utilities = np.array([u for leg in legs for _, u in leg], dtype=np.float64)
+        return ptr, taps, utilities
+
+    access_ptr, access_tap, access_utility = csr(access)
+    egress_ptr, egress_tap, egress_utility = csr(egress)
+    seq = np.arange(len(access), dtype=np.int64)
+    seq_base_uid = np.zeros(len(access), dtype=np.int64)
+
+    for max_paths_per_tap_set, max_paths_across_tap_sets in [(1, 1), (2, 3), (4, 8)]:
+
+        shape = (len(access), max_paths_across_tap_sets)
+        path_utility = np.full(shape, pathbuilder.UNAVAILABLE, dtype=np.float64)
+        path_btap, path_atap, path_set = [np.zeros(shape, dtype=np.int64) for _ in range(3)]
+
+        num_paths = pathbuilder._best_paths(seq, seq, access_ptr, access_tap, access_utility,
+                                            egress_ptr, egress_tap, egress_utility, seq_base_uid, num_taps,
+                                            tap_tap_utilities, max_paths_per_tap_set,
+                                            path_utility, path_btap, path_atap, path_set)
+
+        for i in seq:
+            expected = best_paths_reference(access[i], egress[i], tap_tap_utilities,
+                                            max_paths_per_tap_set, max_paths_across_tap_sets)
+            assert num_paths[i] == len(expected)
+            n = num_paths[i]
+            npt.assert_array_equal(path_utility[i, :n], [p[0] for p in expected])
+            npt.assert_array_equal(path_btap[i, :n], [p[1] for p in expected])
+            npt.assert_array_equal(path_atap[i, :n], [p[2] for p in expected])
+            npt.assert_array_equal(path_set[i, :n], [p[3] for p in expected])
+            assert (path_utility[i, n:] == pathbuilder.UNAVAILABLE).all()
+
+        # chooser 1 only has a same tap path and chooser 2 has no access taps
+        npt.assert_array_equal(num_paths[1:], 0)
+
+
+def test_logsum_cache():
+
+    cache = pathbuilder_cache.TVPBLogsumCache(max_size=4)
+
+    orig = pd.Series([1, 2, 3])
+    dest = pd.Series([4, 5, 6])
+    segment = pd.Series([0, 1, 0])
+    keys = cache.keys('tour_mode_choice', 'WTW', orig, dest, 'AM', segment)
+    assert keys.dtype == np.int64
+
+    # keys differ by every key attribute and are the same for the same attributes
+    npt.assert_array_equal(cache.keys('tour_mode_choice', 'WTW', orig, dest, 'AM', segment), keys)
+    assert cache.keys('tour_mode_choice', 'WTW', orig, dest, 'AM', None)[0] != keys[0]
+    assert cache.keys('tour_mode_choice', 'WTW', orig, dest, 'AM', None)[0] != keys[2]
+    assert cache.keys('tour_mode_choice', 'DTW', orig, dest, 'AM', segment)[0] != keys[0]
+    assert cache.keys('trip_mode_choice', 'WTW', orig, dest, 'AM', segment)[0] != keys[0]
+    assert cache.keys('tour_mode_choice', 'WTW', dest, orig, 'AM', segment)[0] != keys[0]
+
+    values, hit = cache.lookup(keys, 'WTW')
+    assert not hit.any() and np.isnan(values).all()
+
+    cache.store(keys, np.array([-1.0, -2.0, -3.0]))
+    values, hit = cache.lookup(keys[:2], 'WTW')
+    assert hit.all()
+    npt.assert_array_equal(values, [-1.0, -2.0])
+    assert cache.hit_rate('WTW') == 2 / 5
+
+    # different tod is a different key
+    pm_keys = cache.keys('tour_mode_choice', 'WTW', orig, dest, pd.Series(['PM', 'AM', 'AM']), segment)
+    _, hit = cache.lookup(pm_keys, 'WTW')
+    npt.assert_array_equal(hit, [False, True, True])
+
+    # least recently used key (keys[0] was used before keys[1] and keys[2]) is evicted first
+    new_keys = cache.keys('tour_mode_choice', 'WTW', pd.Series([7]), pd.Series([8]), 'AM', pd.Series([0]))
+    cache.store(np.append(pm_keys[:1], new_keys), [-4.0, -5.0])
+    assert len(cache) == 4
+    _, hit = cache.lookup(keys, 'WTW')
+    npt.assert_array_equal(hit, [False, True, True])
+
+    # last value stored for a repeated key wins
+    cache.store(np.append(new_keys, new_keys), [-6.0, -7.0])
+    values, _ = cache.lookup(new_keys, 'other')
+    npt.assert_array_equal(values, [-7.0])
+
+    stats_df = cache.stats_df()
+    assert stats_df.loc['WTW', 'lookups'] == 11
+    assert stats_df.loc['WTW', 'hits'] == 6
@@ -4,11 +4,15 @@ import os
 import logging
 import pytest
 
+import pandas as pd
 import tables
 
+from activitysim.core import config
 from activitysim.core import tracing
 from activitysim.core import pipeline
 from activitysim.core import inject
+from activitysim.core import mp_tasks
+from activitysim.core import pipeline_store
 
 from .extensions import steps
 
@@ -137,6 +141,157 @@ def test_pipeline_checkpoint_drop():
     pipeline.close_pipeline()
     close_handlers()
 
+
+def test_pipeline_parquet_store():
+
+    inject.add_step('step1', steps.step1)
+    inject.add_step('step2', steps.step2)
+    inject.add_step('step3', steps.step3)
+    inject.add_step('step_add_col', steps.step_add_col)
+
+    config.override_setting('pipeline_store_format', 'parquet')
+    config.override_setting('pipeline_store_compression', {'c2': 'zstd'})
+
+    _MODELS = [
+        'step1',
+        'step2',
+        'step3',
+        'step_add_col.table_name=table2;column_name=c2'
+    ]
+
+    pipeline.run(models=_MODELS, resume_after=None)
+
+    assert isinstance(pipeline.get_pipeline_store(), pipeline_store.ParquetPipelineStore)
+    assert pipeline.get_pipeline_store().filename.endswith('pipeline.parquet')
+
+    table1 = pipeline.get_table("table1")
+    table2 = pipeline.get_table("table2")
+    assert 'table2/step2' in pipeline.get_pipeline_store()
+    assert '/table1/step1' in pipeline.get_pipeline_store().keys()
+
+    pipeline.close_pipeline()
+
+    # checkpoints can be read without opening pipeline
+    checkpoints = pipeline.get_checkpoints()
+    assert checkpoints.checkpoint_name.tolist()[:4] == ['init', 'step1', 'step2', 'step3']
+
+    # resume from last checkpoint and read tables back from parquet store
+    pipeline.open_pipeline('_')
+    pd.testing.assert_frame_equal(pipeline.get_table("table1"), table1)
+    pd.testing.assert_frame_equal(pipeline.get_table("table2"), table2)
+    assert 'c2' not in pipeline.get_table("table2", checkpoint_name="step2")
+    pipeline.close_pipeline()
+
+    close_handlers()
+
+
+@pytest.mark.parametrize("store_format", ['hdf5', 'parquet'])
+def test_pipeline_column_deltas(store_format):
+
+    inject.add_step('step1', steps.step1)
+    inject.add_step('step2', steps.step2)
+    inject.add_step('step_add_col', steps.step_add_col)
+
+    config.override_setting('pipeline_store_format', store_format)
+    config.override_setting('checkpoint_column_deltas', True)
+
+    _MODELS = [
+        'step1',
+        'step2',
+        'step_add_col.table_name=table2;column_name=c2',
+    ]
+
+    pipeline.run(models=_MODELS, resume_after=None)
+
+    add_c2 = 'step_add_col.table_name=table2;column_name=c2'
+    table2 = pipeline.get_table("table2")
+
+    # only the added column should have been written
+    store = pipeline.get_pipeline_store()
+    assert store[pipeline.pipeline_table_key('table2', add_c2)].columns.tolist() == ['c2']
+    assert pipeline.column_map_key(pipeline.pipeline_table_key('table2', add_c2)) in store
+    pd.testing.assert_frame_equal(pipeline.read_df('table2', add_c2), table2)
+
+    pipeline.close_pipeline()
+
+    # resume and add another column
+    pipeline.run(models=['step_add_col.table_name=table2;column_name=c3'], resume_after='_')
+
+    add_c3 = 'step_add_col.table_name=table2;column_name=c3'
+    table2 = pipeline.get_table("table2")
+    assert table2.columns.tolist() == ['c', 'c2', 'c3']
+
+    store = pipeline.get_pipeline_store()
+    assert store[pipeline.pipeline_table_key('table2', add_c3)].columns.tolist() == ['c3']
+    pd.testing.assert_frame_equal(pipeline.read_df('table2', add_c3), table2)
+    assert pipeline.get_table("table2", checkpoint_name=add_c2).columns.tolist() == ['c', 'c2']
+
+    pipeline.close_pipeline()
+
+    close_handlers()
+
+
+@pytest.mark.parametrize("store_format", ['hdf5', 'parquet'])
+def test_pipeline_apportion_coalesce(store_format):
+
+    inject.add_step('step1', steps.step1)
+    inject.add_step('step2', steps.step2)
+    inject.add_step('step3', steps.step3)
+    inject.add_step('step_add_col', steps.step_add_col)
+
+    config.override_setting('pipeline_store_format', store_format)
+    config.override_setting('checkpoint_column_deltas', True)
+
+    pipeline.run(models=['step1', 'step2', 'step3'], resume_after=None)
+    table1 = pipeline.get_table("table1")
+    table2 = pipeline.get_table("table2")
+    table3 = pipeline.get_table("table3")
+    pipeline.close_pipeline()
+
+    # table1 is sliced and table2 and table3 (with no ref_col to table1) are mirrored
+    sub_proc_names = ['mp_step_0', 'mp_step_1']
+    step_info = {'name': 'mp_step', 'slice': {'tables': ['table1']},
+                 'last_checkpoint_in_previous_multiprocess_step': 'step3'}
+    mp_tasks.apportion_pipeline(sub_proc_names, step_info)
+
+    add_c2 = 'step_add_col.table_name=table1;column_name=c2'
+    add_t2_c2 = 'step_add_col.table_name=table2;column_name=c2'
+    for i, sub_proc_name in enumerate(sub_proc_names):
+        inject.add_injectable('pipeline_file_prefix', sub_proc_name)
+
+        # mirrored tables are not copied to sub_proc pipeline but read from parent pipeline
+        pipeline_file_path = config.pipeline_file_path(inject.get_injectable('pipeline_file_name'))
+        with pipeline_store.open_store(pipeline_file_path, mode='r') as store:
+            assert 'table1/mp_step' in store and 'table2/mp_step' not in store
+
+        pipeline.run(models=[add_c2, add_t2_c2], resume_after='_')
+        pd.testing.assert_frame_equal(pipeline.get_table("table1")[['c']], table1.iloc[i::2])
+        pd.testing.assert_frame_equal(pipeline.get_table("table2")[['c']], table2)
+        pd.testing.assert_frame_equal(pipeline.get_table("table3"), table3)
+        # as mp_tasks.run_simulation does
+        pipeline.add_checkpoint('mp_step')
+        pipeline.close_pipeline()
+
+    inject.remove_injectable('pipeline_file_prefix')
+    mp_tasks.coalesce_pipelines(sub_proc_names, step_info['slice'])
+
+    pipeline.open_pipeline('_')
+    table1 = pipeline.get_table("table1")
+    assert sorted(table1.index) == [0, 1, 2]
+    assert table1.c2.tolist() == (table1.index + 1000).tolist()
+    assert pipeline.get_table("table2").c2.tolist() == (table2.index + 1000).tolist()
+    pd.testing.assert_frame_equal(pipeline.get_table("table3"), table3)
+
+    # mirrored table3 was not changed by the sub_procs, so was not rewritten
+    checkpoints = pipeline.get_checkpoints()
+    assert checkpoints.checkpoint_name.tolist()[-2:] == ['step3', 'mp_step']
+    assert checkpoints.table1.iloc[-1] == 'mp_step'
+    assert checkpoints.table2.iloc[-1] == 'mp_step'
+    assert checkpoints.table3.iloc[-1] == 'step3'
+    pipeline.close_pipeline()
+
+    close_handlers()
+
 # if __name__ == "__main__":
 #
 #     print "\n\ntest_pipeline_run"
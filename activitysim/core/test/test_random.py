@@ -109,3 +109,86 @@ def test_channel():
     npt.assert_almost_equal(np.asanyarray(rands).flatten(), test1_expected_rands2)
 
     rng.end_step('test_step')
+
+
+def test_philox4x32():
+
+    # Random123 known answer tests for philox4x32-10
+    words = random.philox4x32((0, 0, 0, 0), (0, 0))
+    assert [int(w) for w in words] == [0x6627e8d5, 0xe169c58d, 0xbc57ac4c, 0x9b00dbd8]
+
+    m = 0xffffffff
+    words = random.philox4x32((m, m, m, m), (m, m))
+    assert [int(w) for w in words] == [0x408f276d, 0x41c83b0e, 0xa20bc7c6, 0x6d5451fd]
+
+    words = random.philox4x32((0x243f6a88, 0x85a308d3, 0x13198a2e, 0x03707344), (0xa4093822, 0x299f31d0))
+    assert [int(w) for w in words] == [0xd16cfe09, 0x94fdcceb, 0x5001e420, 0x24126ea1]
+
+
+def test_philox_channel():
+
+    def make_rng():
+        rng = random.Random()
+        rng.set_channel_type('philox')
+        return rng
+
+    households = pd.DataFrame({
+        "data": [1, 1, 2, 2, 2, 3],
+    }, index=[1, 2, 3, 4, 5, 1 << 40])
+    households.index.name = 'household_id'
+
+    rng = make_rng()
+    rng.begin_step('test_step')
+    rng.add_channel('households', households)
+
+    rands = rng.random_for_df(households, n=2)
+    assert rands.shape == (6, 2)
+    assert ((rands >= 0) & (rands < 1)).all()
+
+    # next call should continue the stream
+    rands2 = rng.random_for_df(households)
+    assert not np.isin(rands2, rands).any()
+
+    normals = rng.normal_for_df(households, mu=0, sigma=1)
+    assert normals.shape == (6,)
+
+    choices = rng.choice_for_df(households, [1, 2, 3, 4], 2, replace=True)
+    assert choices.shape == (12,)
+    assert np.isin(choices, [1, 2, 3, 4]).all()
+
+    choices = rng.choice_for_df(households, 10, 4, replace=False)
+    assert choices.shape == (24,)
+    # no duplicate choices for any row
+    choices = np.sort(choices.reshape(6, 4), axis=1)
+    assert (choices[:, 1:] != choices[:, :-1]).all()
+
+    rng.end_step('test_step')
+
+    # same rands when drawn in chunks, in a different order, by a different Random
+    rng = make_rng()
+    rng.begin_step('test_step')
+    rng.add_channel('households', households)
+
+    chunk1 = households.iloc[[4, 0, 5]]
+    chunk2 = households.iloc[[3, 1, 2]]
+    chunk_rands = rng.random_for_df(chunk1, n=2)
+    npt.assert_almost_equal(chunk_rands, rands[[4, 0, 5]])
+    chunk_rands = rng.random_for_df(chunk2, n=2)
+    npt.assert_almost_equal(chunk_rands, rands[[3, 1, 2]])
+    npt.assert_almost_equal(rng.random_for_df(households), rands2)
+
+    rng.end_step('test_step')
+
+    # different step should be different
+    rng.begin_step('test_step2')
+    assert not np.isin(rng.random_for_df(households, n=2), rands).any()
+    rng.end_step('test_step2')
+
+    # can only set channel type before first step
+    with pytest.raises(RuntimeError) as excinfo:
+        rng.set_channel_type('simple')
+    assert "call set_channel_type before the first step" in str(excinfo.value)
+
+    with pytest.raises(RuntimeError) as excinfo:
+        random.Random().set_channel_type('bogus')
+    assert "Unknown rng_channel_type" in str(excinfo.value)
@@ -9,6 +9,7 @@ import pandas as pd
 import pandas.testing as pdt
 import pytest
 
+from .. import chunk
 from .. import inject
 
 from .. import simulate
@@ -91,3 +92,49 @@ def test_simple_simulate_chunked(data, spec):
     choices = simulate.simple_simulate(choosers=data, spec=spec, nest_spec=None, chunk_size=2)
     expected = pd.Series([1, 1, 1], index=data.index)
     pdt.assert_series_equal(choices, expected)
+
+
+def test_compile_expression(data):
+
+    assert simulate.compile_expression('@df.thing2.clip(upper=5)')[0] == simulate.EXPR_LOCALS
+    assert simulate.compile_expression('thing1 == 2')[0] == simulate.EXPR_COLUMNS
+    assert simulate.compile_expression('(thing1 == 2) * thing2 - 1')[2] == ('thing1', 'thing2')
+
+    # operators that DataFrame.eval treats differently than python are left to DataFrame.eval
+    for expr in ['(thing1 == 2) & (thing2 > 4)', '1 < thing2 < 5', 'thing2 / 3', '~(thing1 == 2)', '1']:
+        assert simulate.compile_expression(expr)[0] == simulate.EXPR_PANDAS
+
+    df = data.astype(np.int8)
+    for expr in ['thing1 == 2', '(thing1 == 2) * thing2 - 1', 'thing2 * 100 * thing2', '-thing1 + 0.5']:
+        pdt.assert_series_equal(simulate.eval_expression(expr, df, {}, {}), df.eval(expr),
+                                check_dtype=False, check_names=False)
+
+    # fall back to DataFrame.eval if names are not chooser columns
+    df.index.name = 'thing3'
+    pdt.assert_series_equal(simulate.eval_expression('thing3 + thing1', df, {}, {}), df.eval('thing3 + thing1'))
+
+
+def test_read_model_spec_compiles_expressions(spec_name):
+
+    simulate._COMPILED_EXPRESSIONS.clear()
+    spec = simulate.read_model_spec(file_name=spec_name)
+    assert set(simulate._COMPILED_EXPRESSIONS) == set(spec.index)
+
+
+def test_eval_utilities(data, spec):
+
+    # zero coefficients, and bool, int and scalar expression values
+    spec = spec.copy()
+    spec.iloc[0, 1] = 0
+    spec.iloc[1, :] = 0
+
+    # float16 (e.g. downcast) columns
+    data = data.astype({'thing2': np.float16})
+
+    with chunk.chunk_log('test_eval_utilities', base=True):
+        utilities = simulate.eval_utilities(spec, data)
+
+    expression_values = simulate.eval_variables(spec.index, data).values.astype(np.float64)
+    npt.assert_allclose(utilities.values, np.dot(expression_values, spec.values))
+    pdt.assert_index_equal(utilities.index, data.index)
+    pdt.assert_index_equal(utilities.columns, spec.columns)
@@ -8,6 +8,7 @@ import pandas.testing as pdt
 import pytest
 
 from .. import skim_dictionary
+from .. import skim_dict_factory
 
 
 @pytest.fixture
@@ -99,3 +100,74 @@ def test_3dskims(data):
         ),
         check_dtype=False
     )
+
+
+def test_quantized_3dskims(data):
+
+    omx_shape = (10, 10)
+    values = np.stack([data, data / 7.0, data * 1000.0 + 0.5])
+    values[1, 0, 0] = np.nan
+
+    skim_info = FakeSkimInfo()
+    skim_info.block_offsets = {('SOV', 'AM'): 0, ('SOV', 'MD'): 1, ('SOV', 'PM'): 2}
+    skim_info.omx_keys = {k: f"{k[0]}__{k[1]}" for k in skim_info.block_offsets}
+    skim_info.num_skims = 3
+    skim_info.omx_shape = omx_shape
+    skim_info.dtype_name = 'float32'
+
+    quantization = skim_dict_factory.SkimQuantization(skim_info)
+    codes = np.zeros(values.shape, dtype=np.uint16)
+    for skim_key, offset in skim_info.block_offsets.items():
+        quantization.encode(skim_key, values[offset], codes[offset])
+
+    # integer block is encoded losslessly
+    assert not quantization.is_float16[0] and quantization.max_error[0] == 0
+
+    report = quantization.to_df()
+    assert report.omx_key.tolist() == ['SOV__AM', 'SOV__MD', 'SOV__PM']
+    assert (report.max_error <= np.nanmax(np.abs(values), axis=(1, 2)) / 1000).all()
+
+    skim_data = skim_dict_factory.QuantizedSkimData(codes, quantization, skim_info.dtype_name)
+    skim_dict = skim_dictionary.SkimDict('taz', skim_info, skim_data)
+    skim_dict.offset_mapper.set_offset_int(0)
+    skims3d = skim_dict.wrap_3d(orig_key="taz_l", dest_key="taz_r", dim3_key="period")
+
+    df = pd.DataFrame({
+        "taz_l": [1, 9, 4, 0],
+        "taz_r": [2, 3, 7, 0],
+        "period": ['AM', 'PM', 'MD', 'MD']
+    })
+    skims3d.set_df(df)
+
+    expected = np.array([values[0, 1, 2], values[2, 9, 3], values[1, 4, 7], np.nan])
+    npt.assert_allclose(skims3d["SOV"].values, expected, rtol=1e-3)
+    assert skims3d["SOV"].dtype == np.float32
+
+
+@pytest.mark.parametrize("zone_ids", [
+    [10, 20, 30, 11, 12],  # dense lookup table
+    [10, 20 * skim_dictionary.DENSE_OFFSET_LOOKUP_MIN_SPAN, 30, 11, 12],  # sparse binary search
+])
+def test_offset_mapper(zone_ids):
+
+    offset_mapper = skim_dictionary.OffsetMapper(offset_list=zone_ids)
+    assert (offset_mapper.offset_lookup is None) == (zone_ids[1] > skim_dictionary.DENSE_OFFSET_LOOKUP_MIN_SPAN)
+
+    ids = np.array([30, 10, -1, 99, zone_ids[1], 12, 5])
+    expected = pd.Series(ids).map(offset_mapper.offset_series).fillna(skim_dictionary.NOT_IN_SKIM_ZONE_ID)
+
+    npt.assert_array_equal(offset_mapper.map(ids), expected.astype(int).values)
+    npt.assert_array_equal(offset_mapper.map(pd.Series(ids)), expected.astype(int).values)
+    npt.assert_array_equal(offset_mapper.map(np.array([30.0, np.nan])), [2, skim_dictionary.NOT_IN_SKIM_ZONE_ID])
+
+
+def test_dataframe_matrix():
+
+    df = pd.DataFrame({'a': [1, 2, 3, 4, 5], 'b': [10, 20, 30, 40, 50]}, index=[100, 101, 102, 110, 104])
+    dfm = skim_dictionary.DataFrameMatrix(df)
+
+    npt.assert_array_equal(dfm.get(row_ids=[100, 100, 110], col_ids=['a', 'b', 'a']), [1, 10, 4])
+
+    with pytest.raises(RuntimeError) as excinfo:
+        dfm.get(row_ids=np.array([100, 103]), col_ids=np.array(['a', 'b']))
+    assert "not in skim" in str(excinfo.value)
@@ -4,6 +4,7 @@
 from builtins import range
 import numpy as np
 import pandas as pd
+import numpy.testing as npt
 import pandas.testing as pdt
 import pytest
 
@@ -187,3 +188,32 @@ def test_basic(persons, tdd_alts):
         ends = pd.Series([10, 10, 10, 9])
         periods_available = timetable.remaining_periods_available(person_ids, starts, ends)
         pdt.assert_series_equal(periods_available, pd.Series([6, 3, 4, 3]), check_dtype=False)
+
+
+def test_sparse_row_ids(persons, tdd_alts):
+
+    with chunk.chunk_log('test_sparse_row_ids', base=True):
+
+        # row ids too sparse for dense row id lookup table are mapped by binary search
+        sparse_persons = pd.DataFrame(index=persons.index * tt.DENSE_ROW_IX_LOOKUP_MIN_SPAN * 100)
+        timetables = [tt.TimeTable(tt.create_timetable_windows(df, tdd_alts), tdd_alts)
+                      for df in [persons, sparse_persons]]
+        assert timetables[0].row_ix_lookup is not None
+        assert timetables[1].row_ix_lookup is None
+
+        for timetable, df in zip(timetables, [persons, sparse_persons]):
+            person_ids = pd.Series(df.index[[0, 1, 2, 3, 4, 5]])
+            timetable.assign(person_ids, pd.Series([0, 1, 2, 15, 16, 17]))
+
+            person_ids = pd.Series(df.index[[5, 4, 2, 0]])
+            pdt.assert_series_equal(timetable.tour_available(person_ids, pd.Series([17, 0, 13, 0])),
+                                    pd.Series([False, True, True, True]))
+
+            # max_time_block_available
+            person_ids = pd.Series(df.index[[0, 2, 5]])
+            pdt.assert_series_equal(timetable.max_time_block_available(person_ids), pd.Series([6, 4, 4]))
+
+        npt.assert_array_equal(timetables[0].windows, timetables[1].windows)
+
+        with pytest.raises(AssertionError):
+            timetables[1].tour_available(pd.Series([1]), pd.Series([0]))
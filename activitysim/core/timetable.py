@@ -6,6 +6,7 @@ from builtins import object
 
 import logging
 
+import numba
 import numpy as np
 import pandas as pd
 
@@ -38,6 +39,16 @@ COLLISIONS = [
 
 COLLISION_LIST = [a + (b << I_BIT_SHIFT) for a, b in COLLISIONS]
 
+# COLLISION_TABLE[footprint_state, window_state] is True if footprint state collides with window state
+COLLISION_TABLE = np.zeros((I_MIDDLE + 1, I_MIDDLE + 1), dtype=np.bool_)
+for footprint_state, window_state in COLLISIONS:
+    COLLISION_TABLE[footprint_state, window_state] = True
+
+# window row ids are mapped to window row ordinals with a dense lookup table (indexed by row id) unless the span
+# of row ids is greater than both of these, in which case binary search of sorted row ids is used instead
+DENSE_ROW_IX_LOOKUP_MAX_SPARSITY = 10
+DENSE_ROW_IX_LOOKUP_MIN_SPAN = 1 << 20
+
 
 # str versions of time windows period states
 C_EMPTY = str(I_EMPTY)
@@ -47,6 +58,76 @@ C_MIDDLE = str(I_MIDDLE)
 C_START_END = str(I_START_END)
 
 
+@numba.njit(nogil=True)
+def _tour_available(windows, row_ixs, footprints, tdds, collision_table, available):
+    # available[i] is False if footprint of tdds[i] collides with window row row_ixs[i] in any period
+    for i in range(row_ixs.shape[0]):
+        window = windows[row_ixs[i]]
+        footprint = footprints[tdds[i]]
+        available[i] = True
+        for p in range(window.shape[0]):
+            if collision_table[footprint[p], window[p]]:
+                available[i] = False
+                break
+
+
+@numba.njit(nogil=True)
+def _assign_footprints(windows, row_ixs, footprints, footprint_ixs):
+    # bitwise_or footprint row footprint_ixs[i] into window row row_ixs[i]
+    for i in range(row_ixs.shape[0]):
+        window = windows[row_ixs[i]]
+        footprint = footprints[footprint_ixs[i]]
+        for p in range(window.shape[0]):
+            window[p] |= footprint[p]
+
+
+@numba.njit(nogil=True)
+def _adjacent_window_run_length(windows, row_ixs, time_col_ixs, before, run_lengths):
+    # number of periods before (or after) time_col_ixs[i] that are not I_MIDDLE in window row row_ixs[i]
+    # (padding periods at both ends of the window are not available)
+    num_cols = windows.shape[1]
+    for i in range(row_ixs.shape[0]):
+        window = windows[row_ixs[i]]
+        c = time_col_ixs[i]
+        if before:
+            j = c - 1
+            while j > 0 and window[j] != I_MIDDLE:
+                j -= 1
+            run_lengths[i] = c - max(j, 0) - 1
+        else:
+            j = c + 1
+            while j < num_cols - 1 and window[j] != I_MIDDLE:
+                j += 1
+            run_lengths[i] = min(j, num_cols) - c - 1
+
+
+@numba.njit(nogil=True)
+def _max_run_length(windows, row_ixs, max_run_lengths):
+    # length of longest run of periods that are not I_MIDDLE in window row row_ixs[i] (ignoring padding periods)
+    for i in range(row_ixs.shape[0]):
+        window = windows[row_ixs[i]]
+        longest = run = 0
+        for p in range(1, window.shape[0] - 1):
+            if window[p] != I_MIDDLE:
+                run += 1
+                longest = max(longest, run)
+            else:
+                run = 0
+        max_run_lengths[i] = longest
+
+
+@numba.njit(nogil=True)
+def _num_available(windows, row_ixs, num_available):
+    # number of periods (including padding periods) that are not I_MIDDLE in window row row_ixs[i]
+    for i in range(row_ixs.shape[0]):
+        window = windows[row_ixs[i]]
+        n = 0
+        for p in range(window.shape[0]):
+            if window[p] != I_MIDDLE:
+                n += 1
+        num_available[i] = n
+
+
 def tour_map(persons, tours, tdd_alts, persons_id_col='person_id'):
 
     sigil = {
@@ -193,15 +274,18 @@ class TimeTable(object):
         self.windows = self.windows_df.values
         self.checkpoint_df = None
 
-        # series to map window row index value to window row's ordinal index
-        self.window_row_ix = pd.Series(list(range(len(windows_df.index))), index=windows_df.index)
+        # numpy arrays to map window row index value (e.g. person_id) to window row's ordinal index
+        self._set_window_row_ix_lookup(windows_df.index)
 
         int_time_periods = [int(c) for c in windows_df.columns.values]
-        self.time_ix = pd.Series(list(range(len(windows_df.columns))), index=int_time_periods)
 
         # - pre-compute window state footprints for every tdd_alt
         min_period = min(int_time_periods)
         max_period = max(int_time_periods)
+
+        # windows columns are consecutive time periods, so time period column index is just period - min_period
+        assert int_time_periods == list(range(min_period, max_period + 1))
+        self.min_period = min_period
         # construct with strings so we can create runs of strings using char * int
         w_strings = [
             C_EMPTY * (row.start - min_period) +
@@ -212,7 +296,64 @@ class TimeTable(object):
 
         # we want range index so we can use raw numpy
         assert (tdd_alts_df.index == list(range(tdd_alts_df.shape[0]))).all()
-        self.tdd_footprints = np.asanyarray([list(r) for r in w_strings]).astype(int)
+        self.tdd_footprints = np.asanyarray([list(r) for r in w_strings]).astype(self.windows.dtype)
+
+    def _set_window_row_ix_lookup(self, window_row_index):
+        """
+        set up mapping of window row ids to window row ordinals, either a dense lookup table indexed
+        by row_id - min_row_id, or (if row ids are very sparse) sorted row ids and their ordinals for binary search
+        """
+        row_ids = np.asanyarray(window_row_index.values)
+        assert np.issubdtype(row_ids.dtype, np.integer), f"TimeTable window row ids should be integers"
+
+        self.num_window_rows = len(row_ids)
+        self.min_row_id = int(row_ids.min()) if len(row_ids) else 0
+        self.row_ix_lookup = self.sorted_row_ids = self.sorted_row_ixs = None
+
+        span = int(row_ids.max()) - self.min_row_id + 1 if len(row_ids) else 0
+        if span <= max(DENSE_ROW_IX_LOOKUP_MAX_SPARSITY * len(row_ids), DENSE_ROW_IX_LOOKUP_MIN_SPAN):
+            self.row_ix_lookup = np.full(span, -1, dtype=np.int64)
+            self.row_ix_lookup[row_ids - self.min_row_id] = np.arange(len(row_ids))
+        else:
+            self.sorted_row_ixs = np.argsort(row_ids, kind='stable')
+            self.sorted_row_ids = row_ids[self.sorted_row_ixs]
+
+    def window_row_ixs(self, window_row_ids):
+        """
+        map window_row_ids (e.g. person_ids) to ordinal indexes of window rows
+
+        Parameters
+        ----------
+        window_row_ids : pandas Series, Index, or numpy array of int
+
+        Returns
+        -------
+        numpy array of int64 window row indexes
+        """
+        row_ids = np.asanyarray(window_row_ids).astype(np.int64, copy=False)
+
+        if self.row_ix_lookup is not None:
+            offsets = row_ids - self.min_row_id
+            in_range = (offsets >= 0) & (offsets < len(self.row_ix_lookup))
+            assert in_range.all(), f"TimeTable {self.windows_table_name} window_row_ids not in windows"
+            row_ixs = self.row_ix_lookup[offsets]
+            assert (row_ixs >= 0).all(), f"TimeTable {self.windows_table_name} window_row_ids not in windows"
+        else:
+            pos = np.searchsorted(self.sorted_row_ids, row_ids)
+            assert (pos < len(self.sorted_row_ids)).all() and (self.sorted_row_ids[pos] == row_ids).all(), \
+                f"TimeTable {self.windows_table_name} window_row_ids not in windows"
+            row_ixs = self.sorted_row_ixs[pos]
+
+        return row_ixs
+
+    def time_col_ixs(self, periods):
+        """
+        map time periods to column indexes of windows
+        """
+        time_col_ixs = np.asanyarray(periods).astype(np.int64) - self.min_period
+        assert ((time_col_ixs >= 0) & (time_col_ixs < self.windows.shape[1])).all(), \
+            f"TimeTable {self.windows_table_name} periods not in windows"
+        return time_col_ixs
 
     def begin_transaction(self, transaction_loggers):
         """
@@ -242,18 +383,17 @@ class TimeTable(object):
         return windows array slice containing rows for specified window_row_ids
         (in window_row_ids order)
         """
-        row_ixs = window_row_ids.map(self.window_row_ix).values
-        windows = self.windows[row_ixs]
+        windows = self.windows[self.window_row_ixs(window_row_ids)]
 
         return windows
 
     def slice_windows_by_row_id_and_period(self, window_row_ids, periods):
 
         # row ixs of tour_df group rows in windows
-        row_ixs = window_row_ids.map(self.window_row_ix).values
+        row_ixs = self.window_row_ixs(window_row_ids)
 
         # col ixs of periods in windows
-        time_col_ixs = periods.map(self.time_ix).values
+        time_col_ixs = self.time_col_ixs(periods)
 
         windows = self.windows[row_ixs, time_col_ixs]
 
@@ -308,17 +448,11 @@ class TimeTable(object):
 
         assert len(window_row_ids) == len(tdds)
 
-        # numpy array with one tdd_footprints_df row for tdds
-        tour_footprints = self.tdd_footprints[tdds.values.astype(int)]
-
-        # numpy array with one windows row for each person
-        windows = self.slice_windows_by_row_id(window_row_ids)
-
-        # t0 = tracing.print_elapsed_time("slice_windows_by_row_id", t0, debug=True)
-
-        x = tour_footprints + (windows << I_BIT_SHIFT)
+        # test each tdd footprint against its window row in place (rather than slicing windows and footprints)
+        available = np.empty(len(window_row_ids), dtype=bool)
+        _tour_available(self.windows, self.window_row_ixs(window_row_ids),
+                        self.tdd_footprints, tdds.values.astype(int), COLLISION_TABLE, available)
 
-        available = ~np.isin(x, COLLISION_LIST).any(axis=1)
         available = pd.Series(available, index=window_row_ids.index)
 
         return available
@@ -340,16 +474,13 @@ class TimeTable(object):
 
         assert len(window_row_ids) == len(tdds)
 
-        # vectorization doesn't work duplicates
+        # we don't expect to schedule more than one tour per window row at a time
         assert len(window_row_ids.index) == len(np.unique(window_row_ids.values))
 
-        # numpy array with one time window row for each person tdd
-        tour_footprints = self.tdd_footprints[tdds.values.astype(int)]
-
         # row idxs of windows to assign to
-        row_ixs = window_row_ids.map(self.window_row_ix).values
+        row_ixs = self.window_row_ixs(window_row_ids)
 
-        self.windows[row_ixs] = np.bitwise_or(self.windows[row_ixs], tour_footprints)
+        _assign_footprints(self.windows, row_ixs, self.tdd_footprints, tdds.values.astype(int))
 
     def assign_subtour_mask(self, window_row_ids, tdds):
         """
@@ -373,7 +504,7 @@ class TimeTable(object):
         """
 
         # expect window_row_ids for every row
-        assert len(window_row_ids) == len(self.window_row_ix)
+        assert len(window_row_ids) == self.num_window_rows
 
         assert len(window_row_ids) == len(tdds)
 
@@ -384,7 +515,7 @@ class TimeTable(object):
         tour_footprints = self.tdd_footprints[tdds.values.astype(int)]
 
         # row idxs of windows to assign to
-        row_ixs = window_row_ids.map(self.window_row_ix).values
+        row_ixs = self.window_row_ixs(window_row_ids)
 
         self.windows[row_ixs] = (tour_footprints == 0) * I_MIDDLE
 
@@ -408,13 +539,13 @@ class TimeTable(object):
         # require same number of periods in footprints
         assert self.windows.shape[1] == footprints.shape[1]
 
-        # vectorization doesn't work with duplicate row_ids
+        # we don't expect duplicate row_ids
         assert len(window_row_ids.values) == len(np.unique(window_row_ids.values))
 
         # row idxs of windows to assign to
-        row_ixs = window_row_ids.map(self.window_row_ix).values
+        row_ixs = self.window_row_ixs(window_row_ids)
 
-        self.windows[row_ixs] = np.bitwise_or(self.windows[row_ixs], footprints)
+        _assign_footprints(self.windows, row_ixs, footprints, np.arange(len(row_ixs)))
 
     def pairwise_available(self, window1_row_ids, window2_row_ids):
 
@@ -448,40 +579,14 @@ class TimeTable(object):
         trace_label = 'tt.adjacent_window_run_length'
         with chunk.chunk_log(trace_label):
 
-            time_col_ixs = periods.map(self.time_ix).values
+            time_col_ixs = self.time_col_ixs(periods)
             chunk.log_df(trace_label, 'time_col_ixs', time_col_ixs)
 
-            # sliced windows with 1s where windows state is I_MIDDLE and 0s elsewhere
-            available = (self.slice_windows_by_row_id(window_row_ids) != I_MIDDLE) * 1
-            chunk.log_df(trace_label, 'available', available)
-
-            # padding periods not available
-            available[:, 0] = 0
-            available[:, -1] = 0
-
-            # column idxs of windows
-            num_rows, num_cols = available.shape
-            time_col_ix_map = np.tile(np.arange(0, num_cols), num_rows).reshape(num_rows, num_cols)
-            # 0 1 2 3 4 5...
-            # 0 1 2 3 4 5...
-            # 0 1 2 3 4 5...
-            chunk.log_df(trace_label, 'time_col_ix_map', time_col_ix_map)
-
-            if before:
-                # ones after specified time, zeroes before
-                mask = (time_col_ix_map < time_col_ixs.reshape(num_rows, 1)) * 1
-                # index of first unavailable window after time
-                first_unavailable = np.where((1-available)*mask, time_col_ix_map, 0).max(axis=1)
-                available_run_length = time_col_ixs - first_unavailable - 1
-            else:
-                # ones after specified time, zeroes before
-                mask = (time_col_ix_map > time_col_ixs.reshape(num_rows, 1)) * 1
-                # index of first unavailable window after time
-                first_unavailable = np.where((1 - available) * mask, time_col_ix_map, num_cols).min(axis=1)
-                available_run_length = first_unavailable - time_col_ixs - 1
-
-            chunk.log_df(trace_label, 'mask', mask)
-            chunk.log_df(trace_label, 'first_unavailable', first_unavailable)
+            # walk from each period through its window row to the first unavailable (I_MIDDLE) period
+            available_run_length = np.empty(len(window_row_ids), dtype=np.int64)
+            _adjacent_window_run_length(self.windows, self.window_row_ixs(window_row_ids), time_col_ixs, before,
+                                        available_run_length)
+
             chunk.log_df(trace_label, 'available_run_length', available_run_length)
 
         return pd.Series(available_run_length, index=window_row_ids.index)
@@ -627,7 +732,8 @@ class TimeTable(object):
         assert len(window_row_ids) == len(starts)
         assert len(window_row_ids) == len(ends)
 
-        available = (self.slice_windows_by_row_id(window_row_ids) != I_MIDDLE).sum(axis=1)
+        available = np.empty(len(window_row_ids), dtype=np.int64)
+        _num_available(self.windows, self.window_row_ixs(window_row_ids), available)
 
         # don't count time window padding at both ends of day
         available -= 2
@@ -653,27 +759,7 @@ class TimeTable(object):
         # FIXME consider dedupe/redupe window_row_ids for performance
         # as this may be called for alts with lots of duplicates (e.g. trip scheduling time pressure calculations)
 
-        # sliced windows with 1s where windows state is I_MIDDLE and 0s elsewhere
-        available = (self.slice_windows_by_row_id(window_row_ids) != I_MIDDLE) * 1
-
-        # np.set_printoptions(edgeitems=25, linewidth = 180)
-        # print(f"self.slice_windows_by_row_id(window_row_ids)\n{self.slice_windows_by_row_id(window_row_ids)}")
-
-        # padding periods not available
-        available[:, 0] = 0
-        available[:, -1] = 0
-
-        diffs = np.diff(available)  # 1 at start of run of availables, -1 at end, 0 everywhere else
-        start_row_index, starts = np.asarray(diffs > 0).nonzero()  # indices of run starts
-        end_row_index, ends = np.asarray(diffs < 0).nonzero()  # indices of run ends
-        assert (start_row_index == end_row_index).all()  # because bounded, expect same number of starts and ends
-
-        # run_lengths like availability but with run length at start of every run and zeros elsewhere
-        # (row_indices of starts and ends are aligned, so end - start is run_length)
-        run_lengths = np.zeros_like(available)
-        run_lengths[start_row_index, starts] = (ends - starts)
-
-        # we just want to know the the longest one for each window_row_id
-        max_run_lengths = run_lengths.max(axis=1)
+        max_run_lengths = np.empty(len(window_row_ids), dtype=np.int64)
+        _max_run_length(self.windows, self.window_row_ixs(window_row_ids), max_run_lengths)
 
         return pd.Series(max_run_lengths, index=window_row_ids.index)
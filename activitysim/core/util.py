@@ -2,6 +2,7 @@
 # See full license in LICENSE.txt.
 
 from builtins import zip
+import hashlib
 import logging
 import os
 
@@ -68,6 +69,17 @@ def delete_files(file_list, trace_label):
             logger.warning(f"{trace_label} exception (e) trying to delete {file_path}")
 
 
+def file_digest(file_path):
+    """
+    Return md5 hexdigest of file contents
+    """
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
 def df_size(df):
     bytes = 0 if df.empty else df.memory_usage(index=True).sum()
     return "%s %s" % (df.shape, GB(bytes))